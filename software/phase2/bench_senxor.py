@@ -0,0 +1,1511 @@
+# Benchmarks of the senxor acquisition stack, using synthetic data so that
+# they can be run on any machine, without a camera module attached.
+#
+# Usage:
+#     python bench_senxor.py parser [-n N_FRAMES]
+#     python bench_senxor.py decoder [-n N_FRAMES]
+#     python bench_senxor.py config [--latency MS]
+#     python bench_senxor.py restart [-n N_CYCLES] [--boot-time MS]
+#     python bench_senxor.py spi [-n N_FRAMES] [--xfer-size BYTES]
+#     python bench_senxor.py array [-n N_BATCHES] [--cameras N]
+#     python bench_senxor.py stream [-t SECONDS] [--fps FPS] [--faults P]
+#     python bench_senxor.py record [-n N_FRAMES] [--dir DIR]
+#     python bench_senxor.py crc [-n N_FRAMES]
+#     python bench_senxor.py convert [-n N_FRAMES]
+#     python bench_senxor.py raw [-n N_FRAMES]
+#     python bench_senxor.py frame [-n N_FRAMES] [--window K]
+#     python bench_senxor.py live [-n N_CHANGES] [--fps FPS] [--foreground]
+#     python bench_senxor.py trigger [-n N_CYCLES] [--period MS]
+#     python bench_senxor.py governor [--idle S] [--active S]
+#     python bench_senxor.py info [-n N_CYCLES] [--latency MS] [--interval S]
+#     python bench_senxor.py preprocess [-n N_FRAMES]
+#     python bench_senxor.py classify [-n N_FRAMES]
+#     python bench_senxor.py render [-n N_FRAMES]
+#     python bench_senxor.py filter [-n N_FRAMES] [--noise C] [--hazard C]
+#                                   [--recording FILE.sxr]
+#     python bench_senxor.py average [-n N_FRAMES]
+import argparse
+import collections
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import serial
+
+from senxor.mi48 import MI48, DEFAULT_CTRL_STAT, regmap, KELVIN_0,\
+                        crc16, crc16_numpy, CRC_POLICIES, celsius_lut,\
+                        raw_threshold, FrameRing, AcquisitionStats,\
+                        format_stats, CompensationParamsCache
+from senxor.emulator import MI48Emulator, synthetic_frame
+from senxor.utils import SenxorArray, data_to_frame, remap, cv_filter,\
+                         FrameRateGovernor, RollingAverageFilter,\
+                         ThermalPreprocessor, ThermalClassifier,\
+                         ThermalRenderer, cv_render, _colormap_luts,\
+                         TrueAverageFilter
+import cv2 as cv
+from senxor.recording import Recorder, Recording
+from senxor.interfaces import USB_Interface, SPI_Interface, usb_get_ack, usb_parse_ack, usb_format_ack,\
+                              USBStreamDecoder, USB_ACK_LEN, USB_CMD_LEN,\
+                              USB_CKS_LEN, USB_MAX_ACK_LEN
+
+# frame geometry of the MI0801/MI0802 modules; header is one row of words
+FPA_COLS, FPA_ROWS = 80, 62
+
+
+def synthetic_gfra(seed=0):
+    """Return a GFRA acknowledge (bytes) with a header row and a random frame"""
+    rng = np.random.default_rng(seed)
+    words = rng.integers(2900, 3300, size=FPA_COLS * (FPA_ROWS + 1),
+                         dtype=np.uint16)
+    return usb_format_ack('GFRA', words.tobytes())
+
+
+class ReplayPort:
+    """Minimal stand-in for a serial port, replaying a byte stream forever"""
+
+    def __init__(self, stream):
+        self.stream = bytes(stream)
+        self.pos = 0
+        self.n_read = 0
+
+    def read(self, size):
+        out = bytearray()
+        while len(out) < size:
+            chunk = self.stream[self.pos: self.pos + size - len(out)]
+            out += chunk
+            self.pos = (self.pos + len(chunk)) % len(self.stream)
+        self.n_read += size
+        return bytes(out)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def reset_input_buffer(self):
+        pass
+
+
+class FakeSpiDev:
+    """
+    Stand-in for spidev.SpiDev, clocking out a frame forever. Like the
+    real one, every transfer returns a new list of ints; xfer3 is there
+    only if `xfer3` is true, as in spidev >= 3.5.
+    """
+
+    def __init__(self, frame, xfer3=False, reuse=False):
+        self.stream = list(frame)
+        self.pos = 0
+        if xfer3:
+            self.xfer3 = self.xfer
+        # return the same lists over and over, so that tracemalloc
+        # sees only what the host side allocates
+        self.reuse = {} if reuse else None
+
+    def xfer(self, values):
+        if self.reuse is None:
+            return self._xfer(values)
+        key = (self.pos, len(values))
+        if key not in self.reuse:
+            self.reuse[key] = self._xfer(values)
+        else:
+            self.pos = (self.pos + len(values)) % len(self.stream)
+        return self.reuse[key]
+
+    def _xfer(self, values):
+        if self.pos + len(values) <= len(self.stream):
+            chunk = self.stream[self.pos: self.pos + len(values)]
+            self.pos = (self.pos + len(values)) % len(self.stream)
+            return chunk
+        out = []
+        while len(out) < len(values):
+            chunk = self.stream[self.pos: self.pos + len(values) - len(out)]
+            out += chunk
+            self.pos = (self.pos + len(chunk)) % len(self.stream)
+        return out
+
+
+def legacy_spi_read(device, xfer_size, length_in_words):
+    """
+    The original SPI_Interface.read; note that it fails unless the
+    frame is a multiple of xfer_size (numpy raises ValueError, not
+    IndexError, on the last transfer)
+    """
+    dummy_bytes = [0,] * xfer_size
+    xfer_size_words = int(xfer_size / 2)
+    data = np.zeros(length_in_words, dtype=np.uint16)
+    n_words = 0
+    while n_words < length_in_words:
+        i0 = n_words
+        i1 = n_words + xfer_size_words
+        response = device.xfer(dummy_bytes)
+        buffer = np.array(response).astype('u1')
+        n_words += int(len(buffer) / 2.)
+        _data = np.ndarray(shape=(int(len(buffer) / 2),),
+                           buffer=buffer, dtype='>u2')
+        try:
+            data[i0: i1] = _data
+        except IndexError:
+            data[i0:] = _data[:length_in_words - i0]
+    return data
+
+
+def legacy_get_ack(port):
+    """The original parser: 4-byte reads and a per-byte python check sum"""
+    def _cksum(data, sum=0):
+        for byte in data:
+            sum += byte
+        return sum
+    res = ''
+    while res != '   #':
+        res = port.read(4)
+        try:
+            res = res.decode()
+        except UnicodeDecodeError:
+            res = ''
+    _len = port.read(USB_ACK_LEN)
+    cs = _cksum(_len)
+    ack_len = int(_len.decode(), base=16)
+    data_len = ack_len - USB_ACK_LEN - USB_CMD_LEN
+    cmd = port.read(USB_CMD_LEN)
+    cs = _cksum(cmd, cs)
+    data = port.read(data_len)
+    cs = _cksum(data, cs) & 0xFFFF
+    cks = int(port.read(USB_CKS_LEN), base=16)
+    assert cs == cks
+    return cmd, data
+
+
+def damaged_stream(n_frames, seed=0):
+    """
+    Return a GFRA stream as recorded from a flaky USB link, and the number
+    of intact frames in it: some frames have flipped bits, some are
+    truncated, and some are followed by junk of odd length.
+    """
+    rng = np.random.default_rng(seed)
+    gfra = synthetic_gfra()
+    stream = bytearray()
+    n_good = 0
+    for i in range(n_frames):
+        ack = bytearray(gfra)
+        if i % 10 == 3:
+            ack[rng.integers(12, len(ack) - 4)] ^= 0x40
+        elif i % 15 == 7:
+            ack = ack[:rng.integers(8, len(ack))]
+        else:
+            n_good += 1
+        stream += ack
+        if i % 7 == 5:
+            stream += rng.integers(0, 255, size=rng.integers(1, 9) * 2 - 1,
+                                   dtype=np.uint8).tobytes()
+    return bytes(stream), n_good
+
+
+def connect_emulator(emulator):
+    """Return an MI48 instance attached to the emulator pty"""
+    ser = serial.Serial(emulator.device, timeout=0.5)
+    usb = USB_Interface(ser)
+    return MI48([usb, usb])
+
+
+def configure(mi48):
+    """The configuration sequence of dualcamproc.thermalcapture"""
+    mi48.set_fps(20)
+    mi48.disable_filter(f1=True, f2=True, f3=True)
+    mi48.set_filter_1(85)
+    mi48.enable_filter(f1=True, f2=False, f3=False, f3_ks_5=False)
+    mi48.set_offset_corr(0.0)
+    mi48.set_sens_factor(100)
+    mi48.get_sens_factor()
+
+
+def time_frames(func, n_frames):
+    """Call `func` n_frames times; return (frames/s, CPU ms per frame)"""
+    t0, c0 = time.perf_counter(), time.process_time()
+    for _ in range(n_frames):
+        func()
+    t1, c1 = time.perf_counter(), time.process_time()
+    return n_frames / (t1 - t0), 1.e3 * (c1 - c0) / n_frames
+
+
+def report(name, fps, cpu_ms):
+    print('{:24s} {:10.0f} frames/s {:8.3f} ms CPU/frame'.
+          format(name, fps, cpu_ms))
+
+
+def bench_parser(args):
+    """Compare the GFRA acknowledge parsers"""
+    stream = synthetic_gfra()
+    print('GFRA acknowledge of {} bytes'.format(len(stream)))
+
+    port = ReplayPort(stream)
+    def legacy():
+        usb_parse_ack(*legacy_get_ack(port))
+    report('legacy', *time_frames(legacy, args.n_frames))
+
+    port = ReplayPort(stream)
+    def bulk():
+        usb_parse_ack(*usb_get_ack(port))
+    report('bulk read', *time_frames(bulk, args.n_frames))
+
+    port = ReplayPort(stream)
+    buffer = bytearray(USB_MAX_ACK_LEN)
+    def bulk_reused():
+        usb_parse_ack(*usb_get_ack(port, buffer=buffer))
+    report('bulk read, reused buf', *time_frames(bulk_reused, args.n_frames))
+
+
+def bench_decoder(args):
+    """Frame recovery and speed on a damaged stream: legacy vs decoder"""
+    logging.disable(logging.ERROR)
+    stream, n_good = damaged_stream(args.n_frames)
+    print('{} frames sent, {} intact'.format(args.n_frames, n_good))
+
+    port = ReplayPort(stream)
+    n_frames = 0
+    t0 = time.process_time()
+    while port.n_read < len(stream):
+        ack = usb_get_ack(port)
+        if ack is not None and ack[0] == b'GFRA':
+            n_frames += 1
+    cpu = time.process_time() - t0
+    print('{:24s} {:6d} frames received {:8.3f} ms CPU/frame'.
+          format('usb_get_ack', n_frames, 1.e3 * cpu / args.n_frames))
+
+    decoder = USBStreamDecoder()
+    n_frames = 0
+    t0 = time.process_time()
+    for i in range(0, len(stream), 4096):
+        decoder.feed(stream[i: i + 4096])
+        for cmd, data in decoder:
+            n_frames += cmd == 'GFRA'
+    cpu = time.process_time() - t0
+    print('{:24s} {:6d} frames received {:8.3f} ms CPU/frame'.
+          format('stream decoder', n_frames, 1.e3 * cpu / args.n_frames))
+
+
+def bench_config(args):
+    """Serial vs. pipelined register access, with emulated USB latency"""
+    logging.disable(logging.WARNING)
+    emulator = MI48Emulator(latency=1.e-3 * args.latency).start()
+    mi48 = connect_emulator(emulator)
+    print('Emulated acknowledge latency {} ms'.format(args.latency))
+
+    regs = [regmap[name] for name in DEFAULT_CTRL_STAT]
+    writes = [(name, DEFAULT_CTRL_STAT[name]) for name in DEFAULT_CTRL_STAT
+              if name not in ('STATUS', 'FRAME_MODE')]
+    def serial_sweep():
+        for name, value in writes:
+            mi48.regwrite(name, value)
+        return [mi48.regread(reg) for reg in regs]
+    def batch_sweep():
+        with mi48.batch():
+            for name, value in writes:
+                mi48.regwrite(name, value)
+        return mi48.regread_many(regs)
+    def serial_config():
+        configure(mi48)
+    def batch_config():
+        with mi48.batch():
+            configure(mi48)
+
+    for name, func in [('register sweep, serial', serial_sweep),
+                       ('register sweep, batch', batch_sweep),
+                       ('startup config, serial', serial_config),
+                       ('startup config, batch', batch_config)]:
+        n0 = emulator.n_commands
+        t0 = time.perf_counter()
+        func()
+        dt = time.perf_counter() - t0
+        print('{:24s} {:8.1f} ms {:4d} commands'.
+              format(name, 1.e3 * dt, emulator.n_commands - n0))
+    assert serial_sweep() == batch_sweep()
+    mi48.stop()
+    emulator.close()
+
+
+def bench_restart(args):
+    """Cold start (connect and boot) and warm restart (stop, start) times"""
+    logging.disable(logging.WARNING)
+    emulator = MI48Emulator(fps=25, boot_time=1.e-3 * args.boot_time,
+                            latency=0.5e-3).start()
+    print('Emulated boot time {} ms, {} cycles'.format(args.boot_time,
+                                                       args.n_cycles))
+    cold, warm = [], []
+    for i in range(args.n_cycles):
+        # a reconnect after a USB glitch: the camera is still streaming
+        emulator.regs[regmap['FRAME_MODE']] |= 0x02
+        emulator.t_booted = time.monotonic() + emulator.boot_time
+        t0 = time.perf_counter()
+        mi48 = connect_emulator(emulator)
+        mi48.start(stream=True, with_header=True)
+        mi48.read()
+        cold.append(time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        mi48.stop_capture()
+        mi48.start(stream=True, with_header=True)
+        mi48.read()
+        warm.append(time.perf_counter() - t0)
+        mi48.interfaces[0].port.close()
+    print('{:24s} {:8.1f} ms median {:8.1f} ms max'.format(
+          'cold start', 1.e3 * np.median(cold), 1.e3 * max(cold)))
+    print('{:24s} {:8.1f} ms median {:8.1f} ms max'.format(
+          'warm restart', 1.e3 * np.median(warm), 1.e3 * max(warm)))
+    print('last cycle:')
+    for phase, dt in mi48.timings.items():
+        print('  {:22s} {:8.1f} ms'.format(phase, 1.e3 * dt))
+    emulator.close()
+
+
+def bench_spi(args):
+    """SPI frame reads from a fake spidev: throughput and memory per frame"""
+    n_words = FPA_COLS * (FPA_ROWS + 1)
+    frame = np.random.default_rng(0).integers(
+        2900, 3300, size=n_words, dtype=np.uint16).astype('>u2')
+    print('Frame of {} bytes, transfers of {} bytes'.format(
+          2 * n_words, args.xfer_size))
+    out = np.empty(n_words, dtype=np.uint16)
+    spi = SPI_Interface(FakeSpiDev(frame.tobytes()), args.xfer_size)
+    spi3 = SPI_Interface(FakeSpiDev(frame.tobytes(), xfer3=True),
+                         args.xfer_size)
+    legacy_dev = FakeSpiDev(frame.tobytes())
+    cases = [
+        ('legacy', lambda: legacy_spi_read(legacy_dev, args.xfer_size,
+                                           n_words)),
+        ('xfer', lambda: spi.read(n_words)),
+        ('xfer, out=', lambda: spi.read(n_words, out=out)),
+        ('xfer3, out=', lambda: spi3.read(n_words, out=out)),
+    ]
+    for name, func in cases:
+        assert np.array_equal(func(), frame)
+        fps, cpu_ms = time_frames(func, args.n_frames)
+        # peak of the memory allocated while reading one frame; this
+        # includes the lists returned by spidev, common to all cases
+        tracemalloc.start()
+        func()
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        func()
+        peak = tracemalloc.get_traced_memory()[1] - base
+        tracemalloc.stop()
+        print('{:16s} {:8.1f} MB/s {:8.3f} ms CPU/frame {:8.1f} kB peak'.
+              format(name, 2.e-6 * n_words * fps, cpu_ms, 1.e-3 * peak))
+
+
+def bench_array(args):
+    """Time-aligned batches from several emulated cameras streaming at once"""
+    logging.disable(logging.WARNING)
+    emulators = [MI48Emulator(fps=args.fps).start()
+                 for i in range(args.cameras)]
+    cameras = SenxorArray([connect_emulator(emulator)
+                           for emulator in emulators])
+    print('{} cameras at {} fps'.format(len(cameras), args.fps))
+    cameras.start()
+    skews = []
+    t0 = time.perf_counter()
+    for i in range(args.n_batches):
+        frames, headers = cameras.read(timeout=1.0)
+        assert frames.shape == (len(cameras), FPA_ROWS, FPA_COLS)
+        skews.append(cameras.skew)
+    dt = time.perf_counter() - t0
+    cameras.stop()
+    print('{:24s} {:8.1f} batches/s'.format('throughput', args.n_batches / dt))
+    print('{:24s} {:8.1f} ms mean {:8.1f} ms max'.format(
+          'skew within batch', 1.e3 * np.mean(skews), 1.e3 * max(skews)))
+    print('{:24s} {}'.format('frames dropped', cameras.get_dropped()))
+    print('{:24s} {}'.format('last frame counters',
+                             [h['frame_counter'] for h in headers]))
+    cameras.close()
+    for emulator in emulators:
+        emulator.close()
+
+
+def bench_stream(args):
+    """Acquisition throughput and latency, from an emulator at high fps"""
+    logging.disable(logging.CRITICAL)
+    emulator = MI48Emulator(fps=args.fps, checksum_errors=args.faults,
+                            truncations=args.faults, delays=args.faults / 10,
+                            delay=0.05, seed=0).start()
+    mi48 = connect_emulator(emulator)
+    print('Emulator at {} fps, fault probability {} per frame'.format(
+          args.fps, args.faults))
+    mi48.start(stream=True, with_header=True, background=True,
+               queue_size=args.queue_size, policy='drop_oldest')
+    latencies = []
+    n_frames = n_crc_errors = 0
+    t0 = time.monotonic()
+    while time.monotonic() - t0 < args.duration:
+        data, header = mi48.read(timeout=1.0)
+        if data is None:
+            continue
+        # the emulator stamps frames with its time.monotonic() in ms
+        t_ms = int(1.e3 * time.monotonic()) & 0xFFFFFFFF
+        latencies.append((t_ms - header['timestamp']) & 0xFFFFFFFF)
+        n_frames += 1
+        n_crc_errors += mi48.crc_error
+    dt = time.monotonic() - t0
+    queue = mi48.frame_queue
+    mi48.stop_capture()
+    decoder = mi48.interfaces[1].decoder
+    print('{:24s} {:8.1f} frames/s {:8.1f} MB/s'.format(
+          'received', n_frames / dt,
+          1.e-6 * n_frames * 2 * mi48.get_frame_size() / dt))
+    print('{:24s} {:8.1f} ms median {:8.1f} ms p99'.format(
+          'latency', np.median(latencies), np.percentile(latencies, 99)))
+    print('{:24s} {:8d} sent, {} corrupted, {} truncated, {} delayed'.format(
+          'emulator frames', emulator.n_frames, emulator.n_corrupted,
+          emulator.n_truncated, emulator.n_delayed))
+    print('{:24s} {:8d} rejected acks, {} bytes skipped'.format(
+          'decoder', decoder.n_errors, decoder.n_skipped))
+    print('{:24s} {:8d} CRC errors, {} dropped from queue'.format(
+          'host', n_crc_errors, queue.n_dropped))
+    stats = mi48.get_stats()
+    print('{:24s} {}'.format('MI48.get_stats()', format_stats(stats)))
+    print('{:24s} {:8d} missed in {} gaps; read() waited {:.2f} s'.format(
+          '', stats['missed'], stats['gaps'], stats['read_wait']))
+    # the cost of keeping the statistics
+    acq = AcquisitionStats()
+    i = iter(range(1 << 30))
+    fps, cpu_ms = time_frames(lambda: acq.update(time.monotonic(), 10080,
+                                                 next(i) & 0xFFFF, 0), 10000)
+    print('{:24s} {:8.2f} us CPU/frame'.format('AcquisitionStats.update',
+                                              1.e3 * cpu_ms))
+    fps, cpu_ms = time_frames(mi48.get_stats, 1000)
+    print('{:24s} {:8.2f} us CPU/call'.format('MI48.get_stats', 1.e3 * cpu_ms))
+    mi48.stop()
+    emulator.close()
+
+
+def bench_record(args):
+    """Writing and replaying a recording, vs. CSV as written by savetxt"""
+    n_words = FPA_COLS * FPA_ROWS
+    frames = [synthetic_frame((FPA_COLS, FPA_ROWS), i) for i in range(100)]
+    celsius = [(f / 10. + KELVIN_0).astype(np.float16) for f in frames]
+    header = {'timestamp': 0, 'frame_counter': 0, 'senxor_vdd': 3.3,
+              'senxor_temperature': 30., 'crc': '0x0'}
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        filename = os.path.join(tmp, 'bench.sxr')
+        t0 = time.perf_counter()
+        with Recorder(filename, (FPA_COLS, FPA_ROWS)) as rec:
+            for i in range(args.n_frames):
+                header['frame_counter'] = i
+                rec.write(celsius[i % 100], header, host_time=i / 25.)
+        dt = time.perf_counter() - t0
+        size = os.path.getsize(filename)
+        print('{:24s} {:8.0f} frames/s {:8.1f} MB written'.format(
+              'record', args.n_frames / dt, 1.e-6 * size))
+
+        # replay: the hottest pixel of every frame, in chunks of frames
+        t0 = time.perf_counter()
+        rec = Recording(filename)
+        tmax = np.concatenate([rec.frames[i: i + 4096].max(axis=(1, 2))
+                               for i in range(0, len(rec), 4096)])
+        dt = time.perf_counter() - t0
+        assert len(tmax) == args.n_frames
+        print('{:24s} {:8.0f} frames/s {:8.1f} s per day at 25 fps'.format(
+              'replay', args.n_frames / dt, 86400 * 25 * dt / args.n_frames))
+        rng = np.random.default_rng(0)
+        t0 = time.perf_counter()
+        for i in rng.integers(0, len(rec), 1000):
+            rec.celsius(int(i))
+        dt = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        for t in rng.uniform(0, args.n_frames / 25., 1000):
+            rec.between(t, t + 10.)
+        dt_seek = time.perf_counter() - t0
+        print('{:24s} {:8.1f} us per frame {:8.1f} us per seek by time'.
+              format('random access', 1.e3 * dt, 1.e3 * dt_seek))
+        del rec, tmax
+
+        n_csv = min(args.n_frames, 1000)
+        filename = os.path.join(tmp, 'bench.csv')
+        t0 = time.perf_counter()
+        with open(filename, 'w') as f:
+            for i in range(n_csv):
+                np.savetxt(f, celsius[i % 100].reshape(1, n_words),
+                           fmt='%.2f', delimiter=',')
+        dt = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        data = np.loadtxt(filename, delimiter=',')
+        dt_load = time.perf_counter() - t0
+        assert data.shape == (n_csv, n_words)
+        print('{:24s} {:8.0f} frames/s written {:8.0f} frames/s loaded'.
+              format('CSV', n_csv / dt, n_csv / dt_load))
+
+
+def bench_crc(args):
+    """Frame CRC: crcmod vs. crc16_numpy, and MI48 CRC policies at 25 fps"""
+    import crcmod
+    from crcmod._crcfunpy import _crc16
+    logging.disable(logging.CRITICAL)
+    rng = np.random.default_rng(0)
+    for n in [1, 2, 3, 5, 64, 4959, FPA_COLS * FPA_ROWS]:
+        data = rng.integers(0, 1 << 16, size=n, dtype=np.uint16)
+        assert crc16(data) == crc16_numpy(data)
+    assert crc16_numpy(b'123456789') == 0x29B1
+    print('crc16_numpy == crcmod on random frames')
+
+    data = rng.integers(2900, 3300, size=FPA_COLS * FPA_ROWS, dtype=np.uint16)
+    table = crcmod.Crc(0x11021, initCrc=0xFFFF, rev=False).table
+    budget = 1.e3 / 25
+    for name, func, n in [
+            ('crcmod, python', lambda: _crc16(data.tobytes(), 0xFFFF, table),
+             args.n_frames // 20),
+            ('crcmod, C extension', lambda: crc16(data), args.n_frames),
+            ('crc16_numpy', lambda: crc16_numpy(data), args.n_frames)]:
+        fps, cpu_ms = time_frames(func, n)
+        print('{:24s} {:8.3f} ms CPU/frame {:6.2f} % of a 25 fps frame'.
+              format(name, cpu_ms, 100 * cpu_ms / budget))
+
+    emulator = MI48Emulator().start()
+    mi48 = connect_emulator(emulator)
+    # frames with header, as after mi48.start(with_header=True)
+    emulator.regs[regmap['FRAME_MODE']] = 0
+    mi48.capture_no_header = False
+    responses = [np.frombuffer(emulator.make_frame(), dtype=np.uint16)
+                 for i in range(25)]
+    i = iter(range(1 << 30))
+    for policy in CRC_POLICIES:
+        mi48.set_crc_policy(policy)
+        n0, e0 = mi48.n_crc_checked, mi48.n_crc_errors
+        fps, cpu_ms = time_frames(
+            lambda: mi48.parse_response(responses[next(i) % 25]),
+            args.n_frames)
+        mi48.set_crc_policy('every')
+        print('{:24s} {:8.3f} ms CPU/frame {:6d} checked {} errors'.format(
+              'parse_response, ' + policy, cpu_ms,
+              mi48.n_crc_checked - n0, mi48.n_crc_errors - e0))
+    mi48.stop()
+    emulator.close()
+
+
+def peak_alloc(func, n=5):
+    """Return the peak memory (bytes) allocated by a call to func"""
+    func()
+    tracemalloc.start()
+    peak = 0
+    for _ in range(n):
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        func()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    return peak
+
+
+def bench_convert(args):
+    """Kelvin to Celsius conversion, and memory allocated per MI48 read"""
+    logging.disable(logging.CRITICAL)
+    data = np.random.default_rng(0).integers(
+        2900, 3300, size=FPA_COLS * FPA_ROWS, dtype=np.uint16)
+    out16 = np.empty(data.shape, dtype=np.float16)
+    out32 = np.empty(data.shape, dtype=np.float32)
+    index = np.empty(data.shape, dtype=np.intp)
+    lut = celsius_lut(np.float16)
+    def lut_into(out):
+        np.copyto(index, data)
+        np.take(celsius_lut(out.dtype), index, out=out, mode='clip')
+    assert np.array_equal(lut.take(data),
+                          (data / 10. + KELVIN_0).astype(np.float16))
+    for name, func in [
+            ('arithmetic, float16',
+             lambda: (data / 10. + KELVIN_0).astype(np.float16)),
+            ('LUT, float16', lambda: lut.take(data)),
+            ('LUT into out, float16', lambda: lut_into(out16)),
+            ('LUT into out, float32', lambda: lut_into(out32))]:
+        fps, cpu_ms = time_frames(func, args.n_frames)
+        print('{:24s} {:8.1f} us CPU/frame {:8.1f} kB peak'.format(
+              name, 1.e3 * cpu_ms, 1.e-3 * peak_alloc(func)))
+
+    # registers through the emulator, frames through a fake SPI device
+    # that returns the same lists every time, so that what is measured
+    # is the allocation on the host side; what remains for read_into()
+    # is SPI_Interface turning those lists into bytes
+    emulator = MI48Emulator().start()
+    usb = USB_Interface(serial.Serial(emulator.device, timeout=0.5))
+    emulator.regs[regmap['FRAME_MODE']] = 0
+    frame = np.frombuffer(emulator.make_frame(), dtype=np.uint16)
+    spi = SPI_Interface(FakeSpiDev(frame.astype('>u2').tobytes(),
+                                   xfer3=True, reuse=True), 2520)
+    mi48 = MI48([usb, spi])
+    mi48.capture_no_header = False
+    out = np.empty(data.shape, dtype=np.float32)
+    frame_out = np.empty((FPA_ROWS, FPA_COLS), dtype=np.float32)
+    print('MI48 frames read over SPI, CRC policy "every":')
+    for name, func in [
+            ('read()', lambda: mi48.read()),
+            ('read_into(float32)', lambda: mi48.read_into(out)),
+            ('read_into(2D float32)', lambda: mi48.read_into(frame_out))]:
+        fps, cpu_ms = time_frames(func, args.n_frames)
+        print('{:24s} {:8.1f} us CPU/frame {:8.1f} kB peak'.format(
+              name, 1.e3 * cpu_ms, 1.e-3 * peak_alloc(func)))
+    assert not mi48.crc_error
+    assert np.allclose(mi48.read()[0], out, atol=0.1)
+    emulator.close()
+
+
+def bench_raw(args):
+    """The thermal stage of dualcamproc on Celsius vs. raw frames"""
+    logging.disable(logging.CRITICAL)
+    emulator = MI48Emulator().start()
+    mi48 = connect_emulator(emulator)
+    emulator.regs[regmap['FRAME_MODE']] = 0
+    mi48.capture_no_header = False
+    responses = [np.frombuffer(emulator.make_frame(), dtype=np.uint16)
+                 for i in range(25)]
+    par = {'blur_ks':3, 'd':5, 'sigmaColor': 27, 'sigmaSpace': 27}
+    hazard_temp = 40
+    masks, images = {}, {}
+    for read_raw in (False, True):
+        mi48.read_raw = read_raw
+        level = raw_threshold(hazard_temp) if read_raw else hazard_temp
+        i = iter(range(1 << 30))
+        def thermal_stage():
+            data, header = mi48.parse_response(responses[next(i) % 25])
+            frame = cv.flip(data_to_frame(data, (FPA_COLS, FPA_ROWS)), 0)
+            filt_uint8 = cv_filter(remap(frame), par, use_median=True,
+                                   use_bilat=True, use_nlm=False)
+            hazard = np.greater(frame, level).view(np.uint8)
+            contours, _ = cv.findContours(hazard, cv.RETR_EXTERNAL,
+                                          cv.CHAIN_APPROX_SIMPLE)
+            return frame, hazard, filt_uint8
+        frame, masks[read_raw], images[read_raw] = thermal_stage()
+        fps, cpu_ms = time_frames(thermal_stage, args.n_frames)
+        print('{:24s} {:8.3f} ms CPU/frame {:6d} bytes/frame'.format(
+              'raw' if read_raw else 'Celsius', cpu_ms, frame.nbytes))
+    print('hazard masks identical: {}'.format(
+          np.array_equal(masks[False], masks[True])))
+    # remap() stretches either to 0..255; they differ by rounding only
+    print('display images differ by at most {} levels'.format(
+          np.abs(images[False].astype(int) - images[True]).max()))
+    mi48.stop()
+    emulator.close()
+
+
+def bench_frame(args):
+    """read() with header dict vs. read_frame() into a FrameRing"""
+    logging.disable(logging.CRITICAL)
+    # as in bench_convert: the host side of SPI reads, without the device
+    emulator = MI48Emulator().start()
+    usb = USB_Interface(serial.Serial(emulator.device, timeout=0.5))
+    emulator.regs[regmap['FRAME_MODE']] = 0
+    frame = np.frombuffer(emulator.make_frame(), dtype=np.uint16)
+    spi = SPI_Interface(FakeSpiDev(frame.astype('>u2').tobytes(),
+                                   xfer3=True, reuse=True), 2520)
+    mi48 = MI48([usb, spi])
+    mi48.capture_no_header = False
+    k = args.window
+    # the consumer keeps the latest k frames and their frame counters,
+    # and averages them
+    history = collections.deque(maxlen=k)
+    def dicts():
+        data, header = mi48.read()
+        history.append((data_to_frame(data, (FPA_COLS, FPA_ROWS)),
+                        header))
+        counters = [h['frame_counter'] for f, h in history]
+        return np.mean([f for f, h in history], axis=0,
+                       dtype=np.float32), counters
+    for dtype in (np.float16, np.float32, np.uint16):
+        ring = FrameRing(k, mi48.fpa_shape, dtype)
+        def records():
+            mi48.read_frame(ring)
+            window = ring.window(k)
+            return (window['data'].mean(axis=0, dtype=np.float32),
+                    window['frame_counter'])
+        if dtype == np.float16:
+            mi48.read_raw = False
+            for func in (dicts, records):
+                for i in range(k):
+                    func()
+            avg, _ = records()
+            assert np.allclose(dicts()[0], avg, atol=0.1)
+            assert ring.latest()['frame_counter'] ==\
+                   history[-1][1]['frame_counter']
+            name = 'read() + dict, float16'
+            fps, cpu_ms = time_frames(dicts, args.n_frames)
+            print('{:28s} {:8.1f} us CPU/frame {:8.1f} kB peak'.format(
+                  name, 1.e3 * cpu_ms, 1.e-3 * peak_alloc(dicts)))
+        name = 'read_frame(), {}'.format(np.dtype(dtype).name)
+        fps, cpu_ms = time_frames(records, args.n_frames)
+        print('{:28s} {:8.1f} us CPU/frame {:8.1f} kB peak'.format(
+              name, 1.e3 * cpu_ms, 1.e-3 * peak_alloc(records)))
+    dtype = FrameRing(1, mi48.fpa_shape, np.float16).dtype
+    print('frame record: {} bytes for float16 data, of which {} header'.format(
+          dtype.itemsize, dtype.fields['data'][1]))
+    # reading alone, no consumer
+    ring = FrameRing(k, mi48.fpa_shape, np.float16)
+    for name, func in [
+            ('read() only', lambda: mi48.read()),
+            ('read_frame() only', lambda: mi48.read_frame(ring))]:
+        fps, cpu_ms = time_frames(func, args.n_frames)
+        print('{:28s} {:8.1f} us CPU/frame {:8.1f} kB peak'.format(
+              name, 1.e3 * cpu_ms, 1.e-3 * peak_alloc(func)))
+    emulator.close()
+
+
+def bench_live(args):
+    """Reconfiguring while streaming vs. a stop/configure/start cycle"""
+    logging.disable(logging.CRITICAL)
+    emulator = MI48Emulator(fps=args.fps, latency=1.e-3).start()
+    mi48 = connect_emulator(emulator)
+    background = not args.foreground
+    def start():
+        mi48.start(stream=True, with_header=True, background=background,
+                   queue_size=8, policy='drop_oldest')
+    def settings(k):
+        return dict(filter_1=85 + k, sens_factor=100 + k,
+                    filters={'f1': True})
+    def cycle(k):
+        mi48.stop_capture()
+        mi48.configure(**settings(k))
+        start()
+    def live(k):
+        mi48.configure(**settings(k))
+    print('Emulator at {} fps, {} reader, {} changes'.format(
+          args.fps, 'background' if background else 'foreground',
+          args.n_changes))
+    for name, change in [('stop/configure/start', cycle),
+                         ('configure() while streaming', live)]:
+        start()
+        for i in range(5):
+            mi48.read(timeout=1.0)
+        mi48.reset_stats()
+        t_change = []
+        for k in range(args.n_changes):
+            t0 = time.monotonic()
+            change(k)
+            t_change.append(time.monotonic() - t0)
+            for i in range(5):
+                mi48.read(timeout=1.0)
+        # the gap is between the arrival of consecutive frames
+        stats = mi48.get_stats()
+        print('{:28s} {:6.1f} ms per change {:6.1f} ms max frame gap '
+              '{:4d} frames missed'.format(name, 1.e3 * np.mean(t_change),
+              stats['interval_max_ms'], stats['missed']))
+        mi48.stop_capture()
+    assert mi48.get_sens_factor() == 100 + args.n_changes - 1
+    mi48.stop()
+    emulator.close()
+
+
+def bench_trigger(args):
+    """Streaming vs. triggered frames, for a loop fusing them at its pace"""
+    logging.disable(logging.CRITICAL)
+    period = 1.e-3 * args.period
+    print('Loop period {:.0f} ms, {} cycles'.format(args.period,
+                                                   args.n_cycles))
+    for name in ('stream 20 fps, read()', 'stream 20 fps, background',
+                 'triggered', 'triggered, pipelined'):
+        triggered = name.startswith('triggered')
+        # as dualcamproc does: request the next frame when done with this
+        # one, instead of at the sync point
+        pipelined = name.endswith('pipelined')
+        # streams at the set fps; a single frame comes one frame
+        # period after its request, as from the camera module
+        emulator = MI48Emulator(fps=None if triggered else 20.).start()
+        mi48 = connect_emulator(emulator)
+        mi48.set_fps(mi48.maxfps if triggered else 20)
+        mi48.start(stream=not triggered, with_header=True,
+                   background=name.endswith('background'))
+        decoder = mi48.interfaces[1].decoder
+        n_acks, n_frames = decoder.n_acks, emulator.n_frames
+        ages, offsets, waits = [], [], []
+        t_next = time.monotonic()
+        for i in range(args.n_cycles):
+            # the sync point: the NoIR frame is captured now
+            t_next += period
+            t0 = time.monotonic()
+            if triggered and i > 0 and not pipelined:
+                mi48.trigger()
+            data, header = mi48.read(timeout=1.0)
+            if pipelined:
+                mi48.trigger()
+            t1 = time.monotonic()
+            t_ms = int(1.e3 * t1) & 0xFFFFFFFF
+            ages.append((t_ms - header['timestamp']) & 0xFFFFFFFF)
+            # of the frame acquisition relative to the sync point
+            offsets.append(abs(header['timestamp'] - 1.e3 * t0))
+            waits.append(1.e3 * (t1 - t0))
+            # the rest of the loop: processing and waiting for the NoIR
+            time.sleep(max(0., t_next - time.monotonic()))
+        sent = emulator.n_frames - n_frames
+        decoded = decoder.n_acks - n_acks
+        mi48.stop()
+        emulator.close()
+        print('{:28s} age {:5.1f} ms, off sync {:5.1f} ms, read {:5.1f} ms;'
+              ' {:4d} frames sent, {:4d} acks decoded'.
+              format(name, np.median(ages), np.median(offsets),
+                     np.mean(waits), sent, decoded))
+
+
+def bench_governor(args):
+    """CPU and frames of an idle then busy scene, with and without governor"""
+    logging.disable(logging.CRITICAL)
+    par = {'blur_ks':3, 'd':5, 'sigmaColor': 27, 'sigmaSpace': 27}
+    level = raw_threshold(40)
+    # a still, lukewarm spot in the idle scene; the busy one has the
+    # moving hot spot of synthetic_frame
+    cold = synthetic_frame((FPA_COLS, FPA_ROWS), t_hot=25.)
+    tick = 0.05
+    print('Loop at {:.0f} Hz; idle scene for 2 + {} s, then a hand and a '
+          'hot spot for {} s'.format(1. / tick, args.idle, args.active))
+    print('{:22s} {:>14s} {:>16s} {:>14s} {:>16s} {:>10s}'.format(
+          '', 'idle frames/s', 'idle CPU ms/s', 'busy frames/s',
+          'busy CPU ms/s', 'reaction'))
+    for name in ('fixed 20 fps', 'governed, streaming',
+                 'governed, triggered'):
+        triggered = name.endswith('triggered')
+        emulator = MI48Emulator(frames=[cold]).start()
+        mi48 = connect_emulator(emulator)
+        mi48.read_raw = True
+        governor = None
+        if name.startswith('governed'):
+            governor = FrameRateGovernor(None if triggered else mi48,
+                                         fps_active=20, fps_idle=2,
+                                         idle_after=2.)
+        mi48.set_fps(mi48.maxfps if triggered else 20)
+        mi48.start(stream=not triggered, with_header=True,
+                   background=not triggered)
+        ring = FrameRing(4, mi48.fpa_shape, np.uint16)
+        results = []
+        reaction = None
+        # the governor goes idle after the first 2 s, not measured
+        for phase, duration in (('settle', 2.), ('idle', args.idle),
+                                ('busy', args.active)):
+            hand = phase == 'busy'
+            if hand:
+                emulator.frames = None
+            t_event = time.monotonic()
+            n_frames, c0 = 0, time.process_time()
+            t_next = t_event
+            while time.monotonic() - t_event < duration:
+                if governor is not None:
+                    governor.update(active=hand)
+                rec = None
+                if not triggered:
+                    rec = mi48.read_frame(ring, timeout=0)
+                elif governor is None or governor.due():
+                    mi48.trigger()
+                    rec = mi48.read_frame(ring, timeout=1.0)
+                if rec is not None:
+                    n_frames += 1
+                    if hand and reaction is None:
+                        reaction = time.monotonic() - t_event
+                    frame = cv.flip(rec['data'], 0)
+                    cv_filter(remap(frame), par, use_median=True,
+                              use_bilat=True, use_nlm=False)
+                    hazard = np.greater(frame, level).view(np.uint8)
+                    contours, _ = cv.findContours(hazard, cv.RETR_EXTERNAL,
+                                                  cv.CHAIN_APPROX_SIMPLE)
+                    if governor is not None:
+                        governor.update(float(rec['pixel_max']),
+                                        state=len(contours))
+                t_next += tick
+                time.sleep(max(0., t_next - time.monotonic()))
+            if phase != 'settle':
+                results += [n_frames / duration,
+                            1.e3 * (time.process_time() - c0) / duration]
+        mi48.stop()
+        emulator.close()
+        print('{:22s} {:14.1f} {:16.1f} {:14.1f} {:16.1f} {:7.0f} ms'.
+              format(name, *results, 1.e3 * reaction))
+    print('CPU includes the emulator thread, which also does less at a '
+          'lower frame rate')
+
+
+def bench_info(args):
+    """Reconnect time and compensation parameter reads, with and without
+    the compensation cache"""
+    logging.disable(logging.WARNING)
+    emulator = MI48Emulator(fps=25, latency=1.e-3 * args.latency).start()
+    params = [1.0, -0.25, 0.0125, 36.5]
+    cachedir = tempfile.mkdtemp()
+    cache = CompensationParamsCache(cachedir)
+
+    def connect(param_cache):
+        ser = serial.Serial(emulator.device, timeout=0.5)
+        usb = USB_Interface(ser)
+        return MI48([usb, usb], param_cache=param_cache)
+
+    mi48 = connect(None)
+    mi48.store_compensation_params(params, timeout=0.)
+    mi48.interfaces[0].port.close()
+    print('Emulated USB latency {} ms, {} reconnects'.format(args.latency,
+                                                            args.n_cycles))
+    print('{:28s} {:>10s} {:>10s} {:>9s}'.format('', 'connect', 'comp.par.',
+                                                 'commands'))
+    for name, param_cache, interval in [
+            ('no cache, byte by byte', None, args.interval),
+            ('no cache, bulk read', None, 0.),
+            ('cache', cache, 0.)]:
+        t_connect, t_params, n_commands = [], [], []
+        cycles = 1 if interval > 0 else args.n_cycles
+        for i in range(cycles):
+            n0 = emulator.n_commands
+            t0 = time.perf_counter()
+            mi48 = connect(param_cache)
+            t1 = time.perf_counter()
+            read = mi48.get_compensation_params(interval=interval)
+            t2 = time.perf_counter()
+            assert np.allclose(read, params, rtol=1.e-6), read
+            mi48.interfaces[0].port.close()
+            # the first connect fills the cache
+            if param_cache is None or i > 0:
+                t_connect.append(t1 - t0)
+                t_params.append(t2 - t1)
+                n_commands.append(emulator.n_commands - n0)
+        print('{:28s} {:7.1f} ms {:7.1f} ms {:9.0f}'.format(name,
+              1.e3 * np.median(t_connect), 1.e3 * np.median(t_params),
+              np.median(n_commands)))
+    emulator.close()
+    for f in os.listdir(cachedir):
+        os.remove(os.path.join(cachedir, f))
+    os.rmdir(cachedir)
+
+
+def bench_preprocess(args):
+    """Per-frame preprocessing: repeated remap() vs. ThermalPreprocessor"""
+    raw = [synthetic_frame((FPA_COLS, FPA_ROWS), i) for i in range(25)]
+    # 1-D, as from MI48.read(), and 2-D, as from MI48.read_frame()
+    celsius = [(r / 10. + KELVIN_0).astype(np.float16) for r in raw]
+    celsius_2d = [data_to_frame(c, (FPA_COLS, FPA_ROWS)) for c in celsius]
+    raw_2d = [data_to_frame(r, (FPA_COLS, FPA_ROWS)) for r in raw]
+    par = {'blur_ks':3, 'd':5, 'sigmaColor': 27, 'sigmaSpace': 27}
+    hand_temp = [23, 35]
+    hazard_temp = 40
+    dminav = RollingAverageFilter(N=10)
+    dmaxav = RollingAverageFilter(N=10)
+    i = iter(range(1 << 30))
+
+    # the per-frame code of stream_usb_v2.py
+    def stream_usb_v2():
+        data = celsius[next(i) % 25]
+        min_temp = dminav(data.min())
+        max_temp = dmaxav(data.max())
+        frame = data_to_frame(data, (FPA_COLS, FPA_ROWS), hflip=False)
+        filt_uint8 = cv_filter(remap(frame), par, use_median=True,
+                               use_bilat=True, use_nlm=False)
+        thresh_low = 0+(hand_temp[0]-min_temp)/(max_temp-min_temp)*(255-min_temp)
+        thresh_high = 0+(hand_temp[1]-min_temp)/(max_temp-min_temp)*(255-min_temp)
+        ret, lower = cv.threshold(remap(frame), thresh_low, 255,
+                                  cv.THRESH_BINARY)
+        ret, upper = cv.threshold(remap(frame), thresh_high, 255,
+                                  cv.THRESH_BINARY_INV)
+        hand = np.logical_and(lower, upper).astype(np.uint8)
+        thresh = 0+(hazard_temp-min_temp)/(max_temp-min_temp)*(255-min_temp)
+        ret, hazard = cv.threshold(remap(frame), thresh, 255,
+                                   cv.THRESH_BINARY)
+        return filt_uint8, hand, hazard
+
+    # the thermal stage of dualcamproc, as of read_frame()
+    def dualcamproc(frames, level):
+        data = frames[next(i) % 25]
+        frame = cv.flip(data, 0)
+        filt_uint8 = cv_filter(remap(frame), par, use_median=True,
+                               use_bilat=True, use_nlm=False)
+        hazard = np.greater(frame, level).view(np.uint8)
+        return filt_uint8, hazard
+
+    thresholds = {'hand': hand_temp, 'hazard': hazard_temp}
+    pre = ThermalPreprocessor((FPA_COLS, FPA_ROWS), thresholds=thresholds,
+                              filter_parameters=par)
+    pre_flip = ThermalPreprocessor((FPA_COLS, FPA_ROWS), flip=0,
+                                   thresholds=thresholds,
+                                   filter_parameters=par)
+    pre_raw = ThermalPreprocessor((FPA_COLS, FPA_ROWS), flip=0,
+                                  thresholds=thresholds, raw=True,
+                                  filter_parameters=par)
+    print('{:40s} {:>14s} {:>12s}'.format('', 'CPU/frame', 'peak'))
+    for name, func in [
+            ('stream_usb_v2, 1-D Celsius', stream_usb_v2),
+            ('preprocessor, 1-D Celsius',
+             lambda: pre(celsius[next(i) % 25])),
+            ('dualcamproc, 2-D Celsius',
+             lambda: dualcamproc(celsius_2d, hazard_temp)),
+            ('preprocessor, 2-D Celsius, flipped',
+             lambda: pre_flip(celsius_2d[next(i) % 25])),
+            ('dualcamproc, 2-D raw',
+             lambda: dualcamproc(raw_2d, raw_threshold(hazard_temp))),
+            ('preprocessor, 2-D raw, flipped',
+             lambda: pre_raw(raw_2d[next(i) % 25]))]:
+        fps, cpu_ms = time_frames(func, args.n_frames)
+        print('{:40s} {:11.1f} us {:9.1f} kB'.format(
+              name, 1.e3 * cpu_ms, 1.e-3 * peak_alloc(func)))
+    # same result, up to the rounding of the remap
+    filt_uint8, hazard = dualcamproc(raw_2d[:1] * 25,
+                                     raw_threshold(hazard_temp))
+    pre_raw(raw_2d[0])
+    print('filtered image within {} grey level(s), hazard masks {}'.format(
+          np.abs(filt_uint8.astype(int) - pre_raw.filtered).max(),
+          'identical' if np.array_equal(hazard > 0, pre_raw.masks['hazard'] > 0)
+          else 'DIFFERENT'))
+
+
+def thermal_scenes(n, seed=0, busy=True):
+    """
+    Return `n` random scenes (rows, cols) in Celsius: smooth noise from
+    15 to 75 Celsius if `busy`, else a room at 22 Celsius with a few warm
+    to scalding blobs in it
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[:FPA_ROWS, :FPA_COLS]
+    scenes = []
+    for i in range(n):
+        if busy:
+            scene = cv.GaussianBlur(rng.random((FPA_ROWS, FPA_COLS),
+                                               dtype=np.float32), (0, 0), 2)
+            scene = 15. + 60. * (scene - scene.min()) / np.ptp(scene)
+        else:
+            scene = rng.normal(22., 0.3, (FPA_ROWS, FPA_COLS))
+            for j in range(rng.integers(1, 4)):
+                cx, cy = rng.uniform(0, FPA_COLS), rng.uniform(0, FPA_ROWS)
+                sigma = rng.uniform(2., 6.)
+                scene += rng.uniform(8., 50.) * np.exp(
+                    -((x - cx)**2 + (y - cy)**2) / (2 * sigma**2))
+        scenes.append(scene.astype(np.float32))
+    return scenes
+
+
+def bench_classify(args):
+    """Temperature classes: a threshold pass per class vs. ThermalClassifier"""
+    bands = {'hand': (23, 35), 'warm': (35, 45), 'hot': (45, 60),
+             'scalding': 60}
+    dminav = RollingAverageFilter(N=10)
+    dmaxav = RollingAverageFilter(N=10)
+    i = iter(range(1 << 30))
+
+    def formula(t, min_temp, max_temp):
+        # the uint8 threshold of stream_usb_v2.py
+        return 0+(t-min_temp)/(max_temp-min_temp)*(255-min_temp)
+
+    # stream_usb_v2.py: remap and threshold per band, then contours
+    def per_class_remap(celsius, names):
+        data = celsius[next(i) % 25]
+        min_temp = dminav(data.min())
+        max_temp = dmaxav(data.max())
+        frame = data_to_frame(data, (FPA_COLS, FPA_ROWS))
+        out = {}
+        for name in names:
+            t = bands[name]
+            t0, t1 = t if isinstance(t, tuple) else (t, None)
+            ret, mask = cv.threshold(remap(frame),
+                                     formula(t0, min_temp, max_temp), 255,
+                                     cv.THRESH_BINARY)
+            if t1 is not None:
+                ret, upper = cv.threshold(remap(frame),
+                                          formula(t1, min_temp, max_temp),
+                                          255, cv.THRESH_BINARY_INV)
+                mask = np.logical_and(mask, upper).astype(np.uint8)
+            out[name], ret = cv.findContours(mask, cv.RETR_EXTERNAL,
+                                             cv.CHAIN_APPROX_SIMPLE)
+        return out
+
+    # correct, but still a pass per band, on the Celsius frame
+    def per_class_celsius(celsius, names):
+        frame = data_to_frame(celsius[next(i) % 25], (FPA_COLS, FPA_ROWS))
+        out = {}
+        for name in names:
+            t = bands[name]
+            t0, t1 = t if isinstance(t, tuple) else (t, np.inf)
+            mask = np.logical_and(frame > t0, frame <= t1).view(np.uint8)
+            out[name], ret = cv.findContours(mask, cv.RETR_EXTERNAL,
+                                             cv.CHAIN_APPROX_SIMPLE)
+        return out
+
+    def make_classifier(celsius, names):
+        cl = ThermalClassifier({n: bands[n] for n in names},
+                               (FPA_COLS, FPA_ROWS))
+        return lambda: cl(celsius[next(i) % 25])
+
+    # 1-D float16 Celsius, as from MI48.read()
+    busy = [s.astype(np.float16).ravel() for s in thermal_scenes(25)]
+    sparse = [s.astype(np.float16).ravel()
+              for s in thermal_scenes(25, busy=False)]
+    cases = [(busy, ('hand', 'scalding')), (busy, tuple(bands)),
+             (sparse, ('hand', 'scalding')), (sparse, tuple(bands))]
+    print('CPU per frame; busy scenes have ~80 regions per frame, sparse '
+          '~5')
+    print('{:36s} {:>9s} {:>9s} {:>9s} {:>9s}'.format(
+          '', 'busy 2', 'busy 4', 'sparse 2', 'sparse 4'))
+    for name, make in [
+            ('threshold per class on remap()',
+             lambda c, names: lambda: per_class_remap(c, names)),
+            ('threshold per class on Celsius',
+             lambda c, names: lambda: per_class_celsius(c, names)),
+            ('classifier, one label image + CC', make_classifier)]:
+        results = []
+        for celsius, names in cases:
+            fps, cpu_ms = time_frames(make(celsius, names), args.n_frames)
+            results.append(1.e3 * cpu_ms)
+        print('{:36s} {:6.1f} us {:6.1f} us {:6.1f} us {:6.1f} us'.format(
+              name, *results))
+
+    # pixels put in the wrong class by the uint8 thresholds
+    classifier = ThermalClassifier(bands, (FPA_COLS, FPA_ROWS))
+    wrong = {name: 0 for name in bands}
+    total = {name: 0 for name in bands}
+    for data in busy + sparse:
+        labels = classifier.classify(data)
+        frame = data_to_frame(data, (FPA_COLS, FPA_ROWS))
+        image = remap(frame)
+        lo, hi = float(frame.min()), float(frame.max())
+        for label, (name, t) in enumerate(bands.items(), 1):
+            t0, t1 = t if isinstance(t, tuple) else (t, None)
+            mask = image > formula(t0, lo, hi)
+            if t1 is not None:
+                mask &= image <= formula(t1, lo, hi)
+            wrong[name] += np.count_nonzero(mask != (labels == label))
+            total[name] += np.count_nonzero(labels == label)
+    print('pixels misclassified by the uint8 thresholds (of in class):')
+    for name in bands:
+        print('  {:12s} {:8d} of {:8d}'.format(name, wrong[name],
+                                               total[name]))
+
+
+def bench_render(args):
+    """Colormap and resize for display: cv_render() vs. ThermalRenderer"""
+    pre = ThermalPreprocessor((FPA_COLS, FPA_ROWS), flip=0)
+    images = [pre(s).copy() for s in thermal_scenes(25)]
+    i = iter(range(1 << 30))
+
+    def uncached(**kwargs):
+        # as before the colormaps were cached
+        _colormap_luts.clear()
+        return cv_render(images[next(i) % 25], display=False, **kwargs)
+
+    def make(**kwargs):
+        renderer = ThermalRenderer(**kwargs)
+        return lambda: renderer.render(images[next(i) % 25])
+
+    print('{:44s} {:>12s} {:>12s}'.format('', 'CPU/frame', 'peak'))
+    for name, func in [
+            ('cv_render, jet, uncached',
+             lambda: uncached(colormap='jet')),
+            ('cv_render, jet',
+             lambda: cv_render(images[next(i) % 25], colormap='jet',
+                               display=False)),
+            ('renderer, jet', make(colormap='jet')),
+            ('cv_render, rainbow2, 16 colors, uncached',
+             lambda: uncached(colormap='rainbow2', n_colors=16)),
+            ('cv_render, rainbow2, 16 colors',
+             lambda: cv_render(images[next(i) % 25], colormap='rainbow2',
+                               n_colors=16, display=False)),
+            ('renderer, rainbow2, 16 colors', make(n_colors=16)),
+            ('cv_render, rainbow2',
+             lambda: cv_render(images[next(i) % 25], colormap='rainbow2',
+                               display=False)),
+            ('renderer, rainbow2', make()),
+            ('renderer, rainbow2, x10 nearest',
+             make(resize=10, interpolation=cv.INTER_NEAREST)),
+            ('renderer, rainbow2, x10 area',
+             make(resize=10, interpolation=cv.INTER_AREA)),
+            ('renderer, rainbow2, x4 nearest',
+             make(resize=4, interpolation=cv.INTER_NEAREST)),
+            ('renderer, rainbow2, not resized', make(resize=None))]:
+        fps, cpu_ms = time_frames(func, args.n_frames)
+        print('{:44s} {:9.1f} us {:9.1f} kB'.format(
+              name, 1.e3 * cpu_ms, 1.e-3 * peak_alloc(func)))
+    # same images as cv_render
+    renderer = ThermalRenderer('rainbow2', n_colors=16)
+    same = all(np.array_equal(renderer.render(image),
+                              cv_render(image, colormap='rainbow2',
+                                        n_colors=16, display=False))
+               for image in images)
+    nearest = ThermalRenderer(resize=10, interpolation=cv.INTER_NEAREST)
+    area = ThermalRenderer(resize=10, interpolation=cv.INTER_AREA)
+    print('renderer {} cv_render; x10 nearest and area {}'.format(
+          'identical to' if same else 'DIFFERENT from',
+          'identical' if all(np.array_equal(nearest.render(image),
+                                            area.render(image))
+                             for image in images) else 'different'))
+
+
+def thermal_sequence(n, seed=0, noise=0.5, spikes=0.002):
+    """
+    Return (clean, noisy): `n` consecutive frames (rows, cols) in Celsius
+    of a room at 22 Celsius, with a warm hand and two hot objects slowly
+    moving about; the noisy frames add white noise of `noise` Celsius rms
+    and a fraction `spikes` of pixels off by +/-10 Celsius
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[:FPA_ROWS, :FPA_COLS].astype(np.float32)
+    room = 22. + 1.5 * y / FPA_ROWS
+    # temperature, sigma [px], start (x, y), velocity (x, y) [px/frame]
+    objects = [(33., 5., (20., 40.), (0.15, -0.05)),
+               (70., 2.5, (50., 20.), (-0.1, 0.08)),
+               (55., 1.5, (65., 45.), (0.05, 0.12))]
+    clean, noisy = [], []
+    for i in range(n):
+        frame = room.copy()
+        for temp, sigma, (x0, y0), (vx, vy) in objects:
+            # bounce off the edges of the field of view
+            cx = FPA_COLS - abs(FPA_COLS - (x0 + vx * i) % (2 * FPA_COLS))
+            cy = FPA_ROWS - abs(FPA_ROWS - (y0 + vy * i) % (2 * FPA_ROWS))
+            blob = (temp - 22.) * np.exp(-((x - cx)**2 + (y - cy)**2) /
+                                          (2 * sigma**2))
+            np.maximum(frame, 22. + blob, out=frame)
+        clean.append(frame)
+        frame = frame + rng.normal(0., noise, frame.shape).astype(np.float32)
+        hit = rng.random(frame.shape) < spikes
+        frame[hit] += rng.choice([-10., 10.], np.count_nonzero(hit))
+        noisy.append(frame)
+    return clean, noisy
+
+
+def bench_filter(args):
+    """Cost and hazard detection of cv_filter() and cheaper filters"""
+    if args.recording:
+        rec = Recording(args.recording)
+        n = min(len(rec), args.n_frames)
+        noisy = list(rec.celsius(slice(0, n)))
+        # no ground truth: take a centred running mean of 11 frames
+        cumsum = np.cumsum(np.stack(noisy), axis=0, dtype=np.float64)
+        cumsum = np.concatenate([np.zeros((1,) + cumsum.shape[1:]), cumsum])
+        truth = [(cumsum[min(i + 6, n)] - cumsum[max(i - 5, 0)]) /
+                 (min(i + 6, n) - max(i - 5, 0)) for i in range(n)]
+        print('{}: {} frames; reference: centred mean of 11 frames'.format(
+              args.recording, n))
+    else:
+        truth, noisy = thermal_sequence(args.n_frames, noise=args.noise)
+        print('synthetic: {} frames, {} C rms noise, 0.2% spikes'.format(
+              args.n_frames, args.noise))
+    hazard = args.hazard
+    truth = [t > hazard for t in truth]
+    # the pipelines: remap() to uint8, then the filter; temporal averages
+    # are taken in Celsius, before the remap
+    par = {'blur_ks':3, 'd':5, 'sigmaColor': 27, 'sigmaSpace': 27}
+
+    # each returns the filtered image, and the frame that was remapped
+    def spatial(filt):
+        return lambda i: (filt(remap(noisy[i])), noisy[i])
+
+    def temporal(make, filt=None):
+        state = {}
+        def run(i):
+            if i == 0:
+                state['av'] = make()
+            av = state['av'](noisy[i])
+            image = remap(av)
+            return (image if filt is None else filt(image)), av
+        return run
+
+    configs = [
+        ('none', spatial(lambda im: im)),
+        ('median 3', spatial(lambda im: cv.medianBlur(im, 3))),
+        ('median 5', spatial(lambda im: cv.medianBlur(im, 5))),
+        ('box 3', spatial(lambda im: cv.blur(im, (3, 3)))),
+        ('gaussian 3', spatial(lambda im: cv.GaussianBlur(im, (3, 3), 0))),
+        ('bilateral', spatial(lambda im: cv_filter(im, par, use_median=False,
+                                                   use_bilat=True))),
+        ('median 3 + bilateral (pipelines)',
+         spatial(lambda im: cv_filter(im, par, use_median=True,
+                                      use_bilat=True))),
+        # the NLM stage of cv_filter(), less its timing printout
+        ('median 3 + bilateral + NLM',
+         spatial(lambda im: cv.fastNlMeansDenoising(
+             cv_filter(im, par, use_median=True, use_bilat=True), None,
+             h=5, templateWindowSize=5, searchWindowSize=11))),
+        ('average of 4 frames', temporal(lambda: TrueAverageFilter(4))),
+        ('average of 4 frames + median 3',
+         temporal(lambda: TrueAverageFilter(4),
+                  lambda im: cv.medianBlur(im, 3))),
+        ('exponential average, N=4',
+         temporal(lambda: RollingAverageFilter(N=4))),
+        ('exponential average, N=4 + median 3',
+         temporal(lambda: RollingAverageFilter(N=4),
+                  lambda im: cv.medianBlur(im, 3))),
+    ]
+
+    def iou(a, b):
+        union = np.count_nonzero(a | b)
+        return np.count_nonzero(a & b) / union if union else 1.
+
+    def stats(masks):
+        """Mean contours per frame and frame-to-frame IoU of the masks"""
+        n_contours = [len(cv.findContours(m.view(np.uint8), cv.RETR_EXTERNAL,
+                                          cv.CHAIN_APPROX_SIMPLE)[0])
+                      for m in masks]
+        return (np.mean(n_contours),
+                np.mean([iou(a, b) for a, b in zip(masks[:-1], masks[1:])]))
+
+    n = len(noisy)
+    truth_contours, truth_stability = stats(truth)
+    print('hazard above {} C: {:.1f} regions/frame, frame-to-frame IoU '
+          '{:.3f}'.format(hazard, truth_contours, truth_stability))
+    print('{:36s} {:>9s} {:>7s} {:>7s} {:>7s} {:>8s} {:>6s}'.format(
+          '', 'CPU/frame', 'recall', 'precis.', 'objects', 'regions',
+          'IoU'))
+    for name, run in configs:
+        # including the remap() to uint8, i.e. 'none' is the remap alone
+        t0 = time.process_time()
+        filtered = [run(i) for i in range(n)]
+        cpu = (time.process_time() - t0) / n
+        # the hazard temperature on the scale of the remap
+        masks = [image > (hazard - f.min()) / (f.max() - f.min()) * 255
+                 for image, f in filtered]
+        tp = sum(np.count_nonzero(m & t) for m, t in zip(masks, truth))
+        recall = tp / max(sum(np.count_nonzero(t) for t in truth), 1)
+        precision = tp / max(sum(np.count_nonzero(m) for m in masks), 1)
+        # hazard objects of which no pixel is detected
+        found = total = 0
+        for m, t in zip(masks, truth):
+            nlabels, labels = cv.connectedComponents(t.view(np.uint8))
+            hit = np.bincount(labels[m], minlength=nlabels)[1:] > 0
+            found += np.count_nonzero(hit)
+            total += nlabels - 1
+        n_contours, stability = stats(masks)
+        print('{:36s} {:6.1f} us {:7.3f} {:7.3f} {:7.3f} {:8.1f} {:6.3f}'.
+              format(name, 1.e6 * cpu, recall, precision,
+                     found / max(total, 1), n_contours, stability))
+    print('recall and precision are of the hazard pixels, objects the '
+          'fraction of hazard regions detected at all, regions the number '
+          'of contours per frame and IoU that of the masks of consecutive '
+          'frames')
+
+
+def bench_average(args):
+    """TrueAverageFilter: sum of the whole buffer vs. running sum"""
+    frames = thermal_sequence(64)[1]
+    i = iter(range(1 << 30))
+
+    # TrueAverageFilter.update() as it was, summing the buffer every frame
+    class SumAverageFilter:
+        def __init__(self, depth):
+            self.depth = depth
+            self.buf = np.zeros(shape=(depth, FPA_ROWS, FPA_COLS))
+            self.counter = 0
+            self.ix = 0
+
+        def __call__(self, new):
+            if self.counter < self.depth: self.counter += 1
+            self.buf[self.ix] = new
+            av = np.sum(self.buf, axis=0)
+            av = av / self.counter
+            self.ix += 1
+            if self.ix > self.depth - 1: self.ix = 0
+            return av
+
+    print('{:8s} {:>22s} {:>22s} {:>12s}'.format(
+          'depth', 'sum of buffer', 'running sum', 'max error'))
+    for depth in (4, 16, 64, 256):
+        results = []
+        for make in (SumAverageFilter, TrueAverageFilter):
+            av = make(depth)
+            func = lambda: av(frames[next(i) % 64])
+            fps, cpu_ms = time_frames(func, args.n_frames)
+            results += [1.e3 * cpu_ms, 1.e-3 * peak_alloc(func)]
+        # against the mean of the last `depth` frames, in float64
+        av = TrueAverageFilter(depth)
+        for j in range(args.n_frames):
+            out = av(frames[j % 64])
+        last = [frames[j % 64] for j in range(args.n_frames - depth,
+                                               args.n_frames)]
+        error = np.abs(out - np.mean(last, axis=0, dtype=np.float64)).max()
+        print('{:<8d} {:8.1f} us {:7.1f} kB {:8.1f} us {:7.1f} kB '
+              '{:9.1e} C'.format(depth, *results, error))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='benchmark', required=True)
+    p = sub.add_parser('parser', help='USB acknowledge parser')
+    p.add_argument('-n', '--n-frames', type=int, default=1000)
+    p.set_defaults(func=bench_parser)
+    p = sub.add_parser('decoder', help='USB stream decoder on damaged data')
+    p.add_argument('-n', '--n-frames', type=int, default=1000)
+    p.set_defaults(func=bench_decoder)
+    p = sub.add_parser('config', help='pipelined register configuration')
+    p.add_argument('--latency', type=float, default=1.0,
+                   help='emulated acknowledge latency in ms')
+    p.set_defaults(func=bench_config)
+    p = sub.add_parser('restart', help='boot, stop and restart times')
+    p.add_argument('-n', '--n-cycles', type=int, default=10)
+    p.add_argument('--boot-time', type=float, default=30.0,
+                   help='emulated boot time in ms')
+    p.set_defaults(func=bench_restart)
+    p = sub.add_parser('spi', help='SPI frame read from a fake spidev')
+    p.add_argument('-n', '--n-frames', type=int, default=500)
+    p.add_argument('--xfer-size', type=int, default=2520,
+                   help='bytes per SPI transfer')
+    p.set_defaults(func=bench_spi)
+    p = sub.add_parser('array', help='several cameras read by SenxorArray')
+    p.add_argument('-n', '--n-batches', type=int, default=100)
+    p.add_argument('--cameras', type=int, default=3)
+    p.add_argument('--fps', type=float, default=25.)
+    p.set_defaults(func=bench_array)
+    p = sub.add_parser('stream', help='throughput and latency at high fps')
+    p.add_argument('-t', '--duration', type=float, default=5.)
+    p.add_argument('--fps', type=float, default=200.)
+    p.add_argument('--faults', type=float, default=0.,
+                   help='probability of checksum error and of truncation '
+                        'per frame; delays are 10x less likely')
+    p.add_argument('--queue-size', type=int, default=8)
+    p.set_defaults(func=bench_stream)
+    p = sub.add_parser('record', help='recording and replay vs. CSV')
+    p.add_argument('-n', '--n-frames', type=int, default=50000)
+    p.add_argument('--dir', default=None,
+                   help='where to write the temporary files')
+    p.set_defaults(func=bench_record)
+    p = sub.add_parser('crc', help='frame CRC engines and policies')
+    p.add_argument('-n', '--n-frames', type=int, default=2000)
+    p.set_defaults(func=bench_crc)
+    p = sub.add_parser('convert', help='Celsius conversion and read_into')
+    p.add_argument('-n', '--n-frames', type=int, default=2000)
+    p.set_defaults(func=bench_convert)
+    p = sub.add_parser('raw', help='thermal stage on Celsius vs raw frames')
+    p.add_argument('-n', '--n-frames', type=int, default=2000)
+    p.set_defaults(func=bench_raw)
+    p = sub.add_parser('frame', help='read() vs. read_frame() into a ring')
+    p.add_argument('-n', '--n-frames', type=int, default=2000)
+    p.add_argument('--window', type=int, default=8,
+                   help='number of latest frames kept by the consumer')
+    p.set_defaults(func=bench_frame)
+    p = sub.add_parser('live', help='reconfiguring while streaming')
+    p.add_argument('-n', '--n-changes', type=int, default=10)
+    p.add_argument('--fps', type=float, default=25.)
+    p.add_argument('--foreground', action='store_true',
+                   help='read frames without the background reader')
+    p.set_defaults(func=bench_live)
+    p = sub.add_parser('trigger', help='streaming vs. triggered frames')
+    p.add_argument('-n', '--n-cycles', type=int, default=30)
+    p.add_argument('--period', type=float, default=100.,
+                   help='period of the fusion loop in ms')
+    p.set_defaults(func=bench_trigger)
+    p = sub.add_parser('governor', help='activity-adaptive frame rate')
+    p.add_argument('--idle', type=float, default=10.,
+                   help='seconds of an idle scene')
+    p.add_argument('--active', type=float, default=3.,
+                   help='seconds of a busy scene after the idle one')
+    p.set_defaults(func=bench_governor)
+    p = sub.add_parser('info', help='camera info and compensation params cache')
+    p.add_argument('-n', '--n-cycles', type=int, default=10)
+    p.add_argument('--latency', type=float, default=1.,
+                   help='emulated USB round trip in ms')
+    p.add_argument('--interval', type=float, default=1.,
+                   help='pause between bytes of the byte by byte read, in s')
+    p.set_defaults(func=bench_info)
+    p = sub.add_parser('preprocess', help='remap() calls vs. ThermalPreprocessor')
+    p.add_argument('-n', '--n-frames', type=int, default=2000)
+    p.set_defaults(func=bench_preprocess)
+    p = sub.add_parser('classify', help='temperature classes and regions')
+    p.add_argument('-n', '--n-frames', type=int, default=2000)
+    p.set_defaults(func=bench_classify)
+    p = sub.add_parser('render', help='colormap and resize for display')
+    p.add_argument('-n', '--n-frames', type=int, default=1000)
+    p.set_defaults(func=bench_render)
+    p = sub.add_parser('filter', help='cost and hazard detection of filters')
+    p.add_argument('-n', '--n-frames', type=int, default=500)
+    p.add_argument('--noise', type=float, default=0.5,
+                   help='rms pixel noise of the synthetic frames [C]')
+    p.add_argument('--hazard', type=float, default=40.,
+                   help='hazard temperature [C]')
+    p.add_argument('--recording', default=None,
+                   help='run on a recording (.sxr) instead')
+    p.set_defaults(func=bench_filter)
+    p = sub.add_parser('average', help='TrueAverageFilter cost vs. depth')
+    p.add_argument('-n', '--n-frames', type=int, default=2000)
+    p.set_defaults(func=bench_average)
+    args = parser.parse_args()
+    args.func(args)
@@ -7,13 +7,13 @@ import serial
 import numpy as np
 from picamera2 import Picamera2
 import multiprocessing
+import queue
 import cv2 as cv
 import mediapipe as mp
 
-from senxor.mi48 import MI48, format_header, format_framestats
-from senxor.utils import data_to_frame, remap, cv_filter,\
-                         cv_render, RollingAverageFilter,\
-                         connect_senxor
+from senxor.mi48 import FrameRing, format_stats
+from senxor.utils import connect_senxor, FrameRateGovernor,\
+                         ThermalPreprocessor, ThermalRenderer
 
 # for ble connection
 import asyncio
@@ -42,6 +42,28 @@ par = {'blur_ks':3, 'd':5, 'sigmaColor': 27, 'sigmaSpace': 27}
 # threshold temperature degrees celsius
 hazard_temp = 40
 
+# process the thermal frames as raw integers (deci-Kelvin) rather than
+# Celsius; thresholds are converted to raw units once, by the
+# ThermalPreprocessor
+RAW_MODE = True
+
+# request one thermal frame per NoIR capture (GET_SINGLE_FRAME) instead
+# of streaming at 20 fps and reading whichever frame is queued
+TRIGGERED = True
+
+# drop the thermal frame rate to FPS_IDLE after IDLE_AFTER seconds
+# without hands in view, hazard changes or fast temperature changes
+GOVERNOR = True
+FPS_IDLE = 2
+IDLE_AFTER = 5.0
+
+# seconds between checks of the ready flags, rather than spinning a core
+SYNC_POLL = 1.e-3
+
+# print the acquisition statistics of the thermal camera every so many
+# frames (achieved fps, missed frames, CRC errors); 0 to disable
+STATS_PERIOD = 250
+
 # scaling factor from pixels to cm
 scale_factor = 1.08
 
@@ -52,8 +74,6 @@ thermal_frame_y = 62
 max_hazards = 9
 max_hands = 1
 
-dminav = RollingAverageFilter(N=10)
-dmaxav = RollingAverageFilter(N=10)
 
 # Shared process data
 lock = multiprocessing.Lock()
@@ -63,6 +83,9 @@ thermal_ready = multiprocessing.Value('i', 0, lock=lock)
 manager = multiprocessing.Manager()
 hand_data = manager.list([0]*(max_hands + 1))
 thermal_data = manager.list([0]*(max_hazards + 1))
+# thermal camera settings to change while streaming, as dicts of the
+# arguments of MI48.configure(), e.g. {'fps': 15, 'filter_1': 50}
+thermal_settings = multiprocessing.Queue()
 
 async def find_esp32():
     # Scan for BLE devices and return the address of ESP32. 
@@ -117,6 +140,8 @@ def noircapture(noir_ready, thermal_ready, data):
             # print("checking if ready in noir")
             while not local_ready:
                 local_ready = (noir_ready.value == 1) and (thermal_ready.value == 1)
+                if not local_ready:
+                    time.sleep(SYNC_POLL)
 
             # print(f"noir capture time: {time.time()}")
             # capture next frame as 3D numpy array
@@ -157,28 +182,65 @@ def noircapture(noir_ready, thermal_ready, data):
     picam2.stop()
 
 
-def thermalcapture(noir_ready, thermal_ready, hazard_data):
+def thermalcapture(noir_ready, thermal_ready, hazard_data, settings=None):
     # Make an instance of the MI48, attaching USB for 
     # both control and data interface.
-    mi48, connected_port, port_names = connect_senxor()
-
-    # set desired FPS
-    mi48.set_fps(20)
-
-    # see if filtering is available in MI48 and set it up
-    mi48.disable_filter(f1=True, f2=True, f3=True)
-    mi48.set_filter_1(85)
-    mi48.enable_filter(f1=True, f2=False, f3=False, f3_ks_5=False)
-    mi48.set_offset_corr(0.0)
-
-    mi48.set_sens_factor(100)
+    mi48, connected_port, port_names = connect_senxor(read_raw=RAW_MODE,
+                                                      param_cache=True)
+
+    # send the register writes below with pipelined commands
+    with mi48.batch():
+        # set desired FPS; when triggered, the fastest frame rate gives
+        # the shortest wait for a requested frame
+        mi48.set_fps(mi48.maxfps if TRIGGERED else 20)
+
+        # see if filtering is available in MI48 and set it up
+        mi48.disable_filter(f1=True, f2=True, f3=True)
+        mi48.set_filter_1(85)
+        mi48.enable_filter(f1=True, f2=False, f3=False, f3_ks_5=False)
+        mi48.set_offset_corr(0.0)
+
+        mi48.set_sens_factor(100)
     mi48.get_sens_factor()
 
-    # initiate continuous frame acquisition
+    # frames are read in place into a ring of preallocated records
+    ring = FrameRing(8, mi48.fpa_shape,
+                     dtype=np.uint16 if RAW_MODE else np.float16)
+    # flip, remap, filter and hazard mask, once per frame, in place
+    preprocess = ThermalPreprocessor(mi48.fpa_shape, flip=0,
+                                     thresholds={'hazard': hazard_temp},
+                                     raw=RAW_MODE, filter_parameters=par)
+    # colormap LUT and display buffers, made once
+    render = ThermalRenderer('rainbow2')
     with_header = True
-    mi48.start(stream=True, with_header=with_header)
-
-
+    if TRIGGERED:
+        # requests a first frame; it is too old to be of use by the time
+        # the NoIR camera is ready
+        mi48.start(stream=False, with_header=with_header)
+        mi48.read_frame(ring)
+    else:
+        # initiate continuous frame acquisition
+        mi48.start(stream=True, with_header=with_header, background=True)
+    # when triggered, the governor paces the requests instead of set_fps
+    governor = None
+    if GOVERNOR:
+        governor = FrameRateGovernor(None if TRIGGERED else mi48,
+                                     fps_active=20, fps_idle=FPS_IDLE,
+                                     idle_after=IDLE_AFTER)
+
+    def request_next():
+        """Request the thermal frame for the next NoIR frame, if wanted"""
+        if not TRIGGERED:
+            return False
+        if governor is not None and governor.idle and not governor.due():
+            return False
+        mi48.trigger()
+        return True
+
+    # a triggered frame is requested at the end of each iteration, before
+    # the NoIR frame it goes with is captured, so that it is on its way by
+    # the time it is read, instead of a round trip later
+    requested = request_next()
     while True:
         try:
             # THERMAL STUFF
@@ -188,27 +250,49 @@ def thermalcapture(noir_ready, thermal_ready, hazard_data):
             # print("checking if ready in thermal")
             while not local_ready:
                 local_ready = (noir_ready.value == 1) and (thermal_ready.value == 1)
+                if not local_ready:
+                    time.sleep(SYNC_POLL)
 
             # print(f"thermal capture time: {time.time()}")
 
-            data, header = mi48.read()
+            # apply new settings without stopping the stream
+            while settings is not None:
+                try:
+                    mi48.configure(**settings.get_nowait())
+                except queue.Empty:
+                    break
 
-            if data is None:
+            # a hand in view (as of the last NoIR frame) means full rate
+            if governor is not None:
+                governor.update(active=hand_data[0] > 0)
+            idle = governor is not None and governor.idle
+
+            # the NoIR frame is being captured now; the thermal frame to go
+            # with it was requested when the last one was done with
+            if TRIGGERED:
+                rec = mi48.read_frame(ring) if requested else None
+                requested = False
+            else:
+                # at the idle rate, go on without a new frame, not wait
+                rec = mi48.read_frame(ring, timeout=0 if idle else None)
+
+            if rec is None and idle:
+                # nothing new to see; the hazards stay as they are
+                requested = request_next()
+                thermal_ready.value = 0
+                continue
+
+            if rec is None:
                 # logger.critical('NONE data received instead of GFRA')
                 print("NO DATA FROM THERMAL CAMERA")
                 mi48.stop()
 
             #regular image
-            min_temp = dminav(data.min())  # + 1.5
-            max_temp = dmaxav(data.max())  # - 1.5
-            frame = cv.flip(data_to_frame(data, (thermal_frame_x,thermal_frame_y), hflip=False),0)
-            # frame2 = np.clip(frame, min_temp, max_temp)
-            filt_uint8 = cv_filter(remap(frame), par, use_median=True,
-                                use_bilat=True, use_nlm=False)
+            filt_uint8 = preprocess(rec['data'])
             
             # #hazard
-            thresh = (hazard_temp-min_temp)/(max_temp-min_temp)*(255-min_temp)
-            ret, thresh_image_hazard = cv.threshold(remap(frame), thresh, 255, cv.THRESH_BINARY)
+            # threshold in temperature units, not on the remapped image
+            thresh_image_hazard = preprocess.masks['hazard']
             contours_hazard, ret = cv.findContours(thresh_image_hazard, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
             hazard_count = 0
             # Loop through the contours and filter based on area to detect the hand
@@ -227,14 +311,20 @@ def thermalcapture(noir_ready, thermal_ready, hazard_data):
 
             # print(hazards_contour_list)
             hazard_data[0] = hazard_count
+            if governor is not None:
+                governor.update(float(rec['pixel_max']), state=hazard_count)
 
             if GUI_THERMAL:
-                cv_render(filt_uint8, colormap='rainbow2')
+                render.show(filt_uint8)
                 key = cv.waitKey(1)  # & 0xFF
                 if key == ord("q"):
                     break
             
+            if STATS_PERIOD and ring.n_frames % STATS_PERIOD == 0:
+                print(format_stats(mi48.get_stats()))
+
             # make thermal ready false
+            requested = request_next()
             thermal_ready.value = 0
 
         except KeyboardInterrupt:
@@ -250,7 +340,7 @@ while not esp32_address:
     
 # set up processes
 p1 = multiprocessing.Process(target=noircapture, args=(noir_ready, thermal_ready, hand_data))
-p2 = multiprocessing.Process(target=thermalcapture, args=(noir_ready, thermal_ready, thermal_data))
+p2 = multiprocessing.Process(target=thermalcapture, args=(noir_ready, thermal_ready, thermal_data, thermal_settings))
 p1.start()
 p2.start()
 
@@ -273,6 +363,8 @@ async def main():
                         local_ready = False
                         while not local_ready:
                             local_ready = (noir_ready.value == 0) and (thermal_ready.value == 0)
+                            if not local_ready:
+                                await asyncio.sleep(SYNC_POLL)
 
                         # go through each hazard contour and find distance to each hand point
                         dist_array = []
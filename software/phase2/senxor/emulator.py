@@ -0,0 +1,337 @@
+# Emulation of an MI48 EVK attached over USB, for testing and benchmarking
+# of the host side without a camera module.
+#
+# Usage, to serve a pty until interrupted:
+#     python -m senxor.emulator [--fps FPS] [--frames FILE.npy]
+#                               [--checksum-errors P] [--truncations P]
+#                               [--delays P] [--delay MS]
+import os
+import sys
+import argparse
+import pty
+import tty
+import time
+import select
+import logging
+import threading
+import collections
+import numpy as np
+
+from senxor.mi48 import regmap, crc16_numpy, FPA_SHAPE, KELVIN_0,\
+                        GET_SINGLE_FRAME, CONTINUOUS_STREAM, NO_HEADER,\
+                        BOOTING_UP,\
+                        SPIHDR_FRCNT, SPIHDR_SXVDD, SPIHDR_SXTA, SPIHDR_TIME,\
+                        SPIHDR_MAXV, SPIHDR_MINV, SPIHDR_CRC
+from senxor.interfaces import usb_format_ack
+
+logger = logging.getLogger(__name__)
+
+# register values of a freshly booted EVK with an MI0801 module
+DEFAULT_REGS = {
+    regmap['EVK_TEST']: 0xFF,
+    regmap['EVK_ID']: 0x01,
+    regmap['FRAME_MODE']: 0x20,
+    regmap['FW_VERSION_1']: 0x23,
+    regmap['FW_VERSION_2']: 0x11,
+    regmap['FRAME_RATE']: 0x04,
+    regmap['POWER_DOWN_1']: 0x00,
+    regmap['STATUS']: 0x00,
+    regmap['POWER_DOWN_2']: 0x02,
+    regmap['SENXOR_TYPE']: 0x01,
+    regmap['MODULE_TYPE']: 0x00,
+    regmap['SENS_FACTOR']: 0x64,
+    regmap['EMISSIVITY']: 0x5F,
+    regmap['OFFSET_CORR']: 0x00,
+    regmap['FILTER_CTRL']: 0x00,
+    regmap['FILTER_1_LSB']: 0x32,
+    regmap['FILTER_1_MSB']: 0x00,
+    regmap['FILTER_2']: 0x04,
+    regmap['FLASH_CTRL']: 0x00,
+    regmap['SENXOR_ID_0']: 0x17,
+    regmap['SENXOR_ID_1']: 0x21,
+    regmap['SENXOR_ID_2']: 0x04,
+    regmap['SENXOR_ID_3']: 0x00,
+    regmap['SENXOR_ID_4']: 0x12,
+    regmap['SENXOR_ID_5']: 0x34,
+}
+
+MAX_FPS = 25.5
+
+
+def synthetic_frame(fpa_shape, i=0, t_bg=22.0, t_hot=60.0):
+    """
+    Return a frame of raw pixel values (uint16, deci-Kelvin) in the order
+    the MI48 sends them: a warm background with a hot spot moving along.
+    """
+    ncols, nrows = fpa_shape
+    frame = np.full((nrows, ncols), (t_bg - KELVIN_0) * 10, dtype=np.uint16)
+    c = (3 * i) % ncols
+    frame[nrows // 3: nrows // 3 + 8, max(c - 4, 0): c + 4] =\
+        int((t_hot - KELVIN_0) * 10)
+    # in the order that utils.data_to_frame() takes apart again
+    return frame.ravel()
+
+
+class MI48Emulator:
+    """
+    Emulate an MI48 EVK on the master side of a pseudo-terminal.
+
+    The host opens the slave side, named by `device`, as the serial port
+    of a real EVK. The emulator answers RREG/WREG commands from its
+    register file and streams GFRA frames while FRAME_MODE requests it.
+
+    Frames are taken in turn from `frames` (an iterable of raw uint16
+    arrays), or synthesised if None. If `fps` is given, it overrides the
+    frame rate programmed in the FRAME_RATE register.
+    `latency` (in seconds) delays every acknowledge, as the USB round
+    trip of a real EVK does; commands are still processed as they come.
+    For `boot_time` seconds after start(), or after a write to
+    SENXOR_POWERUP, the BOOTING_UP flag is raised in STATUS.
+    While FLASH_CTRL enables the user flash, register accesses other than
+    to FLASH_CTRL go to `flash` (bytes, erased to 0xFF) instead.
+
+    Faults of a flaky USB link are injected into the GFRA stream at
+    random, each with the given probability per frame:
+
+        * `checksum_errors` -- a bit of the frame is flipped
+        * `truncations`     -- the frame is cut short
+        * `delays`          -- the frame is held back by `delay` seconds
+
+    The number of faults injected is counted in `n_corrupted`,
+    `n_truncated` and `n_delayed`; `n_frames` counts all frames sent.
+    """
+    def __init__(self, frames=None, fps=None, camera_type=1, latency=0.,
+                 boot_time=0., checksum_errors=0., truncations=0.,
+                 delays=0., delay=0.1, seed=None):
+        self.regs = dict(DEFAULT_REGS)
+        self.regs[regmap['SENXOR_TYPE']] = camera_type
+        self.flash = bytearray(b'\xff' * 256)
+        self.fpa_shape = FPA_SHAPE[camera_type]
+        self.frames = list(frames) if frames is not None else None
+        self.fps = fps
+        self.latency = latency
+        self.boot_time = boot_time
+        self.t_booted = 0.
+        self.checksum_errors = checksum_errors
+        self.truncations = truncations
+        self.delays = delays
+        self.delay = delay
+        self.rng = np.random.default_rng(seed)
+        self.n_frames = 0
+        self.n_corrupted = 0
+        self.n_truncated = 0
+        self.n_delayed = 0
+        # acknowledges waiting for their latency to expire: (due, bytes)
+        self.outbox = collections.deque()
+        self.frame_counter = 0
+        self.n_commands = 0
+        self.thread = None
+        self.master, self.slave = pty.openpty()
+        # no echo, no line discipline, just bytes
+        tty.setraw(self.slave)
+        self.device = os.ttyname(self.slave)
+
+    def start(self):
+        """Start serving the host in a background thread"""
+        self._stop = threading.Event()
+        self.t_booted = time.monotonic() + self.boot_time
+        self.thread = threading.Thread(target=self._run, daemon=True,
+                                       name='MI48Emulator')
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread is not None:
+            self._stop.set()
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        self.stop()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def frame_period(self):
+        if self.fps is not None:
+            return 1. / self.fps
+        divisor = self.regs[regmap['FRAME_RATE']] or 1
+        return divisor / MAX_FPS
+
+    def make_frame(self):
+        """Return the payload of the next GFRA acknowledge as bytes"""
+        i = self.frame_counter
+        self.frame_counter = (i + 1) & 0xFFFF
+        if self.frames is None:
+            data = synthetic_frame(self.fpa_shape, i)
+        else:
+            data = np.asarray(self.frames[i % len(self.frames)],
+                              dtype=np.uint16)
+        if self.regs[regmap['FRAME_MODE']] & NO_HEADER:
+            return data.tobytes()
+        header = np.zeros(self.fpa_shape[0], dtype=np.uint16)
+        timestamp = int(1.e3 * time.monotonic()) & 0xFFFFFFFF
+        header[SPIHDR_FRCNT] = i
+        header[SPIHDR_SXVDD] = 33000
+        header[SPIHDR_SXTA] = int((30. - KELVIN_0) * 100)
+        header[SPIHDR_TIME] = timestamp & 0xFFFF
+        header[SPIHDR_TIME + 1] = timestamp >> 16
+        header[SPIHDR_MAXV] = data.max()
+        header[SPIHDR_MINV] = data.min()
+        header[SPIHDR_CRC] = crc16_numpy(data)
+        return header.tobytes() + data.tobytes()
+
+    def inject_faults(self, ack):
+        """Return the GFRA acknowledge `ack`, damaged as configured"""
+        self.n_frames += 1
+        if not (self.checksum_errors or self.truncations or self.delays):
+            return ack
+        p = self.rng.random(3)
+        if p[0] < self.checksum_errors:
+            # flip a bit of the payload, so that the check sum fails
+            ack = bytearray(ack)
+            ack[self.rng.integers(12, len(ack) - 4)] ^= 0x40
+            self.n_corrupted += 1
+        if p[1] < self.truncations:
+            ack = ack[:self.rng.integers(8, len(ack))]
+            self.n_truncated += 1
+        if p[2] < self.delays:
+            # a stall of the link; nothing else gets through meanwhile
+            time.sleep(self.delay)
+            self.n_delayed += 1
+        return ack
+
+    def handle(self, cmd):
+        """Return the acknowledge (bytes) to a host command (str)"""
+        self.n_commands += 1
+        kind, addr = cmd[:4], int(cmd[4:6], 16)
+        if self.regs[regmap['FLASH_CTRL']] & 0x01 and\
+                addr != regmap['FLASH_CTRL']:
+            if kind == 'RREG':
+                return usb_format_ack('RREG', '{:02X}'.format(self.flash[addr]))
+            if kind == 'WREG':
+                self.flash[addr] = int(cmd[6:8], 16)
+                return usb_format_ack('WREG')
+        if kind == 'RREG':
+            value = self.regs.get(addr, 0x00)
+            if addr == regmap['STATUS'] and time.monotonic() < self.t_booted:
+                value |= BOOTING_UP
+            return usb_format_ack('RREG', '{:02X}'.format(value))
+        if kind == 'WREG':
+            self.regs[addr] = int(cmd[6:8], 16)
+            if addr == regmap['SENXOR_POWERUP']:
+                self.t_booted = time.monotonic() + self.boot_time
+            return usb_format_ack('WREG')
+        return usb_format_ack('SERR', 'XXXX')
+
+    def _run(self):
+        inbuf = b''
+        t_next = time.monotonic()
+        while not self._stop.is_set():
+            mode = self.regs[regmap['FRAME_MODE']]
+            capturing = mode & (GET_SINGLE_FRAME | CONTINUOUS_STREAM)
+            timeout = 0.05
+            if capturing:
+                timeout = min(timeout, t_next - time.monotonic())
+            if self.outbox:
+                timeout = min(timeout, self.outbox[0][0] - time.monotonic())
+            ready, _, _ = select.select([self.master], [], [],
+                                        max(0., timeout))
+            if ready:
+                inbuf += os.read(self.master, 4096)
+                inbuf = self._serve(inbuf)
+            now = time.monotonic()
+            while self.outbox and self.outbox[0][0] <= now:
+                self._write(self.outbox.popleft()[1])
+            if not capturing:
+                t_next = now + self.frame_period()
+            elif now >= t_next:
+                self._write(self.inject_faults(
+                    usb_format_ack('GFRA', self.make_frame())))
+                t_next = max(t_next + self.frame_period(), now)
+                if mode & GET_SINGLE_FRAME:
+                    self.regs[regmap['FRAME_MODE']] &= ~GET_SINGLE_FRAME
+
+    def _serve(self, inbuf):
+        """Answer all complete commands in `inbuf`; return the remainder"""
+        while True:
+            i = inbuf.find(b'   #')
+            if i < 0 or len(inbuf) < i + 8:
+                return inbuf
+            n = int(inbuf[i + 4: i + 8], 16)
+            if len(inbuf) < i + 8 + n:
+                return inbuf
+            cmd = inbuf[i + 8: i + 8 + n].decode()
+            inbuf = inbuf[i + 8 + n:]
+            ack = self.handle(cmd)
+            if self.latency:
+                self.outbox.append((time.monotonic() + self.latency, ack))
+            else:
+                self._write(ack)
+
+    def _write(self, data):
+        view = memoryview(data)
+        while view:
+            n = os.write(self.master, view)
+            view = view[n:]
+
+
+def load_frames(filename):
+    """
+    Return the frames of a recording for MI48Emulator(frames=...).
+
+    `filename` is a .npy file of shape (n_frames, rows, cols), holding
+    either raw uint16 values (deci-Kelvin) or temperatures in Celsius,
+    as returned by MI48.read() and utils.data_to_frame().
+    """
+    frames = np.load(filename)
+    if frames.dtype != np.uint16:
+        frames = np.round((frames - KELVIN_0) * 10).astype(np.uint16)
+    # back to 1-D, in the order that utils.data_to_frame() expects
+    return [frame.ravel() for frame in frames]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Emulate an MI48 EVK on a pseudo-terminal')
+    parser.add_argument('--fps', type=float, default=None,
+                        help='frame rate, overriding FRAME_RATE')
+    parser.add_argument('--frames', default=None,
+                        help='.npy recording to stream instead of '
+                             'synthetic frames')
+    parser.add_argument('--latency', type=float, default=0.,
+                        help='acknowledge latency in ms')
+    parser.add_argument('--checksum-errors', type=float, default=0.,
+                        help='probability of a corrupted frame')
+    parser.add_argument('--truncations', type=float, default=0.,
+                        help='probability of a truncated frame')
+    parser.add_argument('--delays', type=float, default=0.,
+                        help='probability of a delayed frame')
+    parser.add_argument('--delay', type=float, default=100.,
+                        help='delay of a delayed frame in ms')
+    args = parser.parse_args(argv)
+    frames = load_frames(args.frames) if args.frames else None
+    emulator = MI48Emulator(frames=frames, fps=args.fps,
+                            latency=1.e-3 * args.latency,
+                            checksum_errors=args.checksum_errors,
+                            truncations=args.truncations,
+                            delays=args.delays, delay=1.e-3 * args.delay)
+    print(emulator.device, flush=True)
+    with emulator:
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+    print('{} frames sent, {} corrupted, {} truncated, {} delayed'.format(
+          emulator.n_frames, emulator.n_corrupted, emulator.n_truncated,
+          emulator.n_delayed), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
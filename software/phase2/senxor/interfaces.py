@@ -1,7 +1,13 @@
 # Copyright (C) Meridian Innovation Ltd. Hong Kong, 2020. All rights reserved.
+import os
 import numpy as np
 import logging
 import time
+import threading
+import asyncio
+import collections
+import contextlib
+import select
 from pprint import pformat
 from senxor.mi48 import get_reg_name
 
@@ -14,11 +20,9 @@ logger = logging.getLogger(__name__)
 
 def cksum(data, sum=0):
     """Calculate simple sum over data, allowing for non-zero init"""
-    sum = sum
-    for byte in data:
-        sum += byte
-    #
-    return sum
+    # data may be bytes, bytearray or memoryview; summing in numpy is
+    # much cheaper than a python loop over the ~10 kB of a GFRA ack
+    return sum + int(np.frombuffer(data, dtype=np.uint8).sum(dtype=np.uint64))
 
 
 class I2C_Interface:
@@ -65,48 +69,75 @@ class SPI_Interface:
         # host system would typically have a buffer that is
         # smaller than the entire frame
         self.xfer_size = xfer_size
+        # MI48 operates as a full duplex device and requires
+        # a dummy write byte for every byte read back
+        self.dummy_bytes = [0,] * xfer_size
+        # transfer buffers, allocated once per frame size; see read()
+        self._frame_dummy_bytes = None
+        self._buffer = bytearray()
 
     def open(self):
         self.device.open()
 
-    def read(self, length_in_words):
-        # MI48 operates as a full duplex device and requires
-        # a dummy write byte for every byte read back
+    def read(self, length_in_words, out=None):
+        """
+        Read a frame of `length_in_words` 16-bit words.
+
+        The frame is returned as a 1-D array of uint16, written into
+        `out` if given, else into a new array. The intermediate buffers
+        are kept from one call to the next, so with `out` no numpy
+        array is allocated per frame.
+        Raise OSError if the SPI device returns fewer or more bytes than
+        asked for.
+        """
         length_in_bytes = 2 * length_in_words
-        dummy_bytes = [0,] * self.xfer_size
-        xfer_size_words = int(self.xfer_size / 2)
-        length_in_words = int(length_in_bytes / 2)
-        # create a couple of buffers for storage of intermediate
-        # transfer and for the return buffer
-        data = np.zeros(length_in_words, dtype=np.uint16)
-        # make up a counter of how many words we have received
-        n_words = 0
-        # loop until we receive the required number of words
-        while n_words < length_in_words:
-            i0 = n_words
-            i1 = n_words + xfer_size_words
-            # Keep the CS asserted throughout the transfer
-            # This should be a property of device.xfer.
-            # If device is an instance of spidev on rpi, this seems to be
-            # true for both xfer and xfer2 routines.
-            # For the sake of generality, keep this as xfer
-            response = self.device.xfer(dummy_bytes)
-            # interpret the response as array of uint8
-            buffer = np.array(response).astype('u1')
-            n_words += int(len(buffer) / 2.)
-            # The MI48 assumes 16 bit word transfer with MSbit first.
-            # But we are reading with 8-bit word transfers on the RPI,
-            # and storing the MSB to lower location than the LSB.
-            # Hence we end up with big-endian data of unsigned 2-byte ints.
-            _data = np.ndarray(shape=(int(len(buffer) / 2),),
-                               buffer=buffer, dtype='>u2')
-            try:
-                data[i0: i1] = _data
-            except IndexError:
-                # depending on xfer_size, the last transfer may be shorter
-                # print(i0, 2*i0, length_in_words, len(_data), len(buffer))
-                data[i0:] = _data[:length_in_words - i0]
-        return data
+        if len(self._buffer) != length_in_bytes:
+            # bytearray, because filling it from the list of ints returned
+            # by spidev is an order of magnitude faster than for ndarray
+            self._buffer = bytearray(length_in_bytes)
+            self._frame_dummy_bytes = None
+        buffer = self._buffer
+        if out is None:
+            out = np.empty(length_in_words, dtype=np.uint16)
+        xfer3 = getattr(self.device, 'xfer3', None)
+        if xfer3 is not None:
+            # spidev >= 3.5 splits large transfers by itself, into
+            # chunks no larger than the buffer of the host driver
+            if self._frame_dummy_bytes is None:
+                self._frame_dummy_bytes = [0,] * length_in_bytes
+            response = xfer3(self._frame_dummy_bytes)
+            # assigning a list of another length would resize the buffer
+            if len(response) != length_in_bytes:
+                raise OSError('SPI transfer of {} bytes returned {}'.format(
+                              length_in_bytes, len(response)))
+            buffer[:] = response
+        else:
+            # make up a counter of how many bytes we have received
+            n_bytes = 0
+            # loop until we receive the required number of bytes
+            while n_bytes < length_in_bytes:
+                # Keep the CS asserted throughout the transfer
+                # This should be a property of device.xfer.
+                # If device is an instance of spidev on rpi, this seems to
+                # be true for both xfer and xfer2 routines.
+                # For the sake of generality, keep this as xfer
+                response = self.device.xfer(self.dummy_bytes)
+                if not response:
+                    raise OSError('SPI transfer returned no data')
+                n = min(len(response), length_in_bytes - n_bytes)
+                if n < len(response):
+                    # depending on xfer_size, the last transfer may be
+                    # longer than what is left of the frame
+                    response = response[:n]
+                buffer[n_bytes: n_bytes + n] = response
+                n_bytes += n
+        # The MI48 assumes 16 bit word transfer with MSbit first.
+        # But we are reading with 8-bit word transfers on the RPI,
+        # and storing the MSB to lower location than the LSB.
+        # Hence we end up with big-endian data of unsigned 2-byte ints,
+        # which are swapped while copying to the output.
+        np.copyto(out, np.frombuffer(buffer, dtype='>u2'))
+        return out
 
     def reset_input_buffer(self):
         try:
@@ -145,6 +176,16 @@ USB_CMD_LEN = 4
 USB_ACK_LEN = 4
 USB_CKS_LEN = 4  # check sum
 USB_HDR_LEN = 320
+# largest acknowledge we expect: GFRA of a 160x120 FPA with header
+USB_MAX_ACK_LEN = USB_CMD_LEN + USB_HDR_LEN + 2 * 160 * 120 + USB_CKS_LEN
+# max number of register commands in flight; conservative, because the
+# size of the EVK command buffer is not documented
+USB_CMD_WINDOW = 8
+# how long [s] to wait for stale acknowledges, if the port has no timeout
+USB_DRAIN_TIME = 0.1
+
+# frames received while waiting for command acknowledges, kept for read()
+USB_KEPT_FRAMES = 4
 
 class USB_Interface:
     """USB interface object to access a connected device"""
@@ -152,6 +193,26 @@ class USB_Interface:
     def __init__(self, port):
         self.port = port
         self.log = logger
+        # keeps partial acknowledges between port reads and resyncs
+        # after corrupted ones without flushing the port
+        self.decoder = USBStreamDecoder()
+        # serialises port access, e.g. register access from the main
+        # thread while a background thread reads frames
+        self.lock = threading.RLock()
+        # held by commands waiting for the port, so that a reader looping
+        # on read() lets them in between frames; see _command()
+        self.command_lock = threading.RLock()
+        # GFRA acknowledges that arrived while waiting for a command
+        # acknowledge; read() returns these first, so that registers can
+        # be changed while streaming without losing frames
+        self.kept_frames = collections.deque(maxlen=USB_KEPT_FRAMES)
+        self.n_kept = 0
+        self.n_kept_dropped = 0
+        # register writes sent by post() whose acknowledge is outstanding
+        self.n_posted = 0
+        # time [s] spent waiting for frame and command acknowledges
+        self.t_frame_ack = 0.
+        self.t_command_ack = 0.
 
     def open(self):
         self.port.open()
@@ -161,19 +222,66 @@ class USB_Interface:
         self.port.close()
 
     def reset_input_buffer(self):
-        self.port.reset_input_buffer()
+        with self.lock:
+            self.port.reset_input_buffer()
+            self.decoder.clear()
+            self.clear_kept_frames()
+            self.n_posted = 0
 
     def reset_output_buffer(self):
         self.port.reset_output_buffer()
 
+    @contextlib.contextmanager
+    def _command(self):
+        """Context holding the port for a command and timing it"""
+        with self.command_lock, self.lock:
+            t0 = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.t_command_ack += time.perf_counter() - t0
+
+    def clear_kept_frames(self):
+        """Drop the frames kept while waiting for command acknowledges"""
+        with self.lock:
+            self.kept_frames.clear()
+
+    def _keep(self, ack):
+        """Keep a frame skipped while waiting for a command acknowledge"""
+        if ack[0] != 'GFRA':
+            return
+        if len(self.kept_frames) == self.kept_frames.maxlen:
+            self.n_kept_dropped += 1
+        self.kept_frames.append(ack[1])
+        self.n_kept += 1
+
+    def _take_posted(self):
+        """Return the number of posted writes not yet acknowledged, for
+        the command about to be sent to skip their acknowledges first"""
+        n_posted, self.n_posted = self.n_posted, 0
+        return n_posted
+
+    def _wait_readable(self):
+        """Wait up to the port timeout for bytes, if the port can be polled"""
+        if self.kept_frames or self.decoder.start < len(self.decoder.buf):
+            return
+        try:
+            fd = self.port.fileno()
+        except (AttributeError, ValueError, OSError):
+            # e.g. not a POSIX serial port
+            return
+        select.select([fd], [], [], self.port.timeout)
+
     def regread(self, reg, regname=""):
         """Read a control/status register via USB protocol"""
         result = None
         while result is None:
-            cmd = 'RREG{:02X}XXXXXX'.format(reg)
-            cmd = '   #{:04X}{}'.format(len(cmd), cmd)
+            cmd = usb_rreg_cmd(reg)
             cmd_name = 'GET_{}'.format(regname)
-            result = usb_command(self.port, cmd, cmd_name)
+            with self._command():
+                result = usb_command(self.port, cmd, cmd_name,
+                                     decoder=self.decoder, skipped=self._keep,
+                                     posted=self._take_posted())
             if result is None: return
             if not isinstance(result, int):
                 # a non int would be a GFRA coming back before the RREG
@@ -182,18 +290,74 @@ class USB_Interface:
 
     def regwrite(self, reg, value, regname=""):
         """Write to a control register via USB protocol"""
-        cmd = 'WREG{:02X}{:02X}XXXX'.format(reg, value)
-        cmd = '   #{:04X}{}'.format(len(cmd), cmd)
+        cmd = usb_wreg_cmd(reg, value)
         cmd_name = 'SET_{}'.format(regname)
-        usb_command(self.port, cmd, cmd_name)
+        with self._command():
+            usb_command(self.port, cmd, cmd_name, decoder=self.decoder,
+                        skipped=self._keep, posted=self._take_posted())
+        return None
+
+    def post(self, reg, value, regname=""):
+        """
+        Write to a control register without waiting for the acknowledge.
+
+        The acknowledge is skipped by read() when it comes, e.g. ahead of
+        the frame requested by writing GET_SINGLE_FRAME to FRAME_MODE,
+        or by the next command, before it waits for its own.
+        """
+        cmd = usb_wreg_cmd(reg, value)
+        with self._command():
+            self.port.write(cmd.encode())
+            self.n_posted += 1
+        self.log.debug('Posted SET_{} {:02X}'.format(regname, value))
         return None
 
-    def read(self, size_in_words):
+    def transact(self, registers, window=USB_CMD_WINDOW):
+        """
+        Access several registers with pipelined commands.
+
+        `registers` is a sequence of (reg, value) pairs; value None means
+        read the register. Up to `window` commands are sent before the
+        first acknowledge is awaited, so the USB round-trip latency is
+        paid about once per batch instead of once per register.
+        Return the list of results: register value for reads, None for
+        writes.
+        """
+        cmds = [usb_rreg_cmd(reg) if value is None else
+                usb_wreg_cmd(reg, value) for reg, value in registers]
+        with self._command():
+            return usb_pipeline(self.port, cmds, self.decoder, window,
+                                skipped=self._keep,
+                                posted=self._take_posted())
+
+    def read(self, size_in_words, block=True):
         """Read a GFRA acknowledge, remove USB header, and return data frame.
 
         The returned data frame is a 1-D numpy array of unsigned int16.
+        If `block` is false, return None if the port times out.
         """
-        cmd, data = usb_acknowledge(self.port)
+        # wait for commands that are waiting for the port, and then for
+        # the frame, without holding the port
+        with self.command_lock:
+            pass
+        self._wait_readable()
+        with self.lock:
+            if self.kept_frames:
+                return self.kept_frames.popleft()[-size_in_words:]
+            t0 = time.perf_counter()
+            while True:
+                if block:
+                    ack = usb_acknowledge(self.port, decoder=self.decoder)
+                else:
+                    ack = usb_decode_ack(self.port, self.decoder)
+                if ack is None or ack[0] != 'WREG' or not self.n_posted:
+                    break
+                # the acknowledge of a write sent by post()
+                self.n_posted -= 1
+            self.t_frame_ack += time.perf_counter() - t0
+        if ack is None:
+            return None
+        cmd, data = ack
         if cmd == 'GFRA':
             # data is a sequence (1-d array) of 16-bit unsigned ints
             # here we drop the USB header 
@@ -203,13 +367,435 @@ class USB_Interface:
             return None
 
 
-def usb_command(port, cmd: str, cmd_name='', verbose=True):
-    """send command to MI48 via USB and return its acknowledge"""
+class USBStreamDecoder:
+    """
+    Incremental decoder of the acknowledge stream coming from the EVK.
+
+    Bytes are appended by feed() in chunks of any size, as they come from
+    the port; next_ack() returns the next complete acknowledge, parsed as
+    by usb_parse_ack(), or None if more bytes are needed.
+    Partial acknowledges are kept between calls. If an acknowledge is
+    corrupt (bad length, unknown command, check sum mismatch), only its
+    start marker is skipped and decoding resumes at the next marker, so
+    that good acknowledges following it are not lost.
+    """
+    MARKER = b'   #'
+    COMMANDS = (b'GFRA', b'RREG', b'WREG', b'SERR')
+    # drop consumed bytes from the front of the buffer past this point
+    COMPACT_LEN = 1 << 16
+
+    def __init__(self, max_ack_len=USB_MAX_ACK_LEN):
+        self.max_ack_len = max_ack_len
+        self.buf = bytearray()
+        self.start = 0
+        # statistics
+        self.n_acks = 0
+        self.n_errors = 0
+        self.n_skipped = 0   # bytes dropped while looking for a marker
+
+    def clear(self):
+        """Drop any buffered bytes"""
+        self.buf.clear()
+        self.start = 0
+
+    def feed(self, data):
+        """Append bytes received from the port"""
+        self.buf += data
+
+    def bytes_needed(self):
+        """Return the number of bytes missing to complete the next ack"""
+        n_prefix = len(self.MARKER) + USB_ACK_LEN
+        n_avail = len(self.buf) - self.start
+        if n_avail < n_prefix or not self.buf.startswith(self.MARKER,
+                                                         self.start):
+            return max(1, n_prefix - n_avail)
+        try:
+            ack_len = int(self.buf[self.start + 4: self.start + n_prefix], 16)
+        except ValueError:
+            return 1
+        # the length field counts itself, the command and the data
+        return max(1, len(self.MARKER) + ack_len + USB_CKS_LEN - n_avail)
+
+    def next_ack(self):
+        """Return the next acknowledge as (command, data), or None"""
+        buf = self.buf
+        n_marker = len(self.MARKER)
+        n_prefix = n_marker + USB_ACK_LEN
+        while True:
+            i = buf.find(self.MARKER, self.start)
+            if i < 0:
+                # keep a tail that may be the beginning of a marker
+                i = max(self.start, len(buf) - n_marker + 1)
+            self.n_skipped += i - self.start
+            self.start = i
+            if len(buf) - i < n_prefix:
+                self._compact()
+                return None
+            # length field counts itself, the command and the data
+            _len = buf[i + n_marker: i + n_prefix]
+            try:
+                ack_len = int(_len, 16)
+            except ValueError:
+                ack_len = -1
+            if not USB_ACK_LEN + USB_CMD_LEN <= ack_len <= self.max_ack_len:
+                self._reject(i, 'Bad USB ack length: {}'.format(bytes(_len)))
+                continue
+            end = i + n_prefix + ack_len - USB_ACK_LEN
+            if len(buf) < end + USB_CKS_LEN:
+                self._compact()
+                return None
+            cmd = bytes(buf[i + n_prefix: i + n_prefix + USB_CMD_LEN])
+            if cmd not in self.COMMANDS:
+                self._reject(i, 'Unknown USB ack command: {}'.format(cmd))
+                continue
+            cs = cksum(memoryview(buf)[i + n_marker: end]) & 0xFFFF
+            try:
+                cks = int(buf[end: end + USB_CKS_LEN], 16)
+            except ValueError:
+                cks = None
+            if cs != cks:
+                self._reject(i, 'Check sum mismatch: calculated {}, '
+                             'received {}'.format(hex(cs),
+                             bytes(buf[end: end + USB_CKS_LEN])))
+                continue
+            # copy the data out, since the buffer is recycled
+            data = buf[i + n_prefix + USB_CMD_LEN: end]
+            self.start = end + USB_CKS_LEN
+            self.n_acks += 1
+            self._compact()
+            return usb_parse_ack(cmd, data)
+
+    def __iter__(self):
+        """Iterate over the complete acknowledges in the buffer"""
+        ack = self.next_ack()
+        while ack is not None:
+            yield ack
+            ack = self.next_ack()
+
+    def _reject(self, i, msg):
+        """Log a corrupt ack and resume decoding just past its marker"""
+        logger.error(msg)
+        self.n_errors += 1
+        self.n_skipped += 1
+        self.start = i + 1
+
+    def _compact(self):
+        if self.start == len(self.buf):
+            self.clear()
+        elif self.start > self.COMPACT_LEN:
+            del self.buf[:self.start]
+            self.start = 0
+
+
+class AsyncUSBTransport:
+    """
+    asyncio transport on top of a USB_Interface.
+
+    The file descriptor of the serial port is watched with
+    loop.add_reader(); whatever arrives is fed to the interface decoder,
+    GFRA acknowledges are queued as frames and all others are queued as
+    command acknowledges. The serial port must support fileno(), as
+    POSIX serial ports and pseudo-terminals do.
+
+    If more than `maxsize` frames are waiting, the oldest is dropped and
+    counted in `n_dropped`.
+
+    If the port fails or hangs up (e.g. the EVK is unplugged), it is no
+    longer watched, and read() and command() raise the error, kept in
+    `error`.
+
+    Acknowledges do not name the register they answer, so commands are
+    sent one at a time, and acknowledges left over from earlier commands
+    are dropped; at most USB_CMD_WINDOW of them are kept.
+
+    `on_regwrite(reg, value)` is called after each regwrite() that was
+    acknowledged, and with value None after one that failed and may or
+    may not have landed, e.g. to keep the shadow registers of MI48 right.
+    """
+    def __init__(self, interface, maxsize=2, on_regwrite=None):
+        self.interface = interface
+        self.on_regwrite = on_regwrite
+        self.port = interface.port
+        self.decoder = interface.decoder
+        self.frames = asyncio.Queue(maxsize)
+        self.acks = asyncio.Queue(USB_CMD_WINDOW)
+        # one command in flight at a time
+        self.lock = asyncio.Lock()
+        self.loop = None
+        self.fd = None
+        self.error = None
+        self.n_dropped = 0
+
+    def open(self):
+        """Start watching the port; must be called from the event loop"""
+        self.loop = asyncio.get_running_loop()
+        self.fd = self.port.fileno()
+        self.loop.add_reader(self.fd, self._on_readable)
+
+    def close(self):
+        if self.loop is not None:
+            self.loop.remove_reader(self.fd)
+            self.loop = None
+
+    def _on_readable(self):
+        try:
+            chunk = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            # e.g. EIO once the USB device is gone
+            self._fail(e)
+            return
+        if not chunk:
+            # end of file: the tty or pty was hung up
+            self._fail(serial.SerialException('{} hung up'.
+                                              format(self.port.name)))
+            return
+        self.decoder.feed(chunk)
+        for ack in self.decoder:
+            if ack[0] != 'GFRA':
+                if self.acks.full():
+                    self.acks.get_nowait()
+                self.acks.put_nowait(ack)
+                continue
+            if self.frames.full():
+                self.frames.get_nowait()
+                self.n_dropped += 1
+            self.frames.put_nowait(ack[1])
+
+    def _fail(self, error):
+        """Stop watching the port, and wake up whoever waits on it"""
+        logger.error('USB transport: {}'.format(error))
+        self.error = error
+        self.close()
+        # None tells a waiter to raise the error
+        if self.frames.full():
+            self.frames.get_nowait()
+        self.frames.put_nowait(None)
+        self._drop_acks()
+        self.acks.put_nowait(None)
+
+    def _drop_acks(self):
+        """Drop the acknowledges waiting; return how many there were"""
+        n = self.acks.qsize()
+        while not self.acks.empty():
+            self.acks.get_nowait()
+        return n
+
+    async def _drain_acks(self, timeout):
+        """Drop acknowledges as they come, until `timeout` passes quietly"""
+        try:
+            while True:
+                ack = await asyncio.wait_for(self.acks.get(), timeout)
+                if ack is None:
+                    raise self.error
+                logger.debug('Dropped stale ACK: {}'.format(ack[0]))
+        except asyncio.TimeoutError:
+            pass
+
+    async def command(self, cmd: str, timeout=0.5, retries=3):
+        """Send a command and return the data of its acknowledge"""
+        async with self.lock:
+            for n_sent in range(1, retries + 1):
+                if self.error is not None:
+                    raise self.error
+                # nothing is in flight; whatever waits is stale
+                if self._drop_acks():
+                    logger.debug('Dropped stale ACKs before {}'.
+                                 format(cmd[8:12]))
+                self.port.write(cmd.encode())
+                try:
+                    while True:
+                        ack = await asyncio.wait_for(self.acks.get(), timeout)
+                        if ack is None:
+                            raise self.error
+                        _cmd, data = ack
+                        if _cmd == cmd[8:12]:
+                            break
+                        logger.debug('Expected ACK: {}, rcvd: {}'.
+                                     format(cmd[8:12], _cmd))
+                except asyncio.TimeoutError:
+                    logger.debug('No ACK to {}; resending'.format(cmd[8:12]))
+                    continue
+                if n_sent > 1:
+                    # the acknowledge to an earlier send may still come
+                    await self._drain_acks(timeout)
+                logger.debug('{}'.format(fmt_usb_cmd(cmd, data)))
+                return data
+        raise TimeoutError('No acknowledge to {}'.format(cmd))
+
+    async def regread(self, reg, regname=""):
+        """Read a control/status register via USB protocol"""
+        return await self.command(usb_rreg_cmd(reg))
+
+    async def regwrite(self, reg, value, regname=""):
+        """Write to a control register via USB protocol"""
+        try:
+            await self.command(usb_wreg_cmd(reg, value))
+        except BaseException:
+            # including cancellation, after the command went out
+            if self.on_regwrite is not None:
+                self.on_regwrite(reg, None)
+            raise
+        if self.on_regwrite is not None:
+            self.on_regwrite(reg, value)
+
+    async def read(self, size_in_words):
+        """Wait for a GFRA acknowledge and return its data frame"""
+        if self.error is not None:
+            raise self.error
+        data = await self.frames.get()
+        if data is None:
+            raise self.error
+        return data[-size_in_words:]
+
+
+def usb_rreg_cmd(reg):
+    """Return the USB command string reading register `reg`"""
+    cmd = 'RREG{:02X}XXXXXX'.format(reg)
+    return '   #{:04X}{}'.format(len(cmd), cmd)
+
+def usb_wreg_cmd(reg, value):
+    """Return the USB command string writing `value` to register `reg`"""
+    cmd = 'WREG{:02X}{:02X}XXXX'.format(reg, value)
+    return '   #{:04X}{}'.format(len(cmd), cmd)
+
+def usb_pipeline(port, cmds, decoder, window=USB_CMD_WINDOW, verbose=True,
+                 skipped=None, posted=0):
+    """
+    Send commands back to back and return the data of their acknowledges.
+
+    Keep up to `window` commands in flight. The EVK acknowledges commands
+    in order, and acknowledges do not name the register, so each one is
+    matched to the oldest outstanding command by position alone; GFRA
+    acknowledges in between are skipped, and passed to `skipped` if given.
+    If an acknowledge may have gone missing -- the port times out, one
+    of the wrong type arrives, or the decoder drops damaged bytes -- it
+    is unknown which one, so none of the values can be placed: those
+    still in flight are drained, and all the commands are sent again,
+    one at a time. Register writes are thus repeated with the same value.
+    The acknowledges to `posted` register writes sent earlier come first,
+    and are skipped; see usb_skip_posted().
+    """
+    results = []
+    n_sent = 0
+    n_damaged = decoder.n_errors + decoder.n_skipped
+    while len(results) < len(cmds):
+        # top up the commands in flight
+        n_next = min(len(results) + window, len(cmds))
+        if n_sent < n_next:
+            port.write(''.join(cmds[n_sent: n_next]).encode())
+            n_sent = n_next
+        if posted:
+            # acknowledged ahead of the commands just sent
+            usb_skip_posted(port, decoder, posted, skipped)
+            posted = 0
+        cmd = cmds[len(results)]
+        ack = usb_decode_ack(port, decoder)
+        if ack is not None and ack[0] == 'GFRA':
+            if skipped is not None:
+                skipped(ack)
+            continue
+        if ack is None or ack[0] != cmd[8:12] or\
+                decoder.n_errors + decoder.n_skipped != n_damaged:
+            logger.warning('Lost track of the acknowledges to {} pipelined '
+                           'commands; sending them one at a time'.
+                           format(len(cmds)))
+            usb_drain_acks(port, decoder, skipped)
+            return [usb_command(port, cmd, verbose=verbose, decoder=decoder,
+                                skipped=skipped) for cmd in cmds]
+        _cmd, data = ack
+        if verbose: logger.debug('{}'.format(fmt_usb_cmd(cmd, data)))
+        results.append(data)
+    return results
+
+def usb_skip_posted(port, decoder, n_posted, skipped=None):
+    """
+    Read and drop the acknowledges to `n_posted` register writes sent
+    without waiting for them, lest they be taken for the acknowledges to
+    the commands that follow. GFRA acknowledges are passed to `skipped`
+    if given. Return the number that did not come before the port timed
+    out.
+    """
+    while n_posted:
+        ack = usb_decode_ack(port, decoder)
+        if ack is None:
+            logger.warning('No ACK to {} posted WREG'.format(n_posted))
+            break
+        if ack[0] == 'GFRA':
+            if skipped is not None:
+                skipped(ack)
+            continue
+        if ack[0] != 'WREG':
+            # e.g. SERR, in answer to the posted write
+            logger.warning('Expected ACK to posted WREG, rcvd: {}'.
+                           format(ack[0]))
+        n_posted -= 1
+    return n_posted
+
+def usb_drain_acks(port, decoder, skipped=None, duration=None):
+    """
+    Read and drop the acknowledges still coming to commands given up on,
+    until the port times out, or for `duration` seconds at most (default:
+    the port timeout), since a streaming EVK never goes quiet.
+    GFRA acknowledges are passed to `skipped` if given.
+    Return the number of acknowledges dropped.
+    """
+    if duration is None:
+        duration = getattr(port, 'timeout', None) or USB_DRAIN_TIME
+    deadline = time.monotonic() + duration
+    n_dropped = 0
+    while time.monotonic() < deadline:
+        ack = usb_decode_ack(port, decoder)
+        if ack is None:
+            break
+        if ack[0] == 'GFRA':
+            if skipped is not None:
+                skipped(ack)
+            continue
+        logger.debug('Dropped stale ACK: {}'.format(ack[0]))
+        n_dropped += 1
+    return n_dropped
+
+def usb_command(port, cmd: str, cmd_name='', verbose=True, decoder=None,
+                skipped=None, posted=0):
+    """send command to MI48 via USB and return its acknowledge
+
+    If a `decoder` (USBStreamDecoder) is given, acknowledges other than
+    the expected one are skipped without flushing the port, and passed
+    to `skipped` if given; the command is re-sent only if the port
+    times out. The acknowledge to an earlier send may then still be on
+    its way; it is drained, lest it be taken for the acknowledge to the
+    next command of the same type. With a decoder, the acknowledges to
+    `posted` register writes sent earlier are skipped first; see
+    usb_skip_posted().
+    """
     _cmd = ''
+    n_sent = 0
     while _cmd != cmd[8:12]:
         # host command
         port.write(cmd.encode())
+        n_sent += 1
         # device ack
+        if decoder is not None:
+            if posted:
+                # acknowledged ahead of the command just sent
+                usb_skip_posted(port, decoder, posted, skipped)
+                posted = 0
+            ack = usb_decode_ack(port, decoder)
+            while ack is not None and ack[0] != cmd[8:12]:
+                if verbose:
+                    logger.debug('Expected ACK: {}, rcvd: {}'.
+                                 format(cmd[8:12], ack[0]))
+                if skipped is not None:
+                    skipped(ack)
+                ack = usb_decode_ack(port, decoder)
+            if ack is None:
+                continue
+            _cmd, data = ack
+            if n_sent > 1:
+                usb_drain_acks(port, decoder, skipped)
+            break
         _cmd, data = usb_acknowledge(port)
         if _cmd != cmd[8:12]:
             if verbose:
@@ -223,28 +809,51 @@ def usb_command(port, cmd: str, cmd_name='', verbose=True):
     if verbose: logger.debug('{}'.format(fmt_usb_cmd(cmd, data)))
     return data
 
-def usb_acknowledge(port):
+def usb_acknowledge(port, buffer=None, decoder=None):
     """Receive the EVK acknowledge and parse it"""
     ack = None
     # this loop will make the program hang if ser.read()
     # has no timeout configured!
     while ack is None:
+        if decoder is not None:
+            # the decoder resyncs by itself; keep what is buffered
+            ack = usb_decode_ack(port, decoder)
+            continue
         # if *.decode() yields UnicodeDecodeError
         # drop the ACK and wait for the next one
-        ack = usb_get_ack(port)
+        ack = usb_get_ack(port, buffer=buffer)
         if ack is None:
             #logger.warning('None ACK received. Resetting input buffer.')
             port.reset_input_buffer()
-    parsed = usb_parse_ack(*ack)
-    return parsed
+            continue
+        ack = usb_parse_ack(*ack)
+    return ack
+
+def usb_decode_ack(port, decoder):
+    """
+    Return the next parsed acknowledge from `port`, using `decoder`.
+
+    Read as many bytes as the decoder needs to complete the acknowledge,
+    or as many as are waiting if more. Return None on port timeout.
+    """
+    ack = decoder.next_ack()
+    while ack is None:
+        size = max(decoder.bytes_needed(), getattr(port, 'in_waiting', 0))
+        chunk = port.read(size)
+        if not chunk:
+            return None
+        decoder.feed(chunk)
+        ack = decoder.next_ack()
+    return ack
 
-def usb_parse_ack(cmd:str, data:bytes):
+def usb_parse_ack(cmd:bytes, data:bytes):
     """
     Parse command and return the command string and a data item.
 
     The data item depends on the type of acknowledge:
 
-    * 'GFRA' -- a 1-D array of 16-bit unsigned integers.
+    * 'GFRA' -- a 1-D array of 16-bit unsigned integers; this is a view
+                of `data` (no copy), so it shares its lifetime.
     * 'RREG' -- an integer
     * 'WREG' -- a None value
     * 'SERR' -- decoded data field
@@ -255,23 +864,28 @@ def usb_parse_ack(cmd:str, data:bytes):
         return cmd, None
     if cmd == 'RREG':
         # read command returns only a register value
-        return cmd, int(data.decode(), base=16)
+        return cmd, int(bytes(data).decode(), base=16)
     if cmd == 'SERR':
         # I have no info on what SERR contains... undocumented
-        return cmd, data.decode()
+        return cmd, bytes(data).decode()
     if cmd == 'GFRA':
         # Frame acknowledge contains unencoded unsigned 16-bit ints
         data = np.frombuffer(data, dtype='u2')
         return cmd, data
 
-def usb_get_ack(port):
+def usb_get_ack(port, buffer=None):
     """
     Obtain an acknowledge to a command sent to a virtual serial port
 
     Ack has the following format:
     | '   #' | 4B length(LenCmdDat) | 4B command | data (lenth - 8B) | 4B CKS |
 
-    Return bytes.
+    Once the length is known, the command, data and check sum are read
+    with a single bulk read into `buffer` (a bytearray), which is reused
+    across calls if provided.
+
+    Return (command, data) bytes-like items. If `buffer` is given, data
+    is a memoryview of it and is valid only until the next call.
     """
     res = ''
     while res != '   #':
@@ -288,26 +902,28 @@ def usb_get_ack(port):
 
     # Read the length field and start check sum calculation
     _len = port.read(USB_ACK_LEN)
-    cs = cksum(_len)
     try:
-        ack_len = int(_len.decode(), base=16)
-    except ValueError:
+        ack_len = int(_len, base=16)
+    except (TypeError, ValueError):
         return None
     data_len = ack_len - USB_ACK_LEN - USB_CMD_LEN
-    # Read the data part of the payload and update the checksum
-    cmd = port.read(USB_CMD_LEN)
-    cs = cksum(cmd, cs)
-    data = port.read(data_len)
-    if data_len > 0:
-        cs = cksum(data, cs)
-    cs = cs & 0xFFFF
-    # Read the check sum field
-    cks = port.read(USB_CKS_LEN)
-    try:
-        cks.decode()
-    except UnicodeDecodeError:
-        print('USB check sum decode error: {}'.format(cks))
+    if data_len < 0:
         return None
+    # Read command, data and check sum in one go
+    n = USB_CMD_LEN + data_len + USB_CKS_LEN
+    if buffer is None or len(buffer) < n:
+        buffer = bytearray(n)
+    view = memoryview(buffer)[:n]
+    n_read = _read_into(port, view)
+    if n_read < n:
+        logger.error('USB acknowledge truncated: expected {} bytes, got {}'.
+                     format(n, n_read))
+        return None
+    cmd = bytes(view[:USB_CMD_LEN])
+    data = view[USB_CMD_LEN: n - USB_CKS_LEN]
+    cs = cksum(view[:n - USB_CKS_LEN], cksum(_len)) & 0xFFFF
+    # Parse the check sum field
+    cks = bytes(view[n - USB_CKS_LEN:])
     try:
         cks = int(cks, base=16)
     except ValueError:
@@ -320,6 +936,29 @@ def usb_get_ack(port):
         return None
     return cmd, data
 
+def _read_into(port, view):
+    """Fill `view` with bytes from `port`; return number of bytes read"""
+    try:
+        return port.readinto(view)
+    except AttributeError:
+        # port does not implement the io.RawIOBase interface
+        chunk = port.read(len(view))
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+def usb_format_ack(cmd: str, data=b''):
+    """
+    Compose an acknowledge as sent by the EVK; return bytes.
+
+    This is the inverse of usb_get_ack(), useful to emulate a device.
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    body = cmd.encode() + bytes(data)
+    _len = '{:04X}'.format(len(body) + USB_ACK_LEN).encode()
+    cs = cksum(body, cksum(_len)) & 0xFFFF
+    return b'   #' + _len + body + '{:04X}'.format(cs).encode()
+
 def fmt_usb_cmd(cmd, data):
     """Command is a string already; here we return a more informative one"""
     s = []
@@ -2,9 +2,16 @@
 #
 import sys
 sys.path.append("/home/test/myenv/lib/python3.11/site-packages")
+import os
+import json
 import logging
 import functools
 import time
+import threading
+import collections
+import inspect
+import contextlib
+import queue
 import struct
 import array
 import numpy as np
@@ -86,6 +93,17 @@ regmap = {
     "SENXOR_ID_5"   : 0xE5,  # R  Serial number of the attached camera module
 }
 
+# Registers that the MI48 may change by itself, or whose reads have side
+# effects; these are never served from the shadow register file of MI48.
+VOLATILE_REGS = {
+    regmap['SENXOR_POWERUP'],
+    regmap['FRAME_MODE'],
+    regmap['STATUS'],
+    regmap['FILTER_CTRL'],   # bit 1 (filter init) may be self-clearing
+    regmap['FLASH_CTRL'],
+}
+CACHED_REGS = set(regmap.values()) - VOLATILE_REGS
+
 MI48_FRAME_MODE    = 0xB1  # RW Control the capture and readout of thermal data 
 MI48_FW_VERSION_1  = 0xB2  # R  Firmware Version (Major, Minor)
 MI48_FW_VERSION_2  = 0xB3  # R  Firmware Version (Build)
@@ -111,6 +129,14 @@ MI48_SENXOR_ID_4   = 0xE4  # R  Serial number of the attached camera module
 MI48_SENXOR_ID_5   = 0xE5  # R  Serial number of the attached camera module
 MI48_SENXOR_ID_LEN = 6     # number of bytes of the SENXOR_ID
 
+# registers identifying the camera module and the EVK, read in one go
+# by get_camera_info(); a cached entry is valid only while these read
+# back the same, see CompensationParamsCache
+CAMERA_IDENT_REGS = ('SENXOR_TYPE', 'MODULE_TYPE', 'EVK_ID',
+                     'FW_VERSION_1', 'FW_VERSION_2') +\
+                    tuple('SENXOR_ID_{}'.format(i)
+                          for i in range(MI48_SENXOR_ID_LEN))
+
 # STATUS Register Flags Masks
 READOUT_TOO_SLOW = 0x02
 SENXOR_IF_ERROR = 0x04
@@ -156,18 +182,485 @@ FPA_SHAPE = {
 crc16 = crcmod.predefined.mkCrcFun('crc-ccitt-false')
 
 
+class CRC16:
+    """
+    CRC-16/CCITT-FALSE of numpy arrays, bit for bit equal to crc16().
+
+    The CRC is affine in the message bits: for a message of L bytes it
+    is the CRC of L zero bytes, XOR the contribution of every bit set.
+    Bit c of the CRC is therefore the parity of the message AND a mask,
+    and with the message viewed as 64-bit words, the 16 masks turn the
+    byte by byte loop of crcmod into one AND and one XOR reduction over
+    the frame. The masks (16 x L/8 words, i.e. 160 kB for an 80x62
+    frame) are built on first use for every message length.
+    """
+    POLY = 0x1021
+    INIT = 0xFFFF
+
+    def __init__(self):
+        # standard MSB-first table: CRC of byte b, register cleared
+        table = np.zeros(256, dtype=np.uint16)
+        for b in range(256):
+            crc = b << 8
+            for _ in range(8):
+                crc = ((crc << 1) ^ self.POLY) if crc & 0x8000 else crc << 1
+            table[b] = crc & 0xFFFF
+        self.table = table
+        self.masks = {}
+        self.lock = threading.Lock()
+        # per-thread scratch buffers, so that no call allocates
+        self.scratch = threading.local()
+
+    def shift(self, crc):
+        """Advance the CRC register(s) `crc` over one zero byte"""
+        return (crc << 8) ^ self.table[crc >> 8]
+
+    def get_masks(self, length):
+        """Return (CRC of `length` zero bytes, masks) for a message length"""
+        try:
+            return self.masks[length]
+        except KeyError:
+            pass
+        with self.lock:
+            n_words = -(-length // 8)
+            # contribution of bit j of byte i to the CRC; the last byte
+            # contributes through the plain table, every byte before it
+            # is shifted through one more zero byte. Leading zero bytes
+            # pad the message to whole words, and contribute nothing.
+            contrib = np.zeros((8 * n_words, 8), dtype=np.uint16)
+            row = self.table[1 << np.arange(8)]
+            for i in range(8 * n_words - 1, -1, -1):
+                contrib[i] = row
+                row = self.shift(row)
+            # bit k of a little-endian word is bit k % 8 of byte k // 8
+            contrib = contrib.reshape(n_words, 64)
+            weights = np.uint64(1) << np.arange(64, dtype=np.uint64)
+            masks = np.empty((16, n_words), dtype=np.uint64)
+            for c in range(16):
+                bits = ((contrib >> c) & 1).astype(np.uint64)
+                masks[c] = (bits * weights).sum(axis=1, dtype=np.uint64)
+            zero = np.uint16(self.INIT)
+            for _ in range(length):
+                zero = self.shift(zero)
+            self.masks[length] = (int(zero), masks)
+        return self.masks[length]
+
+    def __call__(self, data):
+        """Return the CRC of the bytes of `data` (array or bytes), as int"""
+        data = np.frombuffer(np.ascontiguousarray(data), dtype=np.uint8)
+        zero, masks = self.get_masks(len(data))
+        if len(data) % 8:
+            padded = np.zeros(8 * masks.shape[1], dtype=np.uint8)
+            padded[-len(data):] = data
+            data = padded
+        scratch = getattr(self.scratch, 'buffer', None)
+        if scratch is None or scratch.shape != masks.shape:
+            scratch = self.scratch.buffer = np.empty_like(masks)
+        words = data.view('<u8')
+        # row by row: broadcasting the words over all masks at once
+        # makes numpy allocate a buffer on every call
+        for c in range(16):
+            np.bitwise_and(masks[c], words, out=scratch[c])
+        parity = np.bitwise_xor.reduce(scratch, axis=1)
+        crc = zero
+        for c, x in enumerate(parity.tolist()):
+            crc ^= (bin(x).count('1') & 1) << c
+        return crc
+
+
+crc16_numpy = CRC16()
+
+CRC_POLICIES = ('every', 'sampled', 'thread', 'off')
+
+def celsius_to_raw(t):
+    """Return temperature(s) `t` in Celsius as raw (deci-Kelvin) values"""
+    return (np.asarray(t, dtype=np.float64) - KELVIN_0) * 10.
+
+
+def raw_to_celsius(raw):
+    """Return raw (deci-Kelvin) value(s) as temperature in Celsius"""
+    return np.asarray(raw) / 10. + KELVIN_0
+
+
+def raw_threshold(t):
+    """
+    Return the integer r such that, for a raw frame, `frame > r` is true
+    exactly where the frame is hotter than `t` Celsius.
+    """
+    # round off the float error of the conversion before the floor,
+    # else a t on the raw grid (e.g. 39.95) may come out one lower
+    return int(np.floor(np.round(celsius_to_raw(t), 6)))
+
+
+_celsius_luts = {}
+
+def celsius_lut(dtype=np.float16):
+    """
+    Return the temperature in Celsius of every raw (deci-Kelvin) value.
+
+    Indexing the table with a raw frame gives the same values as
+    (data / 10. + KELVIN_0).astype(dtype), without the temporaries.
+    """
+    dtype = np.dtype(dtype)
+    try:
+        return _celsius_luts[dtype]
+    except KeyError:
+        lut = (np.arange(1 << 16) / 10. + KELVIN_0).astype(dtype)
+        lut.flags.writeable = False
+        _celsius_luts[dtype] = lut
+        return lut
+
+
+class FrameQueue:
+    """
+    Bounded, thread-safe queue of frames, dropping frames when full.
+
+    `policy` determines which frames are dropped:
+
+        * 'drop_oldest' -- a FIFO of `maxlen` frames; putting a frame into
+                           a full queue drops the oldest one.
+        * 'keep_latest' -- get() always returns the most recent frame and
+                           drops any older ones still queued.
+
+    The number of frames put and dropped is counted in `n_put` and
+    `n_dropped`. `t_get` is the time (time.monotonic) at which the frame
+    last returned by get() was put into the queue.
+    """
+    POLICIES = ('drop_oldest', 'keep_latest')
+
+    def __init__(self, maxlen=2, policy='keep_latest'):
+        if policy not in self.POLICIES:
+            raise ValueError('Queue policy must be one of {}'.
+                             format(self.POLICIES))
+        self.policy = policy
+        self.frames = collections.deque(maxlen=maxlen)
+        self.cond = threading.Condition()
+        self.n_put = 0
+        self.n_dropped = 0
+        self.t_get = None
+
+    def put(self, frame):
+        t = time.monotonic()
+        with self.cond:
+            if len(self.frames) == self.frames.maxlen:
+                self.n_dropped += 1
+            self.frames.append((t, frame))
+            self.n_put += 1
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        """Return the next frame, or None if none arrives within `timeout`"""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.frames, timeout):
+                return None
+            if self.policy == 'keep_latest':
+                self.n_dropped += len(self.frames) - 1
+                self.t_get, frame = self.frames.pop()
+                self.frames.clear()
+                return frame
+            self.t_get, frame = self.frames.popleft()
+            return frame
+
+    def clear(self):
+        with self.cond:
+            self.frames.clear()
+
+    def __len__(self):
+        return len(self.frames)
+
+
+class AcquisitionStats:
+    """
+    Running statistics of the frames received from a camera module.
+
+    update() is called once per frame and only bumps a few counters and
+    stores the interval since the previous frame in a ring of the last
+    `window` intervals; rates, jitter and the like are computed by
+    snapshot(), as often as the caller wants them.
+
+    Frames missing from the sequence of header frame counters are
+    counted in `n_missed`, in `n_gaps` runs. A jump back of more than
+    half the counter range is taken for a restart of capture, not a gap.
+    """
+    def __init__(self, window=128):
+        self.intervals = np.zeros(window)
+        self.reset()
+
+    def reset(self):
+        self.t_reset = time.monotonic()
+        self.t_first = None
+        self.t_last = None
+        self.n_frames = 0
+        self.n_bytes = 0
+        self.n_missed = 0
+        self.n_gaps = 0
+        self.frame_counter = None
+        # device timestamp [ms] of the first frame with a header, and
+        # the number of frames the device sent since, incl. missed ones
+        self.timestamp_first = None
+        self.timestamp_last = None
+        self.n_device_frames = 0
+
+    def update(self, t, n_bytes, frame_counter=None, timestamp=None):
+        """Count a frame of `n_bytes` received at `t` (time.monotonic)"""
+        if self.t_last is None:
+            self.t_first = t
+        else:
+            self.intervals[self.n_frames % len(self.intervals)] =\
+                t - self.t_last
+        self.t_last = t
+        self.n_frames += 1
+        self.n_bytes += n_bytes
+        if frame_counter is None:
+            return
+        if self.frame_counter is None:
+            self.timestamp_first = timestamp
+        else:
+            gap = (frame_counter - self.frame_counter - 1) & 0xFFFF
+            if 0 < gap < 0x8000:
+                self.n_gaps += 1
+                self.n_missed += gap
+                self.n_device_frames += gap
+        self.n_device_frames += 1
+        self.frame_counter = frame_counter
+        self.timestamp_last = timestamp
+
+    def snapshot(self):
+        """Return the statistics so far as a flat dictionary"""
+        n = min(self.n_frames - 1, len(self.intervals))
+        intervals = self.intervals[:n] if n > 0 else self.intervals[:0]
+        elapsed = time.monotonic() - self.t_reset
+        span = 0. if self.t_first is None else self.t_last - self.t_first
+        stats = {
+            'elapsed': elapsed,
+            'frames': self.n_frames,
+            'fps_mean': (self.n_frames - 1) / span if span > 0 else 0.,
+            'fps': n / intervals.sum() if n > 0 and intervals.sum() else 0.,
+            'jitter_ms': 1.e3 * intervals.std() if n > 1 else 0.,
+            'interval_max_ms': 1.e3 * intervals.max() if n > 0 else 0.,
+            'bytes_per_s': self.n_bytes * (self.n_frames - 1) /
+                           self.n_frames / span if span > 0 else 0.,
+            'missed': self.n_missed,
+            'gaps': self.n_gaps,
+            'missed_rate': self.n_missed / self.n_device_frames
+                           if self.n_device_frames else 0.,
+            'device_fps': 0.,
+        }
+        if self.n_device_frames > 1 and\
+                self.timestamp_last > self.timestamp_first:
+            stats['device_fps'] = 1.e3 * (self.n_device_frames - 1) /\
+                (self.timestamp_last - self.timestamp_first)
+        return stats
+
+
+def frame_dtype(fpa_shape=(80, 62), dtype=np.float32):
+    """
+    Return the dtype of a frame record: header fields as native numbers
+    (as parsed by MI48.parse_frame_header, but with an int CRC) followed by
+    the frame data, of `dtype`, oriented as by utils.data_to_frame().
+    """
+    ncols, nrows = fpa_shape
+    return np.dtype([
+        ('host_time', '<f8'),           # time.time() when read
+        ('timestamp', '<u4'),           # ms
+        ('frame_counter', '<u2'),
+        ('crc', '<u2'),
+        ('senxor_vdd', '<f4'),          # V
+        ('senxor_temperature', '<f4'),  # Celsius
+        ('pixel_max', '<f4'),           # Celsius
+        ('pixel_min', '<f4'),           # Celsius
+        ('crc_error', '?'),
+        ('data', dtype, (nrows, ncols)),
+    ], align=True)
+
+# the fields of frame_dtype() other than 'data', in order
+FRAME_HEADER_FIELDS = ('host_time', 'timestamp', 'frame_counter', 'crc',
+                       'senxor_vdd', 'senxor_temperature', 'pixel_max',
+                       'pixel_min', 'crc_error')
+
+
+class FrameRing:
+    """
+    Preallocated ring buffer of the last `n` frames and their headers.
+
+    Every frame is a record of frame_dtype(fpa_shape, dtype), which
+    MI48.read_frame() fills in place. Consumers take views into the
+    ring instead of copies:
+
+        frame = mi48.read_frame(ring)   # == ring.latest()
+        frame['data']                   # (rows, cols) view
+        ring.window(10)['data']         # (10, rows, cols) view, oldest first
+
+    Every slot is kept twice, so that any window of up to `n` frames is
+    contiguous. A view is valid until its frame is overwritten, i.e. for
+    the next n - 1 frames read into the ring.
+    """
+    def __init__(self, n, fpa_shape=(80, 62), dtype=np.float32):
+        self.n = n
+        self.fpa_shape = fpa_shape
+        self.dtype = frame_dtype(fpa_shape, dtype)
+        self.buffer = np.zeros(2 * n, dtype=self.dtype)
+        # the header fields alone, so that they can be set with one tuple
+        fields = self.dtype.fields
+        self.headers = self.buffer.view(np.dtype({
+            'names': FRAME_HEADER_FIELDS,
+            'formats': [fields[name][0] for name in FRAME_HEADER_FIELDS],
+            'offsets': [fields[name][1] for name in FRAME_HEADER_FIELDS],
+            'itemsize': self.dtype.itemsize}))
+        # number of frames committed so far
+        self.n_frames = 0
+
+    def __len__(self):
+        return min(self.n_frames, self.n)
+
+    def next_slot(self):
+        """Return the record to fill with the next frame; see commit()"""
+        return self.buffer[self.n_frames % self.n]
+
+    def set_header(self, values):
+        """Set the header of next_slot(), in order of FRAME_HEADER_FIELDS"""
+        self.headers[self.n_frames % self.n] = values
+
+    def commit(self):
+        """Make the frame filled into next_slot() the latest one"""
+        i = self.n_frames % self.n
+        self.buffer[i + self.n] = self.buffer[i]
+        self.n_frames += 1
+
+    def latest(self):
+        """Return the latest frame, or None if there is none"""
+        if not self.n_frames:
+            return None
+        return self.buffer[(self.n_frames - 1) % self.n + self.n]
+
+    def window(self, k=None):
+        """Return the latest `k` (default: all) frames, oldest first"""
+        k = len(self) if k is None else min(k, len(self))
+        end = (self.n_frames - 1) % self.n + self.n + 1
+        return self.buffer[end - k: end]
+
+
+class CompensationParamsCache:
+    """
+    Host-side cache of the compensation parameters in the MI48 user
+    flash, which take one register read per byte to get.
+
+    There is one JSON file per camera module, named after its CAMERA_ID,
+    in `directory` (default: $SENXOR_CACHE_DIR, or ~/.cache/senxor).
+    Each entry holds the values of CAMERA_IDENT_REGS it was made with;
+    the entry is used only while these read back the same, so that a
+    module moved to another EVK, or a firmware update, starts afresh.
+
+    Failures to read or write the cache are logged and otherwise
+    ignored; the camera is then simply read as without a cache.
+    """
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.environ.get('SENXOR_CACHE_DIR',
+                os.path.join(os.path.expanduser('~'), '.cache', 'senxor'))
+        self.directory = directory
+
+    def filename(self, camera_id):
+        return os.path.join(self.directory, '{}.json'.format(camera_id))
+
+    def load(self, camera_id, ident):
+        """Return the entry of `camera_id` if made with `ident`, else None"""
+        try:
+            with open(self.filename(camera_id)) as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning('Ignoring compensation cache: {}'.format(e))
+            return None
+        if entry.get('ident') != list(ident):
+            return None
+        return entry
+
+    def store(self, camera_id, entry):
+        """Write the entry of `camera_id`; return True on success"""
+        filename = self.filename(camera_id)
+        tmpname = '{}.{}.tmp'.format(filename, os.getpid())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmpname, 'w') as f:
+                json.dump(entry, f, indent=1)
+            # readers see either the old or the new file, never half of one
+            os.replace(tmpname, filename)
+        except OSError as e:
+            logging.warning('Cannot write compensation cache: {}'.format(e))
+            return False
+        return True
+
+    def remove(self, camera_id):
+        """Forget the entry of `camera_id`"""
+        try:
+            os.remove(self.filename(camera_id))
+        except FileNotFoundError:
+            pass
+
+
 class MI48:
     """
     MI48xx abstraction
     """
     def __init__(self, interfaces:list, fps=None, name="MI48",
-                reset_handler=None, data_ready=None, read_raw=False):
-        """Initialise with a serial port"""
+                reset_handler=None, data_ready=None, read_raw=False,
+                param_cache=None):
+        """Initialise with a serial port
+
+        `param_cache` is a CompensationParamsCache, or True for the
+        default one; by default the compensation parameters are read
+        from the camera module every time.
+        """
         # logging stuff
         self.name = name
         self.log = functools.partial(logger_wrapper, self.name, logger=None)
         # interface handles
         self.interfaces = interfaces
+        # background reader thread and its frame queue; see start()
+        self.reader = None
+        self.frame_queue = None
+        # asyncio transport while stream() is being iterated
+        self.transport = None
+        # register writes queued by batch(), and the shadow values they
+        # set once sent
+        self._batch = None
+        self._batch_shadow = []
+        # duration [s] of the phases of bootup and stop_capture
+        self.timings = {}
+        # shadow register file: last known values of non-volatile regs
+        self.shadow = {}
+        self.shadow_hits = 0
+        self.shadow_misses = 0
+        self.user_flash = False
+        # compensation parameters kept across connects
+        if param_cache is True:
+            param_cache = CompensationParamsCache()
+        self.param_cache = param_cache or None
+        self.param_cache_entry = None
+        # type of the temperatures returned by read()
+        self.celsius_dtype = np.float16
+        # frame buffer reused by interfaces that can read into one
+        try:
+            self.read_takes_out =\
+                'out' in inspect.signature(interfaces[1].read).parameters
+        except (TypeError, ValueError):
+            self.read_takes_out = False
+        self.raw_buffer = None
+        # lookup table indices for read_into()
+        self.lut_index = None
+        # frame CRC checking; see set_crc_policy()
+        self.crc_policy = 'every'
+        self.crc_sample_period = 10
+        self.crc_queue = None
+        self.crc_worker = None
+        self.n_crc_frames = 0
+        self.n_crc_checked = 0
+        self.n_crc_errors = 0
+        # acquisition statistics; see get_stats()
+        self.stats = AcquisitionStats()
+        self.t_read_wait = 0.
         # note that this will potentially clear only the host
         # interface buffers; meanwhile, the MI48 buffers would
         # require different handling, if the MI48 was left in
@@ -220,7 +713,7 @@ class MI48:
         # set the format of the returned data
         self.read_raw = read_raw
 
-    def bootup(self, verbose=False, powerup=False):
+    def bootup(self, verbose=False, powerup=False, boot_timeout=5.0):
         """Ensure bootup of the mi48 is complete, returning MODE and STATUS.
 
         Return all flags raised at any one point while looping and waiting for
@@ -228,33 +721,56 @@ class MI48:
         boot-up. Exception is boot_in_progress flag, as we're handling it here.
         This is necessary because error handling will likely require register
         write, which is allowed only once that bootup is comlete.
+
+        STATUS is polled with exponential backoff for up to `boot_timeout`
+        seconds; the time spent in each phase is stored in self.timings.
         """
-        # NOTE on the timeout (in seconds) below:
-        # On WINDOWS the clock has poor resolution, which probably
-        # depends on CPU frequency too.
-        timeout = max(0.025, time.get_clock_info('monotonic').resolution)
+        t0 = time.monotonic()
         if powerup: self.powerup()
+        t1 = time.monotonic()
         self.check_ctrl_stat_regs()
-        t0 = time.monotonic()
-        status = self.get_status(verbose=verbose)
+        t2 = time.monotonic()
+        status, booted = self._poll(lambda: self.get_status(verbose=verbose),
+                                   lambda status: not status & BOOTING_UP,
+                                   timeout=boot_timeout)
         mode = self.get_mode(verbose=verbose)
-        boot_in_progress = status & BOOTING_UP
-#        no_header = mode & NO_HEADER
-        while boot_in_progress:
-            status = self.get_status(verbose=True)
-            mode = self.get_mode(verbose=True)
-            boot_in_progress = status & BOOTING_UP
-            time.sleep(timeout)
-        t1 = time.monotonic()
+        t3 = time.monotonic()
+        self.timings['bootup_powerup'] = t1 - t0
+        self.timings['bootup_check_regs'] = t2 - t1
+        self.timings['bootup_wait'] = t3 - t2
+        if not booted:
+            self.log(logging.WARNING, 'Bootup not complete after {:.0f} ms'.
+                     format(1.e3 * boot_timeout))
         self.log(logging.DEBUG, 'Bootup complete in {:.0f} ms'.
-                format(1.e3 * (t1-t0)))
+                format(1.e3 * (t3-t0)))
+        self.log(logging.DEBUG, '  powerup {:.1f} ms, check regs {:.1f} ms, '
+                 'wait {:.1f} ms'.format(1.e3 * (t1-t0), 1.e3 * (t2-t1),
+                                         1.e3 * (t3-t2)))
         # clear boot in progress flag as we're done with it
         status = status & (~BOOTING_UP & 0xFF)
         self.log(logging.DEBUG, 'Status: {}'.format(hex(status)))
         self.log(logging.DEBUG, 'Mode  : {}'.format(hex(mode)))
-#        mode = mode & no_header
         return status, mode
 
+    def _poll(self, read, done, timeout, interval=1.e-3, max_interval=0.05):
+        """
+        Call `read` until `done(value)` is true, or `timeout` expires.
+
+        The wait between reads starts at `interval` and doubles up to
+        `max_interval`, so that quick transitions are seen quickly while
+        slow ones do not flood the interface. Return (value, done).
+        """
+        deadline = time.monotonic() + timeout
+        value = read()
+        while not done(value):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return value, False
+            time.sleep(min(interval, remaining))
+            interval = min(2 * interval, max_interval)
+            value = read()
+        return value, True
+
     def error_handler(self, status, mode, verbose=False):
         """Attempt to bring the MI48 to a clean state.
 
@@ -298,6 +814,7 @@ class MI48:
             try:
                 self.log(logging.ERROR,
                     'SenXor Interface ERROR: Attempting SW reset of MI48')
+                self.invalidate_shadow()
                 self.reset()
             except TypeError:
                 # no reset handle provided
@@ -309,8 +826,8 @@ class MI48:
         status = self.get_status(verbose=True)
         return status, mode
 
-    def regread(self, reg):
-        """Read a control/status register; Allow hex or str for reg"""
+    def _reg_addr(self, reg):
+        """Return register address and name, given either one"""
         if isinstance(reg, str):
             regname = reg
             # Try to get the address value from the register map, but
@@ -324,7 +841,20 @@ class MI48:
         else:
             # assume integer; make up the hex representation for logging
             regname = f'0x{reg:02X}'
-        return self.interfaces[0].regread(reg, regname)
+        return reg, regname
+
+    def regread(self, reg):
+        """Read a control/status register; Allow hex or str for reg"""
+        reg, regname = self._reg_addr(reg)
+        if self._is_cached(reg):
+            self.shadow_hits += 1
+            return self._shadow_value(reg)
+        # queued writes must land before we read anything back
+        self.flush_batch()
+        self.shadow_misses += 1
+        value = self.interfaces[0].regread(reg, regname)
+        self._update_shadow(reg, value)
+        return value
 
     def regwrite(self, reg, value):
         """Write to a control register"""
@@ -333,10 +863,130 @@ class MI48:
             reg = regmap[regname]
         else:
             regname = ""
-        return self.interfaces[0].regwrite(reg, value, regname)
+        if self._batch is not None:
+            # the shadow is updated once flush_batch() has sent it
+            self._batch.append((reg, value))
+            if self._is_shadowed(reg, value):
+                self._batch_shadow.append((reg, value))
+            return None
+        try:
+            result = self.interfaces[0].regwrite(reg, value, regname)
+        except Exception:
+            # the device may or may not have taken the value
+            self.shadow.pop(reg, None)
+            raise
+        self._update_shadow(reg, value)
+        return result
+
+    def regread_many(self, regs):
+        """Read several registers with pipelined commands; return a list"""
+        addrs = [self._reg_addr(reg)[0] for reg in regs]
+        missing = [addr for addr in addrs if not self._is_cached(addr)]
+        self.shadow_hits += len(addrs) - len(missing)
+        fetched = {}
+        if missing:
+            self.flush_batch()
+            self.shadow_misses += len(missing)
+            values = self._transact([(addr, None) for addr in missing])
+            fetched = dict(zip(missing, values))
+            for addr, value in fetched.items():
+                self._update_shadow(addr, value)
+        return [fetched[addr] if addr in fetched else self._shadow_value(addr)
+                for addr in addrs]
+
+    def _is_cached(self, reg):
+        """True if the value of `reg` can be served from the shadow file"""
+        return reg in self.shadow and not self.user_flash
+
+    def _shadow_value(self, reg):
+        """Return the shadow value of `reg`, or its last queued write"""
+        for _reg, value in reversed(self._batch_shadow):
+            if _reg == reg:
+                return value
+        return self.shadow[reg]
+
+    def _is_shadowed(self, reg, value):
+        # while the user flash is enabled, low addresses refer to flash
+        return reg in CACHED_REGS and not self.user_flash and value is not None
+
+    def _update_shadow(self, reg, value):
+        if self._is_shadowed(reg, value):
+            self.shadow[reg] = value
+
+    def _written(self, reg, value):
+        """
+        Account for a register write made other than by regwrite(), e.g.
+        through the asyncio transport; `value` is None if it may or may
+        not have landed.
+        """
+        if value is None:
+            self.shadow.pop(reg, None)
+        else:
+            self._update_shadow(reg, value)
+
+    def invalidate_shadow(self):
+        """Forget the shadow register values, e.g. after a reset"""
+        self.shadow.clear()
 
+    def get_shadow_stats(self):
+        """Return hits and misses of the shadow register file"""
+        return {'hits': self.shadow_hits, 'misses': self.shadow_misses}
 
-    def read(self):
+    def _transact(self, registers):
+        """Pipelined register access if the interface supports it"""
+        interface = self.interfaces[0]
+        try:
+            return interface.transact(registers)
+        except AttributeError:
+            # e.g. I2C; fall back to one register at a time
+            return [interface.regread(reg) if value is None else
+                    interface.regwrite(reg, value) for reg, value in registers]
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Context in which register writes are queued and then sent with
+        pipelined commands, e.g.:
+
+            with mi48.batch():
+                mi48.set_fps(20)
+                mi48.set_filter_1(85)
+                mi48.set_offset_corr(0.0)
+
+        A register read within the context first sends the queued writes,
+        so read-modify-write sequences still see their own writes.
+        Writes still queued are dropped if the context exits on an error;
+        the shadow register file only takes values the device has
+        acknowledged.
+        """
+        if self._batch is not None:
+            # nested; the outer context sends everything
+            yield self
+            return
+        self._batch = []
+        try:
+            yield self
+            self.flush_batch()
+        finally:
+            self._batch = None
+            self._batch_shadow = []
+
+    def flush_batch(self):
+        """Send the register writes queued within batch()"""
+        if not self._batch:
+            return
+        writes, self._batch = self._batch, []
+        updates, self._batch_shadow = self._batch_shadow, []
+        try:
+            self._transact(writes)
+        except Exception:
+            # some of the writes may have landed; forget what we knew
+            for reg, value in writes:
+                self.shadow.pop(reg, None)
+            raise
+        self.shadow.update(updates)
+
+    def read(self, timeout=None):
         """Read a data frame
 
         Return the temperature data or (data, header), where the
@@ -344,17 +994,124 @@ class MI48:
         The returned data is a 2D array of np.float16 representing the
         temperature in Celsius.
         Header values if requested are also decoded from bytes.
+
+        If a background reader is running (see start()), the frame is
+        taken from its queue, waiting up to `timeout` seconds for one.
+        """
+        return self.parse_response(self._read_response(timeout))
+
+    def read_into(self, out, timeout=None):
+        """
+        Read a data frame into `out`, a caller-owned array.
+
+        `out` has the size of the data returned by read(), or the shape
+        (rows, cols), in which case the frame is oriented as by
+        utils.data_to_frame(). A float16 or float32 `out` receives the
+        temperature in Celsius, through a lookup table; a uint16 `out`
+        the raw data. Nothing is allocated per frame, other than what
+        the interface needs to read it and the header.
+
+        Return (out, header), or (None, None) if no frame was read.
+        """
+        data, header = self.split_response(self._read_response(timeout))
+        if data is None:
+            return None, None
+        self._convert_into(data, out)
+        return out, header
+
+    def read_frame(self, ring, timeout=None):
         """
+        Read a data frame into the next slot of `ring` (a FrameRing).
+
+        The header is stored in the frame record as native numbers; no
+        dictionary is made. The data type of the ring determines whether
+        the frame is stored raw (uint16) or in Celsius.
+
+        Return the frame record, a view into the ring, or None if no
+        frame was read.
+        """
+        data, words = self.split_response(self._read_response(timeout),
+                                          parse=False)
+        if data is None:
+            return None
+        # setting the fields one by one costs ~3 us each
+        if words is None:
+            ring.set_header((time.time(), 0, 0, 0, 0., 0., 0., 0., False))
+        else:
+            w = words[:SPIHDR_CRC + 1].tolist()
+            ring.set_header((time.time(),
+                             (w[SPIHDR_TIME + 1] << 16) + w[SPIHDR_TIME],
+                             w[SPIHDR_FRCNT],
+                             w[SPIHDR_CRC],
+                             w[SPIHDR_SXVDD] / 1.0e4,
+                             w[SPIHDR_SXTA] / 100. + KELVIN_0,
+                             w[SPIHDR_MAXV] / 10. + KELVIN_0,
+                             w[SPIHDR_MINV] / 10. + KELVIN_0,
+                             self.crc_error))
+        self._convert_into(data, ring.next_slot()['data'])
+        ring.commit()
+        return ring.latest()
+
+    def _convert_into(self, data, out):
+        """Write raw `data` into `out`, converting to its dtype"""
+        if out.ndim == 2:
+            data = data.reshape(self.fpa_shape, order='F').T
+        if out.dtype == np.uint16:
+            np.copyto(out, data)
+            return
+        # np.take would convert uint16 indices into a new intp array
+        if self.lut_index is None or self.lut_index.shape != out.shape:
+            self.lut_index = np.empty(out.shape, dtype=np.intp)
+        np.copyto(self.lut_index, data)
+        # mode='clip', else the output is buffered
+        np.take(celsius_lut(out.dtype), self.lut_index, out=out, mode='clip')
+
+    def _read_response(self, timeout=None):
+        """Return the next frame (raw, with header) from the interface"""
+        t0 = time.perf_counter()
+        try:
+            if self.reader is not None:
+                return self.frame_queue.get(timeout)
+            # The spi device must provide read(number-of-bytes) function
+            size = self.get_frame_size()
+            if not self.read_takes_out:
+                return self.interfaces[1].read(size)
+            if self.raw_buffer is None or len(self.raw_buffer) != size:
+                self.raw_buffer = np.empty(size, dtype=np.uint16)
+            return self.interfaces[1].read(size, out=self.raw_buffer)
+        finally:
+            self.t_read_wait += time.perf_counter() - t0
+
+    def get_frame_size(self):
+        """Return the number of words to read per frame, incl. header"""
         # figure out how many words to get; recall 2 bytes per pixel
-        data_size = np.prod(self.fpa_shape)
-        size_in_words = data_size
+        size_in_words = np.prod(self.fpa_shape)
         if not self.capture_no_header:
             size_in_words += self.cols
-        # print('Reading {} words'.format(size_in_words))
+        return size_in_words
 
-        # The spi device must provide read(number-of-bytes) function
-        response = self.interfaces[1].read(size_in_words)
+    def parse_response(self, response):
+        """Check the CRC of a frame read from the interface and decode it"""
+        data, header = self.split_response(response)
+        if data is None:
+            return None, None
+        # Once we have done the CRC check, convert to degrees C
+        # unless raw numbers are requested
+        if self.read_raw:
+            # the interface may return a view of its reusable buffer
+            return data.copy(), header
+        else:
+            # data[data < 20] = 0     # WE ADDED THIS
+            return celsius_lut(self.celsius_dtype).take(data), header
+
+    def split_response(self, response, parse=True):
+        """
+        Return the (raw data, header) of a frame; check the CRC.
 
+        The header is a dictionary (see parse_frame_header), or, if
+        `parse` is false, the raw header words.
+        """
+        data_size = np.prod(self.fpa_shape)
         # Obtain the data but do NOT convert to degrees C yet,
         # because we have to calculate CRC on it first.
         # Assume the interfaces[1].read() returns 16-bit integers
@@ -366,32 +1123,191 @@ class MI48:
             # if interface.read() yields None we've got an error
             return None, None
 
+        # frames from the background reader count from their arrival
+        if self.reader is not None and self.frame_queue.t_get is not None:
+            t = self.frame_queue.t_get
+        else:
+            t = time.monotonic()
         # Parse the optional header; else return the data
         # If the MI48 is not on the core-development board, do not parse
         if self.capture_no_header or not self.parse_header:
             header = None
+            self.stats.update(t, 2 * len(response))
         else:
             _header = response[:-data_size]
-            header = self.parse_frame_header(_header)
+            self.stats.update(t, 2 * len(response), int(_header[SPIHDR_FRCNT]),
+                              (int(_header[SPIHDR_TIME + 1]) << 16) +
+                              int(_header[SPIHDR_TIME]))
             self.crc_error = False
-            # check crc
-            # note that MI48 implements CRC-16/CCITT-FALSE which
-            # must be initialised with 0xFFFF
-            _crc = crc16(data)
-            if not header['crc'] == hex(_crc):
+            self.check_crc(data, int(_header[SPIHDR_CRC]))
+            header = self.parse_frame_header(_header) if parse else _header
+        return data, header
+
+    def get_stats(self):
+        """
+        Return the acquisition statistics since reset_stats() as a flat
+        dictionary of numbers, e.g. to log it or write it as a CSV row:
+
+            * fps, jitter_ms, interval_max_ms -- over the last frames
+              read, by host arrival time
+            * fps_mean, frames, bytes_per_s   -- since reset_stats()
+            * device_fps                      -- by the frame timestamps
+            * missed, gaps, missed_rate       -- frame counter gaps
+            * queue_dropped                   -- by the background reader
+            * crc_checked, crc_errors         -- see set_crc_policy()
+            * ack_errors, bytes_skipped       -- corrupted USB acknowledges
+            * read_wait                       -- s spent waiting in read()
+            * frame_ack_wait, command_ack_wait -- s spent waiting for
+              USB acknowledges of frames and of register commands
+
+        Counters of the interfaces and the frame queue are not reset by
+        reset_stats(); they count since they were created.
+        """
+        stats = self.stats.snapshot()
+        stats['queue_dropped'] = 0 if self.frame_queue is None else\
+                                 self.frame_queue.n_dropped
+        stats['crc_checked'] = self.n_crc_checked
+        stats['crc_errors'] = self.n_crc_errors
+        stats['read_wait'] = self.t_read_wait
+        stats['ack_errors'] = 0
+        stats['bytes_skipped'] = 0
+        stats['frame_ack_wait'] = 0.
+        stats['command_ack_wait'] = 0.
+        # the same interface may be used for both control and data
+        for interface in {id(i): i for i in self.interfaces}.values():
+            decoder = getattr(interface, 'decoder', None)
+            if decoder is not None:
+                stats['ack_errors'] += decoder.n_errors
+                stats['bytes_skipped'] += decoder.n_skipped
+            stats['frame_ack_wait'] += getattr(interface, 't_frame_ack', 0.)
+            stats['command_ack_wait'] +=\
+                getattr(interface, 't_command_ack', 0.)
+        return stats
+
+    def reset_stats(self):
+        """Restart the acquisition statistics, e.g. after set_fps()"""
+        self.stats.reset()
+        self.n_crc_checked = 0
+        self.n_crc_errors = 0
+        self.t_read_wait = 0.
+
+    def set_crc_policy(self, policy='every', sample_period=10):
+        """
+        Set which frames have their CRC checked against the header:
+
+            * 'every'   -- every frame, before read() returns it
+            * 'sampled' -- one frame in every `sample_period`
+            * 'thread'  -- every frame, but in a worker thread, so that
+                           read() does not wait for it; crc_error then
+                           flags the last error found, not the frame read
+            * 'off'     -- none
+
+        Checked frames and errors are counted in n_crc_checked and
+        n_crc_errors.
+        """
+        if policy not in CRC_POLICIES:
+            raise ValueError('CRC policy must be one of {}'.
+                             format(CRC_POLICIES))
+        if policy != 'thread':
+            self._stop_crc_worker()
+        if policy == 'thread' and self.crc_worker is None:
+            self.crc_queue = queue.Queue(maxsize=8)
+            self.crc_worker = threading.Thread(
+                target=self._crc_loop, name='{}-crc'.format(self.name),
+                daemon=True)
+            self.crc_worker.start()
+        self.crc_policy = policy
+        self.crc_sample_period = sample_period
+        self.log(logging.DEBUG, 'CRC policy: {}'.format(policy))
+
+    def check_crc(self, data, crc):
+        """Check `data` against `crc` according to the CRC policy"""
+        self.n_crc_frames += 1
+        if self.crc_policy == 'off':
+            return
+        if self.crc_policy == 'sampled' and\
+                self.n_crc_frames % self.crc_sample_period:
+            return
+        if self.crc_policy == 'thread':
+            try:
+                # the data may be a view of a buffer reused by the interface
+                self.crc_queue.put_nowait((data.copy(), crc))
+            except queue.Full:
+                # the worker is behind; skip this frame rather than wait
+                pass
+            return
+        self.crc_error = not self.verify_crc(data, crc)
+
+    def verify_crc(self, data, crc):
+        """Return True if the CRC of `data` matches `crc` (int)"""
+        # note that MI48 implements CRC-16/CCITT-FALSE which
+        # must be initialised with 0xFFFF
+        _crc = crc16_numpy(data)
+        self.n_crc_checked += 1
+        if not crc == _crc:
+            self.n_crc_errors += 1
+            self.log(logging.ERROR, 'Frame CRC error. '+
+                'Header CRC: {}, Data CRC: {}'.\
+                format(hex(crc), hex(_crc)))
+            return False
+        return True
+
+    def _stop_crc_worker(self):
+        if self.crc_worker is not None:
+            self.crc_queue.put(None)
+            self.crc_worker.join()
+            self.crc_worker = None
+
+    def _crc_loop(self):
+        """Check the CRC of frames queued by check_crc"""
+        while True:
+            item = self.crc_queue.get()
+            if item is None:
+                break
+            if not self.verify_crc(*item):
                 self.crc_error = True
-                self.log(logging.ERROR, 'Frame CRC error. '+
-                    'Header CRC: {}, Data CRC: {}'.\
-                    format(header['crc'], hex(_crc)))
 
-        # Once we have done the CRC check, convert to degrees C
-        # unless raw numbers are requested
-        if self.read_raw:
-            return data, header
-        else:
-            data = data / 10. + KELVIN_0
-            # data[data < 20] = 0     # WE ADDED THIS
-            return data.astype(np.float16), header
+    def _reader_loop(self, size_in_words):
+        """Move frames from the data interface to the frame queue"""
+        read = self.interfaces[1].read
+        if 'block' in inspect.signature(read).parameters:
+            # let the loop check for stop if the frames stop coming
+            read = functools.partial(read, block=False)
+        while not self._reader_stop.is_set():
+            try:
+                response = read(size_in_words)
+            except Exception as e:
+                # e.g. port closed under our feet
+                self.log(logging.ERROR, 'Background reader stopped: {}'.
+                         format(e))
+                break
+            if response is not None:
+                self.frame_queue.put(response)
+
+    def start_reader(self, queue_size=2, policy='keep_latest'):
+        """Start a thread reading frames into a bounded frame queue"""
+        if self.reader is not None:
+            return
+        self.frame_queue = FrameQueue(queue_size, policy)
+        self._reader_stop = threading.Event()
+        self.reader = threading.Thread(target=self._reader_loop,
+                                       args=(self.get_frame_size(),),
+                                       name='{}-reader'.format(self.name),
+                                       daemon=True)
+        self.reader.start()
+        self.log(logging.DEBUG, 'Background reader started ({}, {} frames)'.
+                 format(policy, queue_size))
+
+    def stop_reader(self, timeout=1.0):
+        """Stop the background reader thread, if running"""
+        if self.reader is None:
+            return
+        self._reader_stop.set()
+        self.reader.join(timeout)
+        self.reader = None
+        self.log(logging.DEBUG, 'Background reader stopped; {} frames '
+                 'received, {} dropped'.format(self.frame_queue.n_put,
+                                               self.frame_queue.n_dropped))
 
     def has_evk_bridge(self):
         """
@@ -409,6 +1325,8 @@ class MI48:
 
     def powerup(self):
         """Read calibration data from flash, and initialise SenXor"""
+        # registers are reloaded by the power-up
+        self.invalidate_shadow()
         self.regwrite('SENXOR_POWERUP', 0x13)
         time.sleep(0.1)
 
@@ -494,24 +1412,32 @@ class MI48:
         return self.regread('FILTER_2')
 
     def get_camera_info(self):
-        """Get camera info: senxor type/ID, maxFPS, FW version"""
+        """Get camera info: senxor type/ID, maxFPS, FW version
+
+        The registers identifying the camera are read with one pipelined
+        transaction.
+        """
         try:
             return self.camera_info
         except AttributeError:
             # if we haven't yet read the info from camera module
             pass
         # read camera module info
-        res = {}
-        self.camera_info = res
-        res['NAME'] = self.name
-        res['CAMERA_TYPE'] = self.get_camera_type()
-        res['MODULE_TYPE'] = self.get_module_type()
-        res['EVK_ID'] = self.get_evk_socket_id()
-        uid, uid_hex, uid_hexsn = self.get_camera_id()
+        ident = dict(zip(CAMERA_IDENT_REGS,
+                         self.regread_many(CAMERA_IDENT_REGS)))
+        uid = [ident['SENXOR_ID_{}'.format(i)]
+               for i in range(MI48_SENXOR_ID_LEN)]
+        uid, uid_hex, uid_hexsn = format_camera_id(uid)
+        res = {'NAME': self.name}
+        res['CAMERA_TYPE'] = ident['SENXOR_TYPE']
+        res['MODULE_TYPE'] = ident['MODULE_TYPE']
+        res['EVK_ID'] = ident['EVK_ID']
         res['CAMERA_ID'] = uid_hex
         res['CAMERA_MFG'] = uid_hexsn
         res['SN'] = 'SN'+uid_hex
-        res['FW_VERSION'] = self.get_fw_version()
+        res['FW_VERSION'] = format_fw_version(ident['FW_VERSION_1'],
+                                              ident['FW_VERSION_2'])
+        self.camera_info = res
         self.camera_type = res['CAMERA_TYPE']
         self.module_type = res['MODULE_TYPE']
         self.camera_name = SENXOR_NAME[self.camera_type]
@@ -524,6 +1450,13 @@ class MI48:
         self.fw_version = res['FW_VERSION']
         res['MAX_FPS'] = self.get_max_fps()
         self.maxfps = res['MAX_FPS']
+        if self.param_cache is not None:
+            # written only once there are parameters to keep
+            entry = self.param_cache.load(self.camera_id, ident.values())
+            if entry is None:
+                entry = {'ident': list(ident.values()),
+                         'compensation_params': {}}
+            self.param_cache_entry = entry
         # note that current FPS requires self.maxfps, 
         # becuase we can only read the divisor
         res['Current FPS'] = self.get_fps()
@@ -531,10 +1464,9 @@ class MI48:
 
     def get_ctrl_stat_regs(self):
         """Read all registers, return a dictionary {'RegName': 0xValue}"""
-        res = {}
         self.log(logging.DEBUG, 'Reading Control and Status Regs:')
-        for reg in list(DEFAULT_CTRL_STAT.keys()):
-            res[reg] = self.regread(reg)
+        regs = list(DEFAULT_CTRL_STAT.keys())
+        res = dict(zip(regs, self.regread_many(regs)))
         return res
 
     def check_ctrl_stat_regs(self, expect=None):
@@ -592,6 +1524,41 @@ class MI48:
         self.regwrite('FRAME_RATE', fps_divisor)
         return None
 
+    def configure(self, fps=None, emissivity=None, sens_factor=None,
+                  offset_corr=None, filter_1=None, filter_2=None,
+                  filters=None):
+        """
+        Change several settings at once; settings left None are kept.
+
+        `filters` is a dict of the flags of enable_filter(), e.g.
+        {'f1': True, 'f3': True}; the filters not enabled by it are
+        disabled.
+
+        The register writes are pipelined (see batch()), and may be done
+        while streaming, without stop_capture() and start(): frames that
+        arrive over USB while waiting for the acknowledges are kept for
+        read(), or go to the frame queue of the background reader.
+        """
+        with self.batch():
+            if fps is not None:
+                self.set_fps(fps)
+            if emissivity is not None:
+                self.set_emissivity(emissivity)
+            if sens_factor is not None:
+                self.set_sens_factor(sens_factor)
+            if offset_corr is not None:
+                self.set_offset_corr(offset_corr)
+            if filter_1 is not None:
+                self.set_filter_1(filter_1)
+            if filter_2 is not None:
+                self.set_filter_2(filter_2)
+            if filters is not None:
+                self.disable_filter(**{f: not filters.get(f, False)
+                                       for f in ('f1', 'f2', 'f3')})
+                if any(filters.values()):
+                    self.enable_filter(**filters)
+        return None
+
     def set_emissivity(self, emissivity):
         """Set emissivity, given in integer % (1-100) or float (0-1)"""
         if emissivity > 100 or emissivity <= 0:
@@ -631,20 +1598,26 @@ class MI48:
             fctrl |= 0x40  # bit 6
         if f3_ks_5:
             fctrl |= 0x20  # bit 5
+        # the register reads below are only for logging; skip them
+        # unless they would be logged, as each is a USB round trip
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
         msg = "Enabling"
-        if fctrl & 0x01:
+        if fctrl & 0x01 and debug:
             fset1 = self.get_filter_1()
             msg += ' Filter 1 ({})'.format(hex(fset1))
-        if fctrl & 0x04:
+        if fctrl & 0x04 and debug:
             fset2 = self.get_filter_2()
             msg += ' Filter 2 ({})'.format(hex(fset2))
         if fctrl & 0x40:
             msg += ' Filter 3 ({})'.format(hex(fctrl & 0x20))
         self.log(logging.DEBUG, msg)
         self.regwrite('FILTER_CTRL', fctrl)
+        # give the filter time to initialise after the write is sent
+        self.flush_batch()
         time.sleep(40.e-3)
-        self.log(logging.DEBUG, 'FILTER_CONTROL {}'.format(
-                 hex(self.get_filter_ctrl())))
+        if debug:
+            self.log(logging.DEBUG, 'FILTER_CONTROL {}'.format(
+                     hex(self.get_filter_ctrl())))
         #return self.regread('FILTER_CTRL')
         return None
 
@@ -668,8 +1641,10 @@ class MI48:
             msg += ' Filter 3'
         self.log(logging.DEBUG, msg)
         self.regwrite('FILTER_CTRL', fctrl)
-        self.log(logging.DEBUG, 'FILTER_CONTROL {}'.format(
-                 hex(self.get_filter_ctrl())))
+        # read back only for logging; see enable_filter()
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            self.log(logging.DEBUG, 'FILTER_CONTROL {}'.format(
+                     hex(self.get_filter_ctrl())))
         return None
 
     def get_filter_1(self):
@@ -736,32 +1711,24 @@ class MI48:
         uid = []
         for i in range(0, MI48_SENXOR_ID_LEN):
             uid.append(self.regread('SENXOR_ID_{}'.format(i)))
-        uid_hex = bytearray(uid).hex()
-        year = 2000 + uid[0]
-        week = uid[1]
-        fab  = uid[2]
-        sernum_hex = bytearray(uid[3:]).hex()
-        sernum = (uid[3] << 16) + (uid[4] << 8) + uid[5]
-        uid = '{}.{}.{}.{}'.format(year, week, fab, sernum)
-        uid_hexsn = '{}.{}.{}.{}'.format(year, week, fab, sernum_hex)
-        return uid, uid_hex, uid_hexsn
+        return format_camera_id(uid)
 
     def get_fw_version(self):
         """Get maj.min.build of EVK FW; return as a string"""
         fwv = self.regread('FW_VERSION_1')
         fwb = self.regread('FW_VERSION_2')
-        fwv_major = (fwv >> 4) & 0xF
-        fwv_minor = fwv & 0xF
-        fwv_build = fwb
-        return '{}.{}.{}'.format(fwv_major, fwv_minor, fwv_build)
+        return format_fw_version(fwv, fwb)
 
     def enable_user_flash(self):
         self.regwrite('FLASH_CTRL', 0x01)
+        self.user_flash = True
 
     def disable_user_flash(self):
         self.regwrite('FLASH_CTRL', 0x00)
+        self.user_flash = False
 
-    def get_compensation_params(self, npar=4, base_addr=0):
+    def get_compensation_params(self, npar=4, base_addr=0, interval=0.,
+                                use_cache=True):
         """
         Read the compensation parameters stored in the MI48 flash.
 
@@ -770,20 +1737,41 @@ class MI48:
         The parameters are stored at `base_addr` in the user
         flash space, using little-endian order, i.e.  LSB to 0x00 etc.,
         in the form of 4--byte IEEE-754 numbers.
+
+        All bytes are read with one pipelined transaction, within
+        enable_user_flash()/disable_user_flash() unless the user flash
+        is already enabled. A positive `interval` [s] reads one byte at
+        a time instead, pausing in between, as for an MI48 firmware
+        that needs the pacing.
+        The parameters are kept in the compensation cache, if any, and
+        read from there unless `use_cache` is False.
         """
-        params = []
-        for i in range(npar):
-            # Parameters are stored as IEEE-754 floats, i.e. 4-bytes,
-            # little endian.
-            # When we read the MI48 we get back unsigned int for each
-            # byte.
-            int_list = []
-            for j in range(4):
-                flash_addr = base_addr + 4 * i + j
-                int_list.append(self.regread(flash_addr))
-                time.sleep(1)
-            byte_array = array.array('B', int_list)
-            params.append(struct.unpack('<f', byte_array)[0])
+        key = '{}:{}'.format(base_addr, npar)
+        cached = self._cached_compensation_params()
+        if use_cache and key in cached:
+            return list(cached[key])
+        addrs = range(base_addr, base_addr + 4 * npar)
+        was_enabled = self.user_flash
+        if not was_enabled:
+            self.enable_user_flash()
+        try:
+            if interval > 0:
+                int_list = []
+                for flash_addr in addrs:
+                    int_list.append(self.regread(flash_addr))
+                    time.sleep(interval)
+            else:
+                int_list = self.regread_many(addrs)
+        finally:
+            if not was_enabled:
+                self.disable_user_flash()
+        # Parameters are stored as IEEE-754 floats, i.e. 4-bytes,
+        # little endian.
+        # When we read the MI48 we get back unsigned int for each
+        # byte.
+        byte_array = array.array('B', int_list)
+        params = list(struct.unpack('<{}f'.format(npar), byte_array))
+        self._cache_compensation_params(key, params)
         return params
 
     def store_compensation_params(self, params, base_addr=0, timeout=0.5):
@@ -794,16 +1782,47 @@ class MI48:
         a 4-byte IEEE-754 representation and stored in sequence,
         starting from `base_addr` in the user flash space, using
         little-endian order, i.e.  LSB to `base_addr`
+        The user flash is enabled for the writes, as by
+        get_compensation_params().
         """
-        for i, p in enumerate(params):
-            byte_array = struct.pack('<f', p)
-            int_list = list(byte_array)
-            assert len(list(byte_array)) == 4
-            for j, uint8 in enumerate(int_list):
-                flash_addr = base_addr + 4 * i + j
-                self.regwrite(flash_addr, uint8)
-                # writing to a flash memory; not sure of the speed
-                time.sleep(timeout)
+        was_enabled = self.user_flash
+        if not was_enabled:
+            self.enable_user_flash()
+        try:
+            for i, p in enumerate(params):
+                byte_array = struct.pack('<f', p)
+                int_list = list(byte_array)
+                assert len(list(byte_array)) == 4
+                for j, uint8 in enumerate(int_list):
+                    flash_addr = base_addr + 4 * i + j
+                    self.regwrite(flash_addr, uint8)
+                    # writing to a flash memory; not sure of the speed
+                    time.sleep(timeout)
+        finally:
+            if not was_enabled:
+                self.disable_user_flash()
+        # cached parameters overlapping the ones written are stale now
+        cached = self._cached_compensation_params()
+        end = base_addr + 4 * len(params)
+        for key in list(cached):
+            addr, npar = map(int, key.split(':'))
+            if addr < end and base_addr < addr + 4 * npar:
+                del cached[key]
+        # as float32, i.e. as they will be read back
+        fmt = '<{}f'.format(len(params))
+        self._cache_compensation_params('{}:{}'.format(base_addr, len(params)),
+            list(struct.unpack(fmt, struct.pack(fmt, *params))))
+
+    def _cached_compensation_params(self):
+        if self.param_cache_entry is None:
+            return {}
+        return self.param_cache_entry['compensation_params']
+
+    def _cache_compensation_params(self, key, params):
+        if self.param_cache_entry is None:
+            return
+        self.param_cache_entry['compensation_params'][key] = params
+        self.param_cache.store(self.camera_id, self.param_cache_entry)
 
     def parse_frame_header(self, header: list):
         """
@@ -815,16 +1834,23 @@ class MI48:
         result['frame_counter']         = header[SPIHDR_FRCNT]
         result['senxor_vdd']            = header[SPIHDR_SXVDD] / 1.0e4
         result['senxor_temperature']    = header[SPIHDR_SXTA] / 100. + KELVIN_0
-        result['timestamp']             = (header[SPIHDR_TIME + 1] << 16) +\
-                                          header[SPIHDR_TIME]
+        # int(), lest the shift overflow the uint16 header words
+        result['timestamp']             = (int(header[SPIHDR_TIME + 1]) << 16) +\
+                                          int(header[SPIHDR_TIME])
         result['pixel_max']             = header[SPIHDR_MAXV] / 10. + KELVIN_0
         result['pixel_min']             = header[SPIHDR_MINV] / 10. + KELVIN_0
         result['crc']                   = hex(header[SPIHDR_CRC])
         return result
 
-    def start(self, stream=True, with_header=True):
+    def start(self, stream=True, with_header=True, background=False,
+              queue_size=2, policy='keep_latest'):
         """
         Start capture.
+
+        If `background` is true (and `stream` too), frames are read by a
+        dedicated thread into a bounded queue of `queue_size` frames, so
+        that read() returns the freshest frame without waiting on the
+        interface. See FrameQueue for the meaning of `policy`.
         """
         mode = 0
         if stream:
@@ -841,11 +1867,80 @@ class MI48:
         self.capture_no_header = (not with_header)
         #
         self.regwrite('FRAME_MODE', mode)
+        if stream and background:
+            self.start_reader(queue_size, policy)
+        return None
+
+    def trigger(self):
+        """
+        Request a single frame, to be read with read(), read_into() or
+        read_frame(); for triggered acquisition, e.g.:
+
+            mi48.start(stream=False)      # the first frame is requested
+            while True:
+                data, header = mi48.read()
+                ...
+                mi48.trigger()            # request the next one
+
+        Each frame then is acquired when it is asked for, instead of
+        streamed at the frame rate and mostly thrown away. Over USB, the
+        request is sent without waiting for its acknowledge, so it costs
+        no round trip; over other control interfaces it is a regwrite.
+        """
+        mode = GET_SINGLE_FRAME
+        if self.capture_no_header:
+            mode = mode | NO_HEADER
+        interface = self.interfaces[0]
+        try:
+            interface.post(regmap['FRAME_MODE'], mode, 'FRAME_MODE')
+        except AttributeError:
+            interface.regwrite(regmap['FRAME_MODE'], mode, 'FRAME_MODE')
         return None
 
+    async def stream(self, with_header=True, queue_size=2):
+        """
+        Start continuous capture and yield (data, header) as frames arrive.
+
+        Usage, within a running asyncio event loop:
+
+            async for data, header in mi48.stream():
+                ...
+
+        The data interface must be a USB_Interface; it is watched by the
+        event loop (see AsyncUSBTransport), so no thread is blocked while
+        waiting for frames. Capture is stopped when the generator is
+        closed; use contextlib.aclosing() to do that as soon as the loop
+        is left with break.
+        """
+        # interfaces imports from this module, hence the late import
+        from senxor.interfaces import AsyncUSBTransport
+        transport = AsyncUSBTransport(self.interfaces[1], maxsize=queue_size,
+                                      on_regwrite=self._written)
+        self.start(stream=True, with_header=with_header)
+        transport.open()
+        self.transport = transport
+        try:
+            size_in_words = self.get_frame_size()
+            while True:
+                response = await transport.read(size_in_words)
+                yield self.parse_response(response)
+        finally:
+            transport.close()
+            self.transport = None
+            # there is no one left to tell if the port is gone
+            if transport.error is None:
+                self.stop_capture()
+
     def stop_capture(self, verbose=True, poll_timeout=0.1,
                      stop_timeout=0.3):
-        """Stop capture; currently clears the FRAME_MODE register."""
+        """Stop capture; currently clears the FRAME_MODE register.
+
+        FRAME_MODE is polled with exponential backoff, starting at 1 ms,
+        up to `poll_timeout` between polls and `stop_timeout` in total.
+        """
+        t0 = time.monotonic()
+        # the interface must be ours again for the register access
+        self.stop_reader()
         # Attempt to stop capture; do not tamper with other bits except
         # the ones for initiating/stopping data acquisition
         mode = self.get_mode()
@@ -854,23 +1949,40 @@ class MI48:
             return None
         _mode = mode & (~(GET_SINGLE_FRAME | CONTINUOUS_STREAM) & 0xFF)
         # self.log(logging.DEBUG, 'Writing 0x{:02X}'.format(_mode))
+        # While streaming, the acknowledge of this write is picked out of
+        # the incoming GFRA stream, and capture has stopped once we have
+        # it, so normally the first poll below confirms the stop.
+        t1 = time.monotonic()
         self.regwrite('FRAME_MODE', _mode)
-        t0 = time.time()
-        delay = 0
-        while mode & (GET_SINGLE_FRAME | CONTINUOUS_STREAM) != 0x00:
-            mode = self.get_mode(verbose)
-            if mode is None:
-                self.log(logging.DEBUG, 'Lost access to camera interface.')
-                return None
-            time.sleep(poll_timeout)  # in ms
-            delay = time.time() - t0
-            if delay > stop_timeout:  # in ms
-                self.log(logging.DEBUG,
-                         'Camera module failed to stop in {:.0f} ms'.\
-                         format(1.e3 * stop_timeout))
-                return mode
-        self.log(logging.DEBUG, 'Camera module stopped in {:.0f} ms.'.
-            format(1.e3 * delay))
+        t2 = time.monotonic()
+        capturing = GET_SINGLE_FRAME | CONTINUOUS_STREAM
+        mode, stopped = self._poll(lambda: self.get_mode(verbose),
+                                  lambda mode: mode is None or
+                                               not mode & capturing,
+                                  timeout=stop_timeout,
+                                  max_interval=poll_timeout)
+        t3 = time.monotonic()
+        # frames that came in with the acknowledges above are stale now
+        for intface in self.interfaces:
+            try:
+                intface.clear_kept_frames()
+            except AttributeError:
+                pass
+        self.timings['stop_reader'] = t1 - t0
+        self.timings['stop_write'] = t2 - t1
+        self.timings['stop_confirm'] = t3 - t2
+        if mode is None:
+            self.log(logging.DEBUG, 'Lost access to camera interface.')
+            return None
+        if not stopped:
+            self.log(logging.DEBUG,
+                     'Camera module failed to stop in {:.0f} ms'.\
+                     format(1.e3 * stop_timeout))
+            return mode
+        self.log(logging.DEBUG, 'Camera module stopped in {:.1f} ms '
+                 '(reader {:.1f} ms, write {:.1f} ms, confirm {:.1f} ms).'.
+                 format(1.e3 * (t3-t0), 1.e3 * (t1-t0), 1.e3 * (t2-t1),
+                        1.e3 * (t3-t2)))
         return mode
 
     def clear_interface_buffers(self):
@@ -896,6 +2008,7 @@ class MI48:
         self.log(logging.DEBUG, 'Closing host interfaces')
         self.clear_interface_buffers()
         self.close_interfaces()
+        self._stop_crc_worker()
         return None
 
     def __repr__(self):
@@ -913,6 +2026,25 @@ def get_reg_name(addr):
         if val == addr: return key
     return 'Unknown reg: 0x{:02X}'.format(addr)
 
+def format_camera_id(uid):
+    """Return the SenXor ID bytes as (Year.Week.Fab.SerNum, hex, hexsn)"""
+    uid_hex = bytearray(uid).hex()
+    year = 2000 + uid[0]
+    week = uid[1]
+    fab  = uid[2]
+    sernum_hex = bytearray(uid[3:]).hex()
+    sernum = (uid[3] << 16) + (uid[4] << 8) + uid[5]
+    uid = '{}.{}.{}.{}'.format(year, week, fab, sernum)
+    uid_hexsn = '{}.{}.{}.{}'.format(year, week, fab, sernum_hex)
+    return uid, uid_hex, uid_hexsn
+
+def format_fw_version(fwv, fwb):
+    """Return the FW_VERSION_1/2 register values as 'maj.min.build'"""
+    fwv_major = (fwv >> 4) & 0xF
+    fwv_minor = fwv & 0xF
+    fwv_build = fwb
+    return '{}.{}.{}'.format(fwv_major, fwv_minor, fwv_build)
+
 def format_header(hdr):
     """Format frame header to represent in log messages"""
     s = "FID{:6d}  time{:8d}  V_dd {:5.3f}  T_SX {:5.2f}".\
@@ -921,6 +2053,16 @@ def format_header(hdr):
     s += '\n'
     return s
 
+def format_stats(stats):
+    """Format acquisition statistics (MI48.get_stats) for log messages"""
+    s = "FPS {:5.1f} (device {:5.1f})  jitter {:5.1f} ms  max {:6.1f} ms  "\
+        "missed {:d} ({:.2%})  CRC errors {:d}/{:d}  {:6.1f} kB/s".\
+        format(stats['fps'], stats['device_fps'], stats['jitter_ms'],
+               stats['interval_max_ms'], stats['missed'],
+               stats['missed_rate'], stats['crc_errors'],
+               stats['crc_checked'], 1.e-3 * stats['bytes_per_s'])
+    return s
+
 def format_framestats(data):
     """Format data frame stats to represent in log messages"""
     s = "Min {:6.1f}   Max {:6.1f}  Avg {:5.1f}  Std {:3.1f}".\
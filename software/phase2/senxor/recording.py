@@ -0,0 +1,281 @@
+# Recording and replay of thermal frames in a fixed-stride binary format.
+#
+# A recording is a pair of files:
+#
+#   <name>.sxr  -- a 64-byte preamble, followed by one record per frame,
+#                  holding the frame header fields and the raw frame
+#                  (uint16, deci-Kelvin) as rows x cols
+#   <name>.sxi  -- the index: host time, MI48 timestamp and frame counter
+#                  of every frame, 16 bytes each, so that seeking by time
+#                  does not have to touch the frames
+#
+# Both files are appended to frame by frame, and read back with np.memmap,
+# so that random access is O(1) and slices of frames are views of the file.
+import os
+import time
+import logging
+import numpy as np
+
+from senxor.mi48 import KELVIN_0
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SXREC\x00\x00\x00'
+VERSION = 1
+
+PREAMBLE_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u2'),
+    ('ncols', '<u2'),
+    ('nrows', '<u2'),
+    ('reserved', 'V50'),
+])
+
+INDEX_DTYPE = np.dtype([
+    ('host_time', '<f8'),           # time.time() at write
+    ('timestamp', '<u4'),           # MI48 timestamp [ms]
+    ('frame_counter', '<u4'),
+])
+
+
+def record_dtype(fpa_shape):
+    """Return the dtype of one frame record, for an FPA of (ncols, nrows)"""
+    ncols, nrows = fpa_shape
+    return np.dtype([
+        ('host_time', '<f8'),
+        ('timestamp', '<u4'),
+        ('frame_counter', '<u4'),
+        ('senxor_vdd', '<f4'),          # V
+        ('senxor_temperature', '<f4'),  # Celsius
+        ('crc', '<u2'),
+        ('crc_error', '<u2'),
+        ('reserved', '<u4'),
+        ('data', '<u2', (nrows, ncols)),
+    ])
+
+
+def index_filename(filename):
+    return os.path.splitext(filename)[0] + '.sxi'
+
+
+def read_preamble(filename):
+    """Return the preamble of a recording; raise ValueError if it is not one"""
+    preamble = np.fromfile(filename, PREAMBLE_DTYPE, count=1)
+    if len(preamble) == 0 or preamble[0]['magic'] != MAGIC.rstrip(b'\x00'):
+        raise ValueError('{} is not a SenXor recording'.format(filename))
+    if preamble[0]['version'] != VERSION:
+        raise ValueError('{} is a recording of version {}, not {}'.format(
+            filename, preamble[0]['version'], VERSION))
+    return preamble[0]
+
+
+class Recorder:
+    """
+    Append frames, as returned by MI48.read(), to a recording.
+
+    Usage:
+
+        with Recorder(get_default_outfile(mi48.name, ext='sxr'),
+                      mi48.fpa_shape) as rec:
+            while ...:
+                data, header = mi48.read()
+                rec.write(data, header, crc_error=mi48.crc_error)
+                # or, without the header dictionary:
+                # rec.write_frame(mi48.read_frame(ring))
+
+    Frames may be raw (read_raw=True) or in Celsius; the latter are
+    converted back to deci-Kelvin, which is exact for float32 data, and
+    for the float16 data of MI48.read() up to 128 Celsius.
+    An existing recording of the same FPA shape is appended to, after
+    dropping a partial record (e.g. the recorder was killed) and bringing
+    the index in line with the records.
+    """
+    def __init__(self, filename, fpa_shape=(80, 62)):
+        self.filename = filename
+        self.fpa_shape = tuple(fpa_shape)
+        self.dtype = record_dtype(fpa_shape)
+        # one preallocated record and index entry, reused for every frame
+        self.record = np.zeros(1, dtype=self.dtype)
+        self.entry = np.zeros(1, dtype=INDEX_DTYPE)
+        new = not os.path.exists(filename) or os.path.getsize(filename) == 0
+        if new:
+            self.file = open(filename, 'ab')
+            preamble = np.zeros(1, dtype=PREAMBLE_DTYPE)
+            preamble['magic'] = MAGIC
+            preamble['version'] = VERSION
+            preamble['ncols'], preamble['nrows'] = self.fpa_shape
+            self.file.write(preamble.tobytes())
+            self.n_frames = 0
+            self.index = open(index_filename(filename), 'wb')
+            return
+        preamble = read_preamble(filename)
+        if (preamble['ncols'], preamble['nrows']) != self.fpa_shape:
+            raise ValueError('{} is a recording of FPA shape {}'.format(
+                filename, (preamble['ncols'], preamble['nrows'])))
+        self.n_frames = (os.path.getsize(filename) -
+                         PREAMBLE_DTYPE.itemsize) // self.dtype.itemsize
+        self._truncate()
+        self.file = open(filename, 'ab')
+        self.index = open(index_filename(filename), 'ab')
+
+    def _truncate(self):
+        """Cut the recording and its index to the whole records in it"""
+        size = PREAMBLE_DTYPE.itemsize + self.n_frames * self.dtype.itemsize
+        if os.path.getsize(self.filename) > size:
+            logger.warning('Dropping a partial record from {}'.format(
+                self.filename))
+            os.truncate(self.filename, size)
+        idxname = index_filename(self.filename)
+        n_index = 0
+        if os.path.exists(idxname):
+            n_index = min(os.path.getsize(idxname) // INDEX_DTYPE.itemsize,
+                          self.n_frames)
+        with open(idxname, 'ab') as index:
+            index.truncate(n_index * INDEX_DTYPE.itemsize)
+            if n_index < self.n_frames:
+                logger.warning('Rebuilding the index of {}'.format(
+                    self.filename))
+                records = np.memmap(self.filename, dtype=self.dtype, mode='r',
+                                    offset=PREAMBLE_DTYPE.itemsize,
+                                    shape=(self.n_frames,))[n_index:]
+                entries = np.zeros(len(records), dtype=INDEX_DTYPE)
+                for name in INDEX_DTYPE.names:
+                    entries[name] = records[name]
+                index.write(entries.tobytes())
+                del records
+
+    def write(self, data, header=None, crc_error=False, host_time=None):
+        """Append a frame (1-D as from MI48.read) and its header (dict)"""
+        rec = self.record[0]
+        rec['host_time'] = time.time() if host_time is None else host_time
+        if header is not None:
+            rec['timestamp'] = header['timestamp']
+            rec['frame_counter'] = header['frame_counter']
+            rec['senxor_vdd'] = header['senxor_vdd']
+            rec['senxor_temperature'] = header['senxor_temperature']
+            rec['crc'] = int(header['crc'], 16)
+        else:
+            for name in ('timestamp', 'frame_counter', 'senxor_vdd',
+                         'senxor_temperature', 'crc'):
+                rec[name] = 0
+        rec['crc_error'] = crc_error
+        # the EVK sends columns first; see utils.data_to_frame
+        self._write_data(np.reshape(data, self.fpa_shape, order='F').T)
+
+    def write_frame(self, frame):
+        """Append a frame record, as returned by MI48.read_frame()"""
+        rec = self.record[0]
+        for name in ('host_time', 'timestamp', 'frame_counter', 'senxor_vdd',
+                     'senxor_temperature', 'crc', 'crc_error'):
+            rec[name] = frame[name]
+        self._write_data(frame['data'])
+
+    def _write_data(self, frame):
+        rec = self.record[0]
+        if frame.dtype == np.uint16:
+            rec['data'] = frame
+        else:
+            rec['data'] = np.rint((frame.astype(np.float32) - KELVIN_0) * 10)
+        self.file.write(self.record.data)
+        for name in INDEX_DTYPE.names:
+            self.entry[name] = rec[name]
+        self.index.write(self.entry.data)
+        self.n_frames += 1
+
+    def flush(self):
+        self.file.flush()
+        self.index.flush()
+
+    def close(self):
+        self.file.close()
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Recording:
+    """
+    Read-only, memory-mapped access to a recording.
+
+    Indexing returns records (a structured array, or a single record);
+    the fields can be taken from them, or from the whole recording:
+
+        rec = Recording('cam0-20240101-120000.sxr')
+        rec.frames[1000:2000]   # (1000, rows, cols) uint16, no copy
+        rec[i]['frame_counter']
+        rec.celsius(i)          # frame i in Celsius
+        rec.between(t0, t1)     # slice of frames by host time
+
+    Nothing is read from disk until accessed. If the index is missing, or
+    shorter than the recording (e.g. the recorder was killed), it is
+    rebuilt from the records.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        preamble = read_preamble(filename)
+        self.fpa_shape = (int(preamble['ncols']), int(preamble['nrows']))
+        self.dtype = record_dtype(self.fpa_shape)
+        n_frames = (os.path.getsize(filename) - PREAMBLE_DTYPE.itemsize) //\
+                   self.dtype.itemsize
+        if n_frames > 0:
+            self.records = np.memmap(filename, dtype=self.dtype, mode='r',
+                                     offset=PREAMBLE_DTYPE.itemsize,
+                                     shape=(n_frames,))
+        else:
+            self.records = np.zeros(0, dtype=self.dtype)
+        self.index = self._load_index(n_frames)
+
+    def _load_index(self, n_frames):
+        idxname = index_filename(self.filename)
+        n_index = 0
+        if os.path.exists(idxname):
+            n_index = os.path.getsize(idxname) // INDEX_DTYPE.itemsize
+        if n_frames == 0:
+            return np.zeros(0, dtype=INDEX_DTYPE)
+        if n_index < n_frames:
+            logger.warning('Rebuilding the index of {}'.format(self.filename))
+            index = np.zeros(n_frames, dtype=INDEX_DTYPE)
+            for name in INDEX_DTYPE.names:
+                index[name] = self.records[name]
+            return index
+        return np.memmap(idxname, dtype=INDEX_DTYPE, mode='r',
+                         shape=(n_frames,))
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, key):
+        return self.records[key]
+
+    @property
+    def frames(self):
+        """All frames, raw, as an (n_frames, rows, cols) view of the file"""
+        return self.records['data']
+
+    @property
+    def host_time(self):
+        return self.index['host_time']
+
+    @property
+    def timestamp(self):
+        return self.index['timestamp']
+
+    @property
+    def frame_counter(self):
+        return self.index['frame_counter']
+
+    def celsius(self, key, dtype=np.float32):
+        """Return frame(s) `key` in Celsius"""
+        return self.frames[key].astype(dtype) / 10 + KELVIN_0
+
+    def find(self, host_time):
+        """Return the index of the first frame recorded at or after host_time"""
+        return int(np.searchsorted(self.index['host_time'], host_time))
+
+    def between(self, t0, t1):
+        """Return the records of the frames recorded in [t0, t1)"""
+        return self.records[self.find(t0): self.find(t1)]
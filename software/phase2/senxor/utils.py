@@ -13,7 +13,7 @@ import cv2 as cv
 import cmapy
 from serial.tools import list_ports
 from serial import Serial, SerialException
-from senxor.mi48 import MI48
+from senxor.mi48 import MI48, raw_threshold
 from senxor.interfaces import MI_VID, MI_PIDs, USB_Interface
 
 list_ironbow_b = [0,6,12,18,27,38,49,59,64,68,73,78,82,86,90,94,98,102,105,109,112,115,119,122,124,127,129,132,134,136,138,140,142,145,147,148,150,151,152,153,154,155,157,158,159,160,161,163,163,164,165,166,166,167,167,167,167,167,166,166,166,165,165,165,165,164,164,164,163,162,161,160,160,160,158,157,156,155,153,152,151,150,148,147,146,145,143,142,141,140,138,136,134,132,130,127,125,123,121,119,118,116,114,112,110,108,106,104,102,100,98,96,94,92,90,88,86,84,82,80,78,75,73,71,69,67,65,63,61,59,57,55,53,51,49,48,46,44,42,40,38,36,34,32,31,29,27,25,24,22,21,20,18,17,16,15,13,12,11,9,8,7,6,4,3,2,1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,1,2,3,5,6,7,9,10,12,13,14,16,17,20,23,26,28,31,34,37,39,42,45,48,50,53,56,59,62,66,70,74,78,82,86,91,96,101,106,111,115,120,125,130,135,140,146,152,158,164,171,178,185,192,201,210,219,229,237,243,248,251,254]
@@ -57,7 +57,7 @@ colormaps = {
     'ironbow': lut_ironbow[-256:],
 }
 
-def connect_senxor(src=None, name=None):
+def connect_senxor(src=None, name=None, read_raw=False, param_cache=None):
     """
     Return an MI48 instance corresponding to the SenXor module connected to `src`
 
@@ -65,6 +65,10 @@ def connect_senxor(src=None, name=None):
     number, e.g. 0, 1, etc.
     if `name` (stirng) is not None, it will be assigned to mi48.name instance, else
     the name of the virtual comport will be assigned to the mi48.name.
+    If `read_raw` is true, mi48.read() returns the raw frames (uint16,
+    deci-Kelvin) instead of Celsius; see mi48.raw_threshold().
+    `param_cache` is passed to MI48, e.g. True to keep the compensation
+    parameters across connects; see mi48.CompensationParamsCache.
 
     Return None, if no connection to SenXor can be established.
     """
@@ -98,9 +102,239 @@ def connect_senxor(src=None, name=None):
             usb = USB_Interface(ser)
             connected_port = port
             if name is None: name = connected_port
-            mi48 = MI48([usb,usb], name=name, read_raw=False)
+            mi48 = MI48([usb,usb], name=name, read_raw=read_raw,
+                        param_cache=param_cache)
     return mi48, connected_port, port_names
 
+def connect_senxors(read_raw=False, param_cache=None):
+    """
+    Return a list of MI48 instances, one for every SenXor module connected,
+    and the list of their comports.
+
+    Ports that cannot be opened, e.g. because they are already open,
+    are skipped with a warning.
+    """
+    mi48s, connected_ports = [], []
+    for p in list_ports.comports():
+        if p.vid == MI_VID and p.pid in MI_PIDs:
+            port = p.description.split()[-1][1:-1]
+            try:
+                ser = Serial(p.device)
+            except SerialException:
+                logging.warning(f'{port} seems already open')
+                continue
+            usb = USB_Interface(ser)
+            mi48s.append(MI48([usb,usb], name=port, read_raw=read_raw,
+                              param_cache=param_cache))
+            connected_ports.append(port)
+    return mi48s, connected_ports
+
+
+class SenxorArray:
+    """
+    Several SenXor modules streaming together, read in time-aligned batches.
+
+    Each MI48 in `mi48s` streams into its own background reader thread
+    (see MI48.start); read() waits until every camera has a new frame and
+    returns the latest one of each, stacked as an (N, rows, cols) array.
+    All cameras must have the same FPA shape.
+
+    Usage:
+
+        cameras = SenxorArray(connect_senxors()[0])
+        cameras.start()
+        frames, headers = cameras.read()
+        cameras.stop()
+
+    `skew` is the spread (in seconds) of the arrival times of the frames
+    of the last batch, `n_batches` the number of batches read so far.
+    Frames are counted as dropped by get_dropped() wherever they were lost:
+    on the USB link, in the frame queue, or passed over for a newer one.
+    """
+    def __init__(self, mi48s, queue_size=2, hflip=False):
+        if not mi48s:
+            raise ValueError('No SenXor module to read from')
+        shapes = set(mi48.fpa_shape for mi48 in mi48s)
+        if len(shapes) != 1:
+            raise ValueError('SenXor modules of different FPA shapes: {}'.
+                             format(shapes))
+        self.mi48s = list(mi48s)
+        self.fpa_shape = shapes.pop()
+        self.queue_size = queue_size
+        self.hflip = hflip
+        self.skew = None
+        self.n_batches = 0
+        # frame counter of the last frame read, and frames missing
+        # between those read, of each camera
+        self.last_counter = [None] * len(self.mi48s)
+        self.n_missed = [0] * len(self.mi48s)
+
+    def __len__(self):
+        return len(self.mi48s)
+
+    def start(self, with_header=True):
+        """Start continuous capture, with one reader thread per camera"""
+        # frames not sent while stopped are not dropped
+        self.last_counter = [None] * len(self.mi48s)
+        for mi48 in self.mi48s:
+            mi48.start(stream=True, with_header=with_header, background=True,
+                       queue_size=self.queue_size, policy='keep_latest')
+
+    def stop(self):
+        for mi48 in self.mi48s:
+            mi48.stop_capture()
+
+    def close(self):
+        for mi48 in self.mi48s:
+            mi48.stop()
+
+    def read(self, timeout=None):
+        """
+        Return (frames, headers) of the next batch, or (None, None) if any
+        camera fails to deliver a frame within `timeout` seconds.
+
+        `frames` is an array of shape (N, rows, cols), `headers` a list of
+        the N frame headers (None if captured without header).
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        responses = []
+        for mi48 in self.mi48s:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0., deadline - time.monotonic())
+            response = mi48.frame_queue.get(remaining)
+            if response is None:
+                return None, None
+            responses.append(response)
+        # cameras that have moved on while we waited for the others
+        # give their latest frame, to keep the batch tight in time
+        times = []
+        for i, mi48 in enumerate(self.mi48s):
+            response = mi48.frame_queue.get(0)
+            if response is not None:
+                responses[i] = response
+            times.append(mi48.frame_queue.t_get)
+        self.skew = max(times) - min(times)
+        frames, headers = [], []
+        for i, (mi48, response) in enumerate(zip(self.mi48s, responses)):
+            data, header = mi48.parse_response(response)
+            frames.append(data_to_frame(data, self.fpa_shape,
+                                        hflip=self.hflip))
+            headers.append(header)
+            if header is not None:
+                counter = int(header['frame_counter'])
+                if self.last_counter[i] is not None:
+                    # the 16-bit frame counter wraps around
+                    self.n_missed[i] += (counter - self.last_counter[i] - 1)\
+                                        & 0xFFFF
+                self.last_counter[i] = counter
+        self.n_batches += 1
+        return np.stack(frames), headers
+
+    def get_dropped(self):
+        """
+        Return the number of frames dropped by each camera: the gaps in
+        the frame counters of the frames read if captured with header,
+        else the frames dropped by its frame queue.
+        """
+        return [n_missed if last is not None else
+                mi48.frame_queue.n_dropped if mi48.frame_queue else 0
+                for mi48, last, n_missed in zip(self.mi48s, self.last_counter,
+                                                self.n_missed)]
+
+class FrameRateGovernor:
+    """
+    Lower the frame rate of a SenXor while nothing happens in its view.
+
+    Call update() once per frame, or per cycle of the processing loop,
+    with what is known of the scene. After `idle_after` seconds without
+    activity the frame rate drops to `fps_idle`; it returns to
+    `fps_active` on the first sign of activity, i.e. with the update
+    that sees it. Activity is any of:
+
+        * `active` passed to update() being true, e.g. a hand in view
+        * the hottest pixel, `t_max`, changing faster than `max_rate`
+          Kelvin per second
+        * `state`, e.g. the number of hazards, differing from the last
+
+    If `mi48` is given, the frame rate is set with MI48.set_fps() while
+    streaming. For triggered acquisition (see MI48.trigger) leave it
+    None and request a frame only if due() says so.
+
+    Usage:
+
+        governor = FrameRateGovernor(mi48, fps_active=20, fps_idle=2)
+        while True:
+            data, header = mi48.read()
+            ...
+            governor.update(header['pixel_max'], active=hands > 0,
+                            state=n_hazards)
+
+    `idle` tells whether the rate is down, `n_changes` counts the rate
+    changes and `t_idle` the seconds spent at the idle rate so far.
+    """
+    def __init__(self, mi48=None, fps_active=20., fps_idle=2.,
+                 idle_after=5., max_rate=1.):
+        self.mi48 = mi48
+        self.fps_active = fps_active
+        self.fps_idle = fps_idle
+        self.idle_after = idle_after
+        self.max_rate = max_rate
+        self.fps = fps_active
+        self.idle = False
+        self.n_changes = 0
+        self.t_idle = 0.
+        now = time.monotonic()
+        self.t_active = now
+        self.t_changed = now
+        self.t_due = None
+        self.t_max = None
+        self.t_last = None
+        self.state = None
+
+    def update(self, t_max=None, active=False, state=None, now=None):
+        """Take note of the scene; return the frame rate now in effect"""
+        now = time.monotonic() if now is None else now
+        if t_max is not None:
+            if self.t_max is not None and now > self.t_last:
+                rate = abs(t_max - self.t_max) / (now - self.t_last)
+                if rate > self.max_rate:
+                    active = True
+            self.t_max, self.t_last = t_max, now
+        if state is not None:
+            if self.state is not None and state != self.state:
+                active = True
+            self.state = state
+        if active:
+            self.t_active = now
+        idle = now - self.t_active >= self.idle_after
+        if idle != self.idle:
+            self._set_idle(idle, now)
+        return self.fps
+
+    def due(self, now=None):
+        """Return True if a frame is due at the governed rate, and count it"""
+        now = time.monotonic() if now is None else now
+        if self.t_due is not None and now - self.t_due < 1. / self.fps:
+            return False
+        self.t_due = now
+        return True
+
+    def _set_idle(self, idle, now):
+        if self.idle:
+            self.t_idle += now - self.t_changed
+        self.idle = idle
+        self.fps = self.fps_idle if idle else self.fps_active
+        self.t_changed = now
+        self.n_changes += 1
+        if not idle:
+            # a frame may be taken straight away
+            self.t_due = None
+        if self.mi48 is not None:
+            self.mi48.set_fps(self.fps)
+        logging.debug('Frame rate governor: {} fps'.format(self.fps))
+
+
 def data_to_frame(data, array_shape, hflip=False):
     """
     Convert 1D array into nH x nV 2D array corresponding to the FPA.
@@ -141,6 +375,7 @@ def remap(data, new_range=(0, 255), curr_range=None, to_uint8=True):
     If `to_uint8` is true, return an uint8, instead of float16. This is
     useful in conjuction with `new_range` being (0, 255), to prepare for
     many OpneCV routines which accept only uint8.
+    `data` may be in Celsius or raw (uint16, deci-Kelvin).
     """
     lo2, hi2 = new_range
     #
@@ -154,7 +389,8 @@ def remap(data, new_range=(0, 255), curr_range=None, to_uint8=True):
     # current range.
     # We could potentially manipulate relpos by some function to 
     # realise non-linear remapping
-    relpos = (data - lo1) / float(hi1 - lo1)
+    # subtract in float, lest unsigned raw data wrap around below lo1
+    relpos = np.subtract(data, lo1, dtype=np.float32) / float(hi1 - lo1)
     out = lo2 + relpos * (hi2 - lo2)
     #
     if to_uint8:
@@ -172,6 +408,9 @@ def get_default_outfile(src_id=None, ext='csv'):
     return filename
 
 
+# LUTs made by get_colormap() and get_colormap_lut(), by (colormap, nc)
+_colormap_luts = {}
+
 #fib = [0, 1, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144, 233, 377, 600]
 def get_colormap(colormap='rainbow2', nc=None):
     """
@@ -179,7 +418,12 @@ def get_colormap(colormap='rainbow2', nc=None):
 
     `colormap` is either from open cv, matplotlib or explicitly defined above.
     If `nc` is not None, return a quantized colormap with `nc` different colors.
+    The LUTs are made once per (colormap, nc) and shared; do not modify them.
     """
+    try:
+        return _colormap_luts[(colormap, nc)]
+    except KeyError:
+        pass
     try:
         # use defualt opencv maps or explicitly defined above
         cmap = colormaps[colormap]
@@ -193,6 +437,7 @@ def get_colormap(colormap='rainbow2', nc=None):
                 cmap = cmapy.cmap(colormap)
             except KeyError:
                 # return non-quantized CV cmap
+                _colormap_luts[(colormap, nc)] = cmap
                 return cmap
         # we need to create a LUT with 256 entries, and these entries
         # are indexes in the actual color map; there are `nc` such indexes
@@ -205,6 +450,27 @@ def get_colormap(colormap='rainbow2', nc=None):
         lut = [int((j // ipc) / (nc-1) * (nmax-1)) for j in range(nmax-delta)]
         lut += [nmax-1,] * delta
         cmap = np.array([cmap[i] for i in lut], dtype='uint8')
+    _colormap_luts[(colormap, nc)] = cmap
+    return cmap
+
+
+def get_colormap_lut(colormap='rainbow2', nc=None):
+    """
+    Return get_colormap() as a (256, 1, 3) uint8 LUT, also for the
+    built-in maps of OpenCV, which cv.applyColorMap() would otherwise
+    build anew on every call.
+    """
+    key = ('lut', colormap, nc)
+    try:
+        return _colormap_luts[key]
+    except KeyError:
+        pass
+    cmap = get_colormap(colormap, nc)
+    if isinstance(cmap, int):
+        gray = np.arange(256, dtype=np.uint8).reshape(256, 1)
+        cmap = cv.applyColorMap(gray, cmap)
+    cmap = np.ascontiguousarray(cmap, dtype=np.uint8).reshape(256, 1, 3)
+    _colormap_luts[key] = cmap
     return cmap
 
 
@@ -221,7 +487,7 @@ def cv_render(data, title='', resize=(800, 620), colormap='jet',
     Else, return the OpenCV image object.
     """
     # colormap may be either a colormap list or a string
-    cmap = get_colormap(colormap, n_colors)
+    cmap = get_colormap_lut(colormap, n_colors)
     cvcol = cv.applyColorMap(data, cmap)
     if isinstance(resize, tuple) or isinstance(resize, list):
         cvresize =  cv.resize(cvcol, dsize=resize,
@@ -233,6 +499,74 @@ def cv_render(data, title='', resize=(800, 620), colormap='jet',
         cv.imshow(title, cvresize)
     return cvresize
 
+
+class ThermalRenderer:
+    """
+    Render uint8 images, such as from cv_filter() or ThermalPreprocessor,
+    as cv_render() does, but into buffers that are reused from one frame
+    to the next, and with the colormap LUT made only once.
+
+    `resize` is the output size (width, height), a scale factor, or None
+    to keep the size of the data. `interpolation` is that of cv.resize;
+    with an integer scale factor, e.g. resize=4, cv.INTER_NEAREST makes
+    a block of each pixel, in exactly the colors of the colormap, and
+    so does cv.INTER_AREA, which is often faster.
+
+    Usage:
+
+        renderer = ThermalRenderer('rainbow2', resize=(800, 620))
+        while True:
+            ...
+            renderer.show(filt_uint8, title='thermal')
+
+    render() and show() return the output buffer, which the next call
+    overwrites; copy it to keep it.
+    """
+    def __init__(self, colormap='rainbow2', n_colors=None, resize=(800, 620),
+                 interpolation=cv.INTER_CUBIC):
+        self.colormap = colormap
+        self.n_colors = n_colors
+        self.resize = resize
+        self.interpolation = interpolation
+        self.color = None
+        self.out = None
+
+    def _output_size(self, shape):
+        if self.resize is None:
+            return None
+        if isinstance(self.resize, (tuple, list)):
+            return tuple(self.resize)
+        nrows, ncols = shape
+        return (int(round(ncols * self.resize)),
+                int(round(nrows * self.resize)))
+
+    def render(self, data, colormap=None, n_colors=None):
+        """Colorize and resize `data`; return the rendered image"""
+        if colormap is None:
+            colormap, n_colors = self.colormap, self.n_colors
+        lut = get_colormap_lut(colormap, n_colors)
+        if self.color is None or self.color.shape[:2] != data.shape:
+            self.color = np.empty(data.shape + (3,), dtype=np.uint8)
+        cv.applyColorMap(data, lut, dst=self.color)
+        size = self._output_size(data.shape)
+        if size is None or size == data.shape[::-1]:
+            return self.color
+        if self.out is None or self.out.shape[1::-1] != size:
+            self.out = np.empty((size[1], size[0], 3), dtype=np.uint8)
+        cv.resize(self.color, size, dst=self.out,
+                  interpolation=self.interpolation)
+        return self.out
+
+    def show(self, data, title='', colormap=None, n_colors=None):
+        """Render `data` and display it in the window `title`"""
+        image = self.render(data, colormap, n_colors)
+        cv.imshow(title, image)
+        return image
+
+    def __call__(self, data, title='', colormap=None, n_colors=None):
+        return self.show(data, title, colormap, n_colors)
+
+
 def cv_filter(data, parameters=None, use_median=True, use_bilat=True,
                      use_nlm=False):
     """
@@ -277,6 +611,304 @@ def cv_filter(data, parameters=None, use_median=True, use_bilat=True,
         print('NLMeans cost [ms]: {:8.4f}'.format(time.time() - t0))
     return filtered
 
+
+class ThermalPreprocessor:
+    """
+    Per-frame preprocessing of thermal frames in one pass over
+    preallocated buffers: orientation, auto-ranging, remap to uint8,
+    spatial filtering, and a mask per temperature threshold.
+
+    It replaces the sequence of
+
+        frame = cv.flip(data, 0)
+        filt_uint8 = cv_filter(remap(frame), par)
+        mask = cv.threshold(remap(frame), ...)   # per threshold
+
+    which finds the min and max of the frame, and allocates new arrays,
+    with every call of remap(). Here the frame is oriented while being
+    copied to a float32 buffer, and everything else works from that copy.
+
+    `data` may be a frame of shape (rows, cols) as from MI48.read_frame,
+    or 1-D as from MI48.read, and in Celsius, or raw if `raw` is true.
+    `flip` is None or a flip code of cv.flip.
+    `thresholds` maps a name to a temperature t, for a mask of where the
+    frame is hotter than t, or to (t0, t1), for where t0 < T <= t1;
+    thresholds are in Celsius also for raw frames.
+    `filter_parameters`, `use_median` and `use_bilat` are as of
+    cv_filter().
+
+    Usage:
+
+        pre = ThermalPreprocessor(mi48.fpa_shape, flip=0,
+                                  thresholds={'hand': (23, 35),
+                                              'hazard': 40})
+        while True:
+            filt_uint8 = pre(mi48.read_frame(ring)['data'])
+            hazards = pre.masks['hazard']
+            ...
+
+    After each call, `frame` holds the oriented frame (float32), `lo`
+    and `hi` its range, `image` the frame remapped from (lo, hi) to
+    uint8, `filtered` the filtered image, which is also returned, and
+    `masks` the threshold masks (uint8, 0 or 255). All of them are
+    overwritten by the next call. The remap rounds to the nearest grey
+    level, where remap() truncates.
+    """
+    def __init__(self, fpa_shape=(80, 62), flip=None, thresholds=None,
+                 raw=False, filter_parameters=None, use_median=True,
+                 use_bilat=True):
+        self.fpa_shape = tuple(fpa_shape)
+        ncols, nrows = self.fpa_shape
+        self.flip = flip
+        self.raw = raw
+        # as for cv_filter()
+        par = {'blur_ks': 5, 'd': 7, 'sigmaColor': 23, 'sigmaSpace': 23}
+        if filter_parameters is not None:
+            par.update(filter_parameters)
+        self.parameters = par
+        self.use_median = use_median
+        self.use_bilat = use_bilat
+        self.frame = np.zeros((nrows, ncols), dtype=np.float32)
+        self.image = np.zeros((nrows, ncols), dtype=np.uint8)
+        self.median = np.zeros_like(self.image)
+        self.bilat = np.zeros_like(self.image)
+        if use_bilat:
+            self.filtered = self.bilat
+        elif use_median:
+            self.filtered = self.median
+        else:
+            self.filtered = self.image
+        self.lo = self.hi = 0.
+        # inclusive bounds for cv.inRange, in the units of the frame
+        self.bounds = {}
+        self.masks = {}
+        for name, t in (thresholds or {}).items():
+            t0, t1 = t if isinstance(t, (tuple, list)) else (t, None)
+            self.bounds[name] = (self._above(t0), self._at_or_below(t1))
+            self.masks[name] = np.zeros_like(self.image)
+
+    def _above(self, t):
+        """Lowest frame value hotter than `t` Celsius"""
+        if self.raw:
+            return float(raw_threshold(t) + 1)
+        return float(np.nextafter(np.float32(t), np.float32(np.inf)))
+
+    def _at_or_below(self, t):
+        """Highest frame value not hotter than `t` Celsius"""
+        if t is None:
+            return float(np.finfo(np.float32).max)
+        if self.raw:
+            return float(raw_threshold(t))
+        return float(np.float32(t))
+
+    def process(self, data):
+        """Preprocess a frame; return the filtered uint8 image"""
+        if data.ndim == 1:
+            # the EVK sends columns first; see data_to_frame
+            data = np.reshape(data, self.fpa_shape, order='F').T
+        if self.flip == 0:
+            data = data[::-1]
+        elif self.flip == 1:
+            data = data[:, ::-1]
+        elif self.flip == -1:
+            data = data[::-1, ::-1]
+        np.copyto(self.frame, data, casting='unsafe')
+        self.lo, self.hi = cv.minMaxLoc(self.frame)[:2]
+        alpha = 255. / (self.hi - self.lo) if self.hi > self.lo else 0.
+        cv.convertScaleAbs(self.frame, dst=self.image, alpha=alpha,
+                           beta=-self.lo * alpha)
+        src = self.image
+        if self.use_median:
+            src = cv.medianBlur(src, self.parameters['blur_ks'],
+                                dst=self.median)
+        if self.use_bilat:
+            cv.bilateralFilter(src, self.parameters['d'],
+                               self.parameters['sigmaColor'],
+                               self.parameters['sigmaSpace'], dst=self.bilat)
+        for name, (lower, upper) in self.bounds.items():
+            cv.inRange(self.frame, lower, upper, dst=self.masks[name])
+        return self.filtered
+
+    def __call__(self, data):
+        return self.process(data)
+
+
+# a connected region of one class of ThermalClassifier
+REGION_DTYPE = np.dtype([
+    ('label', 'u1'),        # class label, 1 for the first band, etc.
+    ('component', 'i4'),    # value of the region in its components image
+    ('x', 'i4'),            # bounding box
+    ('y', 'i4'),
+    ('width', 'i4'),
+    ('height', 'i4'),
+    ('area', 'i4'),         # pixels
+    ('cx', 'f8'),           # centroid
+    ('cy', 'f8'),
+])
+
+
+class ThermalClassifier:
+    """
+    Classify the pixels of thermal frames by temperature bands, into one
+    label image, and find the connected regions of every class.
+
+    `bands` maps class names to temperatures in Celsius, as for the
+    thresholds of ThermalPreprocessor: t for hotter than t, or (t0, t1)
+    for t0 < T <= t1. Bands must not overlap. The classes are labelled
+    1, 2, ... in the order of `bands`; 0 is no class.
+
+    `data` may be 1-D or 2-D, in Celsius or raw if `raw` is true, and is
+    oriented by `flip` as for ThermalPreprocessor. Frames of 16 bits,
+    i.e. raw (uint16) or float16 Celsius as from MI48.read(), are
+    classified with one lookup per pixel in a table of all 65536 values;
+    others with a binary search over the band edges.
+
+    Usage:
+
+        classifier = ThermalClassifier({'warm': (30, 45), 'hot': (45, 60),
+                                        'scalding': 60}, mi48.fpa_shape)
+        while True:
+            regions = classifier(mi48.read_frame(ring)['data'])
+            for region in regions['scalding']:
+                contour = classifier.contour(region)
+                ...
+
+    segment() (or calling the instance) returns, per class name, an
+    array of REGION_DTYPE records, largest first. It runs one pass of
+    connected components over the masks of all classes, stacked into
+    one image, so that regions of different classes stay apart where
+    they touch.
+    After each call `labels` holds the label image (uint8), `masks` the
+    mask of each class and `components` the region numbers of each
+    class (int32), i.e. masks[label - 1] and components[label - 1] are
+    (rows, cols); all of them are overwritten by the next call.
+    """
+    def __init__(self, bands, fpa_shape=(80, 62), flip=None, raw=False,
+                 connectivity=8):
+        self.names = list(bands)
+        self.fpa_shape = tuple(fpa_shape)
+        ncols, nrows = self.fpa_shape
+        self.flip = flip
+        self.raw = raw
+        self.connectivity = connectivity
+        intervals = []
+        for label, name in enumerate(self.names, 1):
+            t = bands[name]
+            t0, t1 = t if isinstance(t, (tuple, list)) else (t, None)
+            t1 = np.inf if t1 is None else t1
+            if not t0 < t1:
+                raise ValueError('Empty band {}: {}'.format(name, t))
+            intervals.append((t0, t1, label))
+        intervals.sort()
+        for (a0, a1, a), (b0, b1, b) in zip(intervals, intervals[1:]):
+            if b0 < a1:
+                raise ValueError('Bands {} and {} overlap'.format(
+                                 self.names[a - 1], self.names[b - 1]))
+        # interval i of the edges is (edges[i-1], edges[i]], and
+        # np.searchsorted(edges, T) is the interval of T
+        edges = sorted({t for t0, t1, label in intervals
+                        for t in (t0, t1) if np.isfinite(t)})
+        self.edge_labels = np.zeros(len(edges) + 1, dtype=np.uint8)
+        for i in range(len(edges) + 1):
+            lo = edges[i - 1] if i > 0 else -np.inf
+            for t0, t1, label in intervals:
+                if t0 <= lo and (i == len(edges) or edges[i] <= t1):
+                    self.edge_labels[i] = label
+        if raw:
+            # T > t exactly where raw > raw_threshold(t)
+            self.edges = np.array([raw_threshold(t) for t in edges])
+        else:
+            self.edges = np.array(edges, dtype=np.float64)
+        self.luts = {}
+        self.labels = np.zeros((nrows, ncols), dtype=np.uint8)
+        # the masks of all classes, stacked one below the other with a
+        # row of zeros in between, for one pass of connected components
+        nclass = len(self.names)
+        self.stack = np.zeros((nclass * (nrows + 1), ncols), dtype=np.uint8)
+        self.masks = self.stack.reshape(nclass, nrows + 1, ncols)[:, :nrows]
+        self.stack_components = np.zeros(self.stack.shape, dtype=np.int32)
+        self.components = self.stack_components.reshape(
+            nclass, nrows + 1, ncols)[:, :nrows]
+        self.class_labels = np.arange(1, nclass + 1,
+                                      dtype=np.uint8)[:, None, None]
+
+    def _lut(self, dtype):
+        """Labels of all 65536 values of a 16-bit frame"""
+        try:
+            return self.luts[dtype]
+        except KeyError:
+            pass
+        values = np.arange(1 << 16, dtype=np.uint16).view(dtype)
+        lut = self.edge_labels.take(np.searchsorted(self.edges, values))
+        if dtype == np.float16:
+            lut[np.isnan(values)] = 0
+        self.luts[dtype] = lut
+        return lut
+
+    def classify(self, data):
+        """Return the label image of a frame"""
+        if data.ndim == 1:
+            # the EVK sends columns first; see data_to_frame
+            data = np.reshape(data, self.fpa_shape, order='F').T
+        if self.flip == 0:
+            data = data[::-1]
+        elif self.flip == 1:
+            data = data[:, ::-1]
+        elif self.flip == -1:
+            data = data[::-1, ::-1]
+        if data.dtype in (np.uint16, np.float16):
+            np.take(self._lut(data.dtype), data.view(np.uint16),
+                    out=self.labels)
+        else:
+            self.edge_labels.take(np.searchsorted(self.edges, data),
+                                  out=self.labels)
+        return self.labels
+
+    def segment(self, data):
+        """Classify a frame; return {name: regions} of every class"""
+        labels = self.classify(data)
+        np.equal(labels, self.class_labels, out=self.masks.view(bool))
+        # Grana's BBDT is the fastest here, by far for 8-connectivity
+        n, components, stats, centroids =\
+            cv.connectedComponentsWithStatsWithAlgorithm(
+                self.stack, self.connectivity, cv.CV_32S, cv.CCL_GRANA,
+                labels=self.stack_components)
+        nrows = self.fpa_shape[1] + 1
+        regions = np.zeros(n - 1, dtype=REGION_DTYPE)
+        tile, regions['y'] = np.divmod(stats[1:, cv.CC_STAT_TOP], nrows)
+        regions['label'] = tile + 1
+        regions['component'] = np.arange(1, n)
+        regions['x'] = stats[1:, cv.CC_STAT_LEFT]
+        regions['width'] = stats[1:, cv.CC_STAT_WIDTH]
+        regions['height'] = stats[1:, cv.CC_STAT_HEIGHT]
+        regions['area'] = stats[1:, cv.CC_STAT_AREA]
+        regions['cx'] = centroids[1:, 0]
+        regions['cy'] = centroids[1:, 1] - tile * nrows
+        # by class, largest first
+        regions = regions[np.lexsort((-regions['area'], regions['label']))]
+        ends = np.searchsorted(regions['label'],
+                               np.arange(len(self.names) + 1), side='right')
+        return {name: regions[ends[label - 1]: ends[label]]
+                for label, name in enumerate(self.names, 1)}
+
+    def mask(self, region):
+        """Return the mask (uint8, 0 or 1) of a region within its box"""
+        x, y, w, h = (int(region[k]) for k in ('x', 'y', 'width', 'height'))
+        roi = self.components[region['label'] - 1, y: y + h, x: x + w]
+        return np.equal(roi, region['component']).view(np.uint8)
+
+    def contour(self, region):
+        """Return the outer contour of a region, in frame coordinates"""
+        contours, _ = cv.findContours(self.mask(region), cv.RETR_EXTERNAL,
+                                      cv.CHAIN_APPROX_SIMPLE,
+                                      offset=(int(region['x']),
+                                              int(region['y'])))
+        return max(contours, key=len)
+
+    def __call__(self, data):
+        return self.segment(data)
+
+
 def clip_frame(frame, minval=None, maxval=None, c0=0.0, c1=0.0):
     """
     Clip the lowest and highest of the `frame`.
@@ -298,22 +930,62 @@ def clip_frame(frame, minval=None, maxval=None, c0=0.0, c1=0.0):
 
 class TrueAverageFilter:
 
-    def __init__(self, depth):
+    def __init__(self, depth, shape=None):
+        """
+        Average of the last ``depth`` frames, pixel by pixel.
+
+        A running sum (float32) is kept: each update subtracts the frame
+        leaving the buffer and adds the new one, so that its cost does not
+        depend on ``depth``. The sum is taken anew once per pass through
+        the buffer, lest rounding errors accumulate.
+        The frame shape is that of the first frame, unless given.
+
+        Usage:
+
+            # average hazard maps over 50 frames
+            av_filter = TrueAverageFilter(50)
+            ...
+
+            av = av_filter(frame)
+        """
         self.depth = depth
-        self.buf = np.zeros(shape=(depth,62,80))
+        self.buf = None
         self.counter = 0
         self.ix = 0
         self.av = 0
+        if shape is not None:
+            self._allocate(shape)
+
+    def _allocate(self, shape):
+        self.shape = tuple(shape)
+        self.buf = np.zeros((self.depth,) + self.shape, dtype=np.float32)
+        self.sum = np.zeros(self.shape, dtype=np.float32)
 
     def update(self, new):
+        if self.buf is None:
+            self._allocate(np.shape(new))
         if self.counter < self.depth: self.counter += 1
+        # the outgoing frame; zeros until the buffer is full
+        np.subtract(self.sum, self.buf[self.ix], out=self.sum)
         self.buf[self.ix] = new
-        self.av = np.sum(self.buf, axis=0)
-        self.av = self.av / self.counter
+        np.add(self.sum, self.buf[self.ix], out=self.sum)
         self.ix += 1
-        if self.ix > self.depth - 1: self.ix = 0
+        if self.ix > self.depth - 1:
+            self.ix = 0
+            np.sum(self.buf, axis=0, out=self.sum)
+        # a new array, which the caller may keep
+        self.av = self.sum / self.counter
         return self.av
 
+    def clear(self):
+        """Forget the frames so far; the buffers are kept"""
+        self.counter = 0
+        self.ix = 0
+        if self.buf is not None:
+            self.buf.fill(0)
+            self.sum.fill(0)
+        self.av = 0
+
     def __call__(self, new):
         return self.update(new)
 
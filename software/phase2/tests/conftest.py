@@ -0,0 +1,6 @@
+# Run from software/phase2 with `python -m pytest tests`; the senxor
+# package is imported from the source tree, as the scripts do.
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
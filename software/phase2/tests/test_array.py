@@ -0,0 +1,101 @@
+# SenxorArray against several MI48 emulators streaming at once
+import contextlib
+
+import numpy as np
+import serial
+
+from senxor.emulator import MI48Emulator
+from senxor.interfaces import USB_Interface
+from senxor.mi48 import MI48, KELVIN_0
+from senxor.utils import SenxorArray
+
+FPS = 50.
+N_BATCHES = 20
+
+
+class SkippingEmulator(MI48Emulator):
+    """Emulator that does not send the frames whose counter is in `skip`"""
+
+    def __init__(self, skip=(), **kwargs):
+        super().__init__(**kwargs)
+        self.skip = set(skip)
+
+    def inject_faults(self, ack):
+        if (self.frame_counter - 1) & 0xFFFF in self.skip:
+            return b''
+        return super().inject_faults(ack)
+
+
+def connect(emulator):
+    usb = USB_Interface(serial.Serial(emulator.device, timeout=0.5))
+    return MI48([usb, usb], read_raw=True)
+
+
+@contextlib.contextmanager
+def array_of(emulators):
+    with contextlib.ExitStack() as stack:
+        for emulator in emulators:
+            stack.enter_context(emulator)
+        cameras = SenxorArray([connect(emulator) for emulator in emulators])
+        try:
+            yield cameras
+        finally:
+            cameras.close()
+
+
+def read_batches(cameras, n=N_BATCHES):
+    cameras.start()
+    batches = []
+    for _ in range(n):
+        frames, headers = cameras.read(timeout=2.)
+        assert frames is not None
+        batches.append((frames, headers, cameras.skew))
+    cameras.stop()
+    return batches
+
+
+def test_batches_aligned():
+    # camera k sees a uniform scene at 20 + k Celsius, and counts its
+    # frames from 1000 k on
+    emulators = []
+    for k in range(3):
+        frame = np.full(80 * 62, int((20 + k - KELVIN_0) * 10), np.uint16)
+        emulator = MI48Emulator(frames=[frame], fps=FPS)
+        emulator.frame_counter = 1000 * k
+        emulators.append(emulator)
+    with array_of(emulators) as cameras:
+        batches = read_batches(cameras)
+    for frames, headers, skew in batches:
+        assert frames.shape == (3, 62, 80)
+        # the frames of a batch arrived within about a frame period; not
+        # the queue_size periods of frames taken as they are queued
+        assert skew < 2. / FPS
+        for k, header in enumerate(headers):
+            assert np.all(frames[k] == frames[k].flat[0])
+            assert header['pixel_max'] == frames[k].flat[0] / 10 + KELVIN_0
+            assert 1000 * k <= header['frame_counter'] < 1000 * k + 1000
+    assert cameras.n_batches == N_BATCHES
+
+
+def test_dropped_counts_skipped_frames():
+    # the second camera does not send every 4th frame, the third loses
+    # every 5th on the link
+    skip = [i for i in range(1000) if i % 4 == 3]
+    emulators = [MI48Emulator(fps=FPS),
+                 SkippingEmulator(skip=skip, fps=FPS),
+                 MI48Emulator(fps=FPS, checksum_errors=0.2, seed=1)]
+    with array_of(emulators) as cameras:
+        batches = read_batches(cameras, 2 * N_BATCHES)
+        dropped = cameras.get_dropped()
+    counters = np.array([[int(h['frame_counter']) for h in headers]
+                         for _, headers, _ in batches]).T
+    for k in range(3):
+        assert np.all(np.diff(counters[k]) > 0)
+        # every frame counter between the first and the last read was
+        # either read or counted as dropped
+        assert dropped[k] == counters[k][-1] - counters[k][0] + 1 -\
+                             len(counters[k])
+    assert not set(counters[1]) & set(skip)
+    n_skipped = sum(counters[1][0] < i < counters[1][-1] for i in skip)
+    assert dropped[1] >= n_skipped > 0
+    assert dropped[2] > 0
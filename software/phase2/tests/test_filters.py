@@ -0,0 +1,47 @@
+# Temporal filters of senxor.utils
+import numpy as np
+import pytest
+
+from senxor.utils import TrueAverageFilter
+
+
+def frames(n, shape=(62, 80), seed=0):
+    rng = np.random.default_rng(seed)
+    return 20. + 10. * rng.random((n,) + shape)
+
+
+@pytest.mark.parametrize('depth', [1, 4, 7])
+def test_average_of_last_frames(depth):
+    # over two passes through the buffer, i.e. across the periodic sum
+    # of the whole buffer, and while it fills up
+    seq = frames(2 * depth + 3)
+    av = TrueAverageFilter(depth)
+    for n in range(1, len(seq) + 1):
+        out = av(seq[n - 1])
+        expected = np.mean(seq[max(0, n - depth): n], axis=0)
+        assert out.shape == seq[0].shape
+        np.testing.assert_allclose(out, expected, atol=1.e-4)
+
+
+def test_average_is_a_new_array():
+    seq = frames(6)
+    av = TrueAverageFilter(3)
+    first = av(seq[0])
+    kept = first.copy()
+    second = av(seq[1])
+    assert second is not first
+    assert np.array_equal(first, kept)
+
+
+def test_clear_keeps_buffers():
+    seq = frames(5, shape=(4, 3))
+    av = TrueAverageFilter(3, shape=(4, 3))
+    buf = av.buf
+    for frame in seq:
+        av(frame)
+    av.clear()
+    assert av.buf is buf
+    assert av.counter == 0
+    np.testing.assert_allclose(av(seq[0]), seq[0], atol=1.e-5)
+    np.testing.assert_allclose(av(seq[1]), (seq[0] + seq[1]) / 2,
+                               atol=1.e-5)
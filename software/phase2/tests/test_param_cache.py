@@ -0,0 +1,61 @@
+# The compensation cache of MI48, against the MI48 emulator
+import os
+import struct
+
+import pytest
+import serial
+
+from senxor.emulator import MI48Emulator
+from senxor.interfaces import USB_Interface
+from senxor.mi48 import MI48, CompensationParamsCache, regmap
+
+PARAMS = [1.5, -2.25, 0.125, 4.0]
+
+
+def connect(emulator, cache):
+    usb = USB_Interface(serial.Serial(emulator.device, timeout=0.5))
+    return MI48([usb, usb], param_cache=cache)
+
+
+def flash_params(emulator, params):
+    emulator.flash[:4 * len(params)] = struct.pack(
+        '<{}f'.format(len(params)), *params)
+
+
+@pytest.fixture
+def emu():
+    with MI48Emulator() as emulator:
+        flash_params(emulator, PARAMS)
+        yield emulator
+
+
+def test_connect_writes_nothing(emu, tmp_path):
+    cache = CompensationParamsCache(tmp_path)
+    connect(emu, cache)
+    assert os.listdir(tmp_path) == []
+
+
+def test_params_from_cache(emu, tmp_path):
+    cache = CompensationParamsCache(tmp_path)
+    assert connect(emu, cache).get_compensation_params() == PARAMS
+    assert len(os.listdir(tmp_path)) == 1
+    # the flash changes behind our back: only the cache can tell PARAMS
+    flash_params(emu, [0., 0., 0., 0.])
+    mi48 = connect(emu, cache)
+    n_commands = emu.n_commands
+    assert mi48.get_compensation_params() == PARAMS
+    assert emu.n_commands == n_commands
+    assert mi48.get_compensation_params(use_cache=False) == [0.] * 4
+
+
+@pytest.mark.parametrize('reg', ['SENXOR_ID_0', 'FW_VERSION_1'])
+def test_changed_ident_invalidates(emu, tmp_path, reg):
+    cache = CompensationParamsCache(tmp_path)
+    assert connect(emu, cache).get_compensation_params() == PARAMS
+    emu.regs[regmap[reg]] ^= 0x01
+    new_params = [p + 1 for p in PARAMS]
+    flash_params(emu, new_params)
+    mi48 = connect(emu, cache)
+    n_commands = emu.n_commands
+    assert mi48.get_compensation_params() == new_params
+    assert emu.n_commands > n_commands
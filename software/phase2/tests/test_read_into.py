@@ -0,0 +1,83 @@
+# MI48.read_into() allocates nothing per frame, checked with tracemalloc
+import tracemalloc
+
+import numpy as np
+import pytest
+import serial
+
+from senxor.emulator import MI48Emulator
+from senxor.interfaces import USB_Interface
+from senxor.mi48 import MI48, regmap, KELVIN_0
+
+# bytes read_into() may allocate at its peak, for small objects such as
+# the header dictionary (~2 kB); a frame is 10 to 20 kB
+SLACK = 4096
+
+
+class FrameSource:
+    """Data interface that copies the same frame into `out`, allocating
+    nothing, so that what is measured is what MI48 allocates"""
+
+    def __init__(self, frame):
+        self.frame = frame
+
+    def read(self, length_in_words, out=None):
+        if out is None:
+            return self.frame[-length_in_words:].copy()
+        np.copyto(out, self.frame[-length_in_words:])
+        return out
+
+    def reset_input_buffer(self):
+        pass
+
+    def reset_output_buffer(self):
+        pass
+
+
+def peak_alloc(func, n=5):
+    """Return the peak memory (bytes) allocated by a call to func"""
+    func()
+    tracemalloc.start()
+    try:
+        peak = 0
+        for _ in range(n):
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            func()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+@pytest.fixture(scope='module')
+def mi48():
+    with MI48Emulator() as emu:
+        usb = USB_Interface(serial.Serial(emu.device, timeout=0.5))
+        emu.regs[regmap['FRAME_MODE']] = 0
+        frame = np.frombuffer(emu.make_frame(), dtype=np.uint16)
+        mi48 = MI48([usb, FrameSource(frame)])
+        mi48.capture_no_header = False
+        yield mi48
+        usb.close()
+
+
+@pytest.mark.parametrize('dtype', [np.float16, np.float32, np.uint16])
+@pytest.mark.parametrize('two_d', [False, True])
+def test_read_into_allocates_nothing(mi48, dtype, two_d):
+    shape = (mi48.rows, mi48.cols) if two_d else (mi48.rows * mi48.cols,)
+    out = np.empty(shape, dtype=dtype)
+    assert mi48.read_into(out)[0] is out
+    assert not mi48.crc_error
+    raw = mi48.interfaces[1].frame[-mi48.rows * mi48.cols:]
+    expected = raw if dtype == np.uint16 else raw / 10. + KELVIN_0
+    if two_d:
+        # as oriented by utils.data_to_frame()
+        expected = expected.reshape((mi48.cols, mi48.rows), order='F').T
+    assert np.allclose(out, expected, atol=0.02)
+    assert peak_alloc(lambda: mi48.read_into(out)) < SLACK
+
+
+def test_read_allocates_a_frame(mi48):
+    # the measurement sees the frame that read() returns
+    assert peak_alloc(lambda: mi48.read()) > mi48.rows * mi48.cols * 2
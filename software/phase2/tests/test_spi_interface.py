@@ -0,0 +1,68 @@
+# SPI_Interface.read() against a stand-in for spidev.SpiDev
+import numpy as np
+import pytest
+
+from senxor.interfaces import SPI_Interface
+
+
+class SpiDev:
+    """Clock out `frame` (bytes) forever; `lengths` overrides the length
+    of the next xfer3 transfers, as a misbehaving driver would"""
+
+    def __init__(self, frame, xfer3=True, lengths=()):
+        self.frame = bytes(frame)
+        self.pos = 0
+        self.lengths = list(lengths)
+        if xfer3:
+            self.xfer3 = self._xfer3
+
+    def xfer(self, values):
+        out = []
+        for _ in values:
+            out.append(self.frame[self.pos])
+            self.pos = (self.pos + 1) % len(self.frame)
+        return out
+
+    def _xfer3(self, values):
+        out = self.xfer(values)
+        if self.lengths:
+            n = self.lengths.pop(0)
+            out = (out * 2)[:n]
+        return out
+
+
+WORDS = np.arange(1000, 1000 + 4960, dtype='>u2')
+
+
+@pytest.mark.parametrize('xfer3', [True, False])
+@pytest.mark.parametrize('xfer_size', [160, 2520, 4096])
+def test_read(xfer3, xfer_size):
+    spi = SPI_Interface(SpiDev(WORDS.tobytes(), xfer3=xfer3), xfer_size)
+    out = np.empty(len(WORDS), dtype=np.uint16)
+    for _ in range(3):
+        # the last xfer() may clock out bytes past the frame
+        spi.device.pos = 0
+        assert spi.read(len(WORDS), out=out) is out
+        assert np.array_equal(out, WORDS)
+    spi.device.pos = 0
+    assert np.array_equal(spi.read(len(WORDS)), WORDS)
+
+
+@pytest.mark.parametrize('length', [0, 2 * len(WORDS) - 1,
+                                    2 * len(WORDS) + 2])
+def test_bad_transfer_length(length):
+    spi = SPI_Interface(SpiDev(WORDS.tobytes(), lengths=[length]), 2520)
+    out = np.empty(len(WORDS), dtype=np.uint16)
+    with pytest.raises(OSError):
+        spi.read(len(WORDS), out=out)
+    # the transfer buffer keeps the frame size
+    assert len(spi._buffer) == 2 * len(WORDS)
+    spi.device.pos = 0
+    assert np.array_equal(spi.read(len(WORDS), out=out), WORDS)
+
+
+def test_empty_transfer():
+    dev = SpiDev(WORDS.tobytes(), xfer3=False)
+    dev.xfer = lambda values: []
+    with pytest.raises(OSError):
+        SPI_Interface(dev, 2520).read(len(WORDS))
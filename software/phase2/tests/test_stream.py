@@ -0,0 +1,97 @@
+# MI48.stream() over AsyncUSBTransport, against the MI48 emulator
+import asyncio
+import contextlib
+import os
+
+import numpy as np
+import pytest
+import serial
+
+from senxor.emulator import MI48Emulator, synthetic_frame
+from senxor.interfaces import USB_Interface
+from senxor.mi48 import MI48, regmap, CONTINUOUS_STREAM
+
+# generous; the frames below come at 100 fps
+TIMEOUT = 10.
+
+
+def connect(emulator):
+    usb = USB_Interface(serial.Serial(emulator.device, timeout=0.5))
+    return MI48([usb, usb], read_raw=True)
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, TIMEOUT))
+
+
+def test_frame_order():
+    with MI48Emulator(fps=100) as emu:
+        mi48 = connect(emu)
+
+        async def main():
+            frames = []
+            async with contextlib.aclosing(mi48.stream()) as frames_in:
+                async for data, header in frames_in:
+                    frames.append((data, header))
+                    if len(frames) == 20:
+                        break
+            return frames
+
+        frames = run(main())
+        counters = [int(header['frame_counter']) for _, header in frames]
+        assert counters == list(range(counters[0], counters[0] + 20))
+        for (data, _), i in zip(frames, counters):
+            assert np.array_equal(data, synthetic_frame(emu.fpa_shape, i))
+        assert not mi48.crc_error
+        # capture stopped when the generator was closed
+        assert mi48.transport is None
+        assert not emu.regs[regmap['FRAME_MODE']] & CONTINUOUS_STREAM
+
+
+def test_regwrite_while_streaming():
+    with MI48Emulator(fps=100, latency=2.e-3) as emu:
+        mi48 = connect(emu)
+        assert mi48.get_frame_rate() != 2
+
+        async def main():
+            counters = []
+            async with contextlib.aclosing(mi48.stream()) as frames_in:
+                async for data, header in frames_in:
+                    counters.append(int(header['frame_counter']))
+                    if len(counters) == 5:
+                        await mi48.transport.regwrite(regmap['FRAME_RATE'], 2)
+                        assert await mi48.transport.regread(
+                            regmap['FRAME_RATE']) == 2
+                    if len(counters) == 15:
+                        break
+            return counters
+
+        counters = run(main())
+        # frames that came with the acknowledges were kept
+        assert counters == list(range(counters[0], counters[0] + 15))
+        assert emu.regs[regmap['FRAME_RATE']] == 2
+        assert mi48.get_frame_rate() == 2
+
+
+def test_port_failure_raises():
+    emu = MI48Emulator(fps=100).start()
+    mi48 = connect(emu)
+
+    def unplug():
+        emu.stop()
+        os.close(emu.master)
+
+    async def main():
+        n = 0
+        async for data, header in mi48.stream():
+            n += 1
+            if n == 3:
+                # the EVK is unplugged; the emulator may be blocked on a
+                # full pty until the event loop reads again
+                await asyncio.to_thread(unplug)
+        return n
+
+    with pytest.raises((serial.SerialException, OSError)):
+        run(main())
+    assert mi48.transport is None
+    os.close(emu.slave)
@@ -0,0 +1,152 @@
+# USBStreamDecoder against fixed byte streams as recorded from a flaky
+# USB link: flipped bits, truncated acknowledges, junk between them and
+# chunks split anywhere, including within the start marker.
+import numpy as np
+import pytest
+
+from senxor.interfaces import USBStreamDecoder, usb_format_ack
+
+N_WORDS = 80 * 63
+
+
+def gfra(i):
+    """GFRA acknowledge of frame `i`; its first word is i"""
+    # words of 3000..3999 have no byte that could form a start marker
+    words = np.arange(3000, 3000 + N_WORDS, dtype='<u2') % 1000 + 3000
+    words[0] = i
+    return usb_format_ack('GFRA', words.tobytes())
+
+
+def flip(ack, pos, mask=0x40):
+    ack = bytearray(ack)
+    ack[pos] ^= mask
+    return bytes(ack)
+
+
+def decode(stream, chunk=None):
+    """Feed `stream` in chunks; return the acks, as (cmd, value) pairs,
+    with GFRA data reduced to the frame number, and the decoder"""
+    dec = USBStreamDecoder()
+    chunk = chunk or len(stream)
+    acks = []
+    for k in range(0, len(stream), chunk):
+        dec.feed(stream[k: k + chunk])
+        for cmd, data in dec:
+            if cmd == 'GFRA':
+                assert len(data) == N_WORDS
+                data = int(data[0])
+            acks.append((cmd, data))
+    return acks, dec
+
+
+def test_intact_stream():
+    stream = (usb_format_ack('RREG', 'A5') + usb_format_ack('WREG') +
+              gfra(0) + usb_format_ack('SERR', '0001') + gfra(1))
+    expected = [('RREG', 0xA5), ('WREG', None), ('GFRA', 0),
+                ('SERR', '0001'), ('GFRA', 1)]
+    for chunk in (None, 1, 7, 4096):
+        acks, dec = decode(stream, chunk)
+        assert acks == expected
+        assert (dec.n_acks, dec.n_errors, dec.n_skipped) == (5, 0, 0)
+
+
+@pytest.mark.parametrize('pos', [20, 5000, -3])
+def test_flipped_bit(pos):
+    # in the data, and in the check sum field
+    bad = flip(gfra(1), pos)
+    acks, dec = decode(gfra(0) + bad + gfra(2) + usb_format_ack('WREG'))
+    assert acks == [('GFRA', 0), ('GFRA', 2), ('WREG', None)]
+    assert dec.n_errors == 1
+    assert dec.n_skipped == len(bad)
+
+
+def test_flipped_length():
+    # an ack length beyond what the decoder accepts
+    bad = flip(gfra(1), 4, 0x08)
+    acks, dec = decode(gfra(0) + bad + gfra(2))
+    assert acks == [('GFRA', 0), ('GFRA', 2)]
+    assert dec.n_errors == 1
+    assert dec.n_skipped == len(bad)
+
+
+@pytest.mark.parametrize('length', [2, 6, 10, 100, len(gfra(0)) - 1])
+def test_truncated_ack(length):
+    # the acks that follow are taken for the rest of the truncated one
+    # until its check sum fails, and then recovered
+    cut = gfra(1)[:length]
+    stream = gfra(0) + cut + gfra(2) + usb_format_ack('RREG', '01') + gfra(3)
+    for chunk in (None, 1000):
+        acks, dec = decode(stream, chunk)
+        assert acks == [('GFRA', 0), ('GFRA', 2), ('RREG', 1), ('GFRA', 3)]
+        assert dec.n_errors == (1 if length >= 4 else 0)
+        assert dec.n_skipped == length
+
+
+@pytest.mark.parametrize('junk', [b'\x00', b'\xff\x20\x20', b'  #',
+                                  b'#   ', b'\x13\x37\x20\x20\x20\x00\x01'])
+def test_junk_between_acks(junk):
+    stream = gfra(0) + junk + usb_format_ack('WREG') + junk + gfra(1) + junk
+    acks, dec = decode(stream)
+    assert acks == [('GFRA', 0), ('WREG', None), ('GFRA', 1)]
+    assert dec.n_errors == 0
+    # the trailing junk may yet be the start of a marker
+    assert 2 * len(junk) <= dec.n_skipped <= 3 * len(junk)
+
+
+def test_split_anywhere():
+    # every split of the stream into two feed() calls, including within
+    # the start marker and the length field, decodes the same
+    stream = (b'\x01\x20' + usb_format_ack('RREG', '3C') + b'\x20\x20' +
+              usb_format_ack('WREG') + usb_format_ack('SERR', 'FF'))
+    expected = [('RREG', 0x3C), ('WREG', None), ('SERR', 'FF')]
+    for k in range(len(stream) + 1):
+        dec = USBStreamDecoder()
+        dec.feed(stream[:k])
+        acks = list(dec)
+        dec.feed(stream[k:])
+        acks += list(dec)
+        assert acks == expected, k
+        assert dec.n_skipped == 4, k
+
+
+def test_bytes_needed_stops_at_ack_end():
+    # reading what bytes_needed() asks for never reads into the next ack
+    acks = [usb_format_ack('WREG'), gfra(0), usb_format_ack('RREG', '7F')]
+    stream = b''.join(acks)
+    dec = USBStreamDecoder()
+    pos = 0
+    for ack in acks:
+        end = stream.index(ack, pos) + len(ack)
+        while True:
+            got = dec.next_ack()
+            if got is not None:
+                break
+            n = dec.bytes_needed()
+            assert 0 < n <= end - pos
+            dec.feed(stream[pos: pos + n])
+            pos += n
+        assert pos == end
+
+
+def test_damaged_recording():
+    # a long stream with damage at random; every intact frame comes back
+    rng = np.random.default_rng(0)
+    stream = bytearray()
+    intact = []
+    for i in range(200):
+        ack = gfra(i)
+        if i % 10 == 3:
+            ack = flip(ack, int(rng.integers(12, len(ack) - 4)))
+        elif i % 15 == 7:
+            ack = ack[:int(rng.integers(8, len(ack)))]
+        else:
+            intact.append(i)
+        stream += ack
+        if i % 7 == 5:
+            stream += bytes(rng.integers(0, 255, size=int(rng.integers(1, 9)) *
+                                         2 - 1, dtype=np.uint8))
+    for chunk in (None, 1 << 12, 2521):
+        acks, dec = decode(bytes(stream), chunk)
+        assert acks == [('GFRA', i) for i in intact]
+        assert dec.n_acks == len(intact)
+        assert dec.n_errors == 200 - len(intact)
@@ -0,0 +1,47 @@
+# USB_Interface register access against the MI48 emulator
+import serial
+
+from senxor.emulator import MI48Emulator
+from senxor.interfaces import USB_Interface
+from senxor.mi48 import regmap
+
+FRAME_RATE = regmap['FRAME_RATE']
+READS = [(regmap[name], None) for name in
+         ('SENXOR_TYPE', 'FRAME_RATE', 'SENS_FACTOR', 'STATUS')]
+
+
+def connect(emulator):
+    return USB_Interface(serial.Serial(emulator.device, timeout=0.5))
+
+
+def test_transact_after_post():
+    # the acknowledges of posted writes come first, and are not taken
+    # for those of the pipelined reads
+    with MI48Emulator(latency=5.e-3) as emu:
+        usb = connect(emu)
+        n0 = emu.n_commands
+        usb.post(FRAME_RATE, 3)
+        usb.post(FRAME_RATE, 5)
+        values = usb.transact(READS)
+        assert values == [emu.regs[reg] for reg, _ in READS]
+        assert values[1] == 5
+        # sent once each, not again one at a time
+        assert emu.n_commands - n0 == 2 + len(READS)
+        assert usb.n_posted == 0
+
+
+def test_commands_after_post():
+    with MI48Emulator(latency=5.e-3) as emu:
+        usb = connect(emu)
+        usb.post(FRAME_RATE, 3)
+        usb.regwrite(FRAME_RATE, 4)
+        # the write above waited for its own acknowledge, so none is left
+        # over to shift the pipelined reads
+        n0 = emu.n_commands
+        assert usb.transact(READS)[1] == 4
+        assert emu.n_commands - n0 == len(READS)
+        usb.post(FRAME_RATE, 6)
+        assert usb.regread(FRAME_RATE) == 6
+        assert usb.n_posted == 0
+        assert usb.transact(READS)[1] == 6
+        assert emu.n_commands - n0 == 2 * len(READS) + 2